@@ -1,5 +1,9 @@
 # common.py - file containing functionality common to client and server
 import numpy as np
+import struct
+import zlib
+import lzma
+import hashlib
 from io import BytesIO
 
 # -------------
@@ -19,96 +23,553 @@ OFFLINE_RETURN = "Offline"
 # loops can be up to 2 minutes long
 MAX_LOOP_DURATION = 120
 
+# seconds the server holds a /watch request open waiting for the session composite to change
+WATCH_TIMEOUT = 25
+
+# numpy dtypes of loop & composite array entries, by format version
+# version 1: platform-dependent int values and float64 timestamps (16 bytes per sample on 64-bit machines, 12 on Raspbian)
+# version 2: little-endian int16 values and float32 timestamps, in seconds (6 bytes per sample everywhere)
+LOOP_FORMATS = {
+    1 : np.dtype([('value', int), ('timestamp', float)]),
+    2 : np.dtype([('value', '<i2'), ('timestamp', '<f4')])
+}
+
+# format used by the pedal, the server and everything in between
+LOOP_FORMAT_VERSION = 2
+LOOP_ARRAY_DTYPE = LOOP_FORMATS[LOOP_FORMAT_VERSION]
+
+# header saved in front of the .npy data of loop & composite payloads, so the value sum never has to be rescanned
+# magic, format version, sum of values, number of values
+# payloads without it are plain .npy files written before the header existed
+LOOP_PAYLOAD_MAGIC = b"SLOOP"
+LOOP_PAYLOAD_HEADER = struct.Struct("<5sBqq")
+
+# encoded loop & composite payloads, which delta-encode the value and timestamp columns and then compress them
+# magic, format version, codec number, sum of values, number of values
+# followed by the compressed value deltas and then timestamp deltas, each split into byte planes
+LOOP_ENCODED_MAGIC = b"SPACK"
+LOOP_ENCODED_HEADER = struct.Struct("<5sBBqq")
+
+# codecs of encoded payloads by number, with the token naming them in Accept-Encoding & Content-Encoding headers
+# the tokens are deliberately not gzip/deflate, which HTTP clients decompress behind the caller's back
+LOOP_CODECS = {
+    1 : ("x-sloop-zlib", lambda data: zlib.compress(data, 6), zlib.decompress),
+    2 : ("x-sloop-lzma", lambda data: lzma.compress(data, preset=1), lzma.decompress)
+}
+LOOP_ENCODINGS = {codec[0] : number for number, codec in LOOP_CODECS.items()}
+
+# encoding the server stores loops and composites in, and pedals upload in, so that neither is ever re-encoded in between
+LOOP_STORE_ENCODING = "x-sloop-zlib"
+
+# Accept-Encoding header of pedal downloads, the stored encoding first so the server can send it as is
+LOOP_ACCEPT_ENCODING = ", ".join([LOOP_STORE_ENCODING] + [encoding for encoding in LOOP_ENCODINGS if encoding != LOOP_STORE_ENCODING])
+
+# header of each loop in a bundle of several loop payloads: loop index, payload length
+LOOP_BUNDLE_HEADER = struct.Struct("<qq")
+
+# header saved in front of composite deltas, which replace ranges of values in a composite whose timestamps haven't changed
+# magic, format version, sum of values of the patched composite, its length, number of ranges
+# followed by the start and length of each range (little-endian uint32) and the replacement values of every range, back to back
+COMPOSITE_DELTA_MAGIC = b"SDLTA"
+COMPOSITE_DELTA_HEADER = struct.Struct("<5sBqqq")
+
+# unchanged runs of up to this many samples are sent along with the changed ranges either side of them,
+# since starting another range costs as much as sending four values
+COMPOSITE_DELTA_GAP = 4
+
+# response header carrying the session composite version a /getcomposite response brings the pedal up to
+COMPOSITE_VERSION_HEADER = "X-Composite-Version"
+
+# average number of composite samples per time bucket in a CompositeIndex
+COMPOSITE_INDEX_BUCKET_SAMPLES = 4
+
+# -----------
+#   Classes
+# -----------
+
+# -------------------------------------------------------------------------------------------------------------
+#   CompositeIndex - fixed-width time buckets over the timestamps of a composite, mapping playback time to
+#                    array offsets so the sample nearest any timestamp is found in constant time, no matter
+#                    how far the playhead has jumped. laid out once per composite by whoever writes it;
+#                    overdubbing only changes values, so the index stays valid until the composite array itself
+#                    is replaced
+# -------------------------------------------------------------------------------------------------------------
+
+class CompositeIndex():
+
+    # args:     timestamps: ascending timestamp column of a composite array, which is kept as a view
+    #           bucketsamples: average number of samples per bucket
+    #           layout: (start, bucketwidth, bucketstarts, maxbucketsize) laid out over these timestamps beforehand,
+    #                   by indexlayout or while recording them, so the index is taken up without a scan
+
+    def __init__(self, timestamps, bucketsamples=COMPOSITE_INDEX_BUCKET_SAMPLES, layout=None):
+        self.timestamps = np.asarray(timestamps)
+        self.lastindex = len(self.timestamps) - 1
+
+        if layout is None:
+            layout = indexlayout(self.timestamps, bucketsamples)
+        self.start, self.bucketwidth, self.bucketstarts, self.maxbucketsize = layout
+        self.numbuckets = len(self.bucketstarts) - 1
+
+    # bucket number of each timestamp, clipped to the buckets that exist
+
+    def buckets(self, timestamps):
+        return timebuckets(timestamps, self.start, self.bucketwidth, self.numbuckets)
+
+    # number of composite samples strictly before each timestamp (same result as numpy.searchsorted)
+
+    def countbefore(self, timestamps):
+        buckets = self.buckets(timestamps)
+        positions = self.bucketstarts[buckets]
+        ends = self.bucketstarts[buckets + 1]
+
+        # walk forward within each bucket, which never takes more steps than the fullest bucket holds
+        for _ in range(self.maxbucketsize):
+            advance = positions < ends
+            advance[advance] = self.timestamps[positions[advance]] < timestamps[advance]
+            if not advance.any():
+                break
+            positions += advance
+
+        return positions
+
+    # find the composite index played at each of the given timestamps
+    # same result as walking the index forward one sample at a time and taking the closer of the two samples
+    # adjoining each timestamp
+    # args:     timestamps: ascending playback timestamps, relative to the composite start
+    #           startindex: index reached by the previous sample, since the playhead never moves backwards
+    # return:   array of composite indices, one per timestamp
+
+    def lookup(self, timestamps, startindex=0):
+        timestamps = np.asarray(timestamps, dtype=float)
+        if not len(timestamps):
+            return np.zeros(0, dtype=int)
+
+        # last composite sample strictly before each timestamp
+        indices = np.clip(self.countbefore(timestamps) - 1, 0, self.lastindex)
+
+        # move to the following sample if it's strictly closer
+        nextindices = np.minimum(indices + 1, self.lastindex)
+        indices += (indices < self.lastindex) & (timestamps - self.timestamps[indices] > self.timestamps[nextindices] - timestamps)
+
+        indices[0] = max(indices[0], startindex)
+        return np.maximum.accumulate(indices)
+
+# -------------------------------------------------------------------------------------------------------------
+#   CompositeNorm - running sum and count of the values of a loop or composite, from which the mean subtracted
+#                   when mixing (the DC offset) is read in constant time. updated by every write to the
+#                   composite and saved alongside it, so neither the pedal nor the server rescans for it
+# -------------------------------------------------------------------------------------------------------------
+
+class CompositeNorm():
+
+    # args:     total: sum of values
+    #           count: number of values
+
+    def __init__(self, total=0, count=0):
+        self.total = int(total)
+        self.count = int(count)
+
+    # args:     total: amount added to the sum of values
+    #           count: number of values added
+
+    def add(self, total, count=0):
+        self.total += int(total)
+        self.count += int(count)
+
+    # return:   mean value, truncated the same way as np.mean(values, dtype=int)
+
+    def value(self):
+        return int(self.total / self.count) if self.count else 0
+
+    def __eq__(self, other):
+        return isinstance(other, CompositeNorm) and (self.total, self.count) == (other.total, other.count)
+
+    def __repr__(self):
+        return "CompositeNorm(%d, %d)" % (self.total, self.count)
+
 # -----------
 #   Methods
 # -----------
 
+# copy of a loop array in timestamp order, with samples of equal timestamps left in the order they were recorded
+# sorting on the timestamps alone is many times faster than sorting the structured array
+# args:     arr: loop array
+# return:   sorted copy of arr
+def sortloop(arr):
+    return arr[np.argsort(arr['timestamp'], kind="stable")]
+
+# sum the values of a loop or composite array the slow way, for arrays that don't come with a CompositeNorm
+# args:     arr: loop or composite array, or None
+# return:   CompositeNorm of arr
+def scannorm(arr):
+    if arr is None:
+        return CompositeNorm()
+    return CompositeNorm(np.sum(arr['value'], dtype=np.int64), len(arr))
+
+# add to loop or composite values in place, clipping each result to the range the values can be stored in, so
+# overdubs saturate instead of wrapping around
+# args:     values: slice of a loop or composite value column
+#           additions: amount added to each value, accumulated in int64
+# return:   change to the sum of the values, after clipping
+def addclipped(values, additions):
+    limits = np.iinfo(values.dtype)
+    previous = values.astype(np.int64)
+    clipped = np.clip(previous + additions, limits.min, limits.max)
+    values[:] = clipped
+    return int(np.sum(clipped - previous))
+
+# time bucket of each timestamp, computed in float64 so that stored float32 timestamps and playback timestamps
+# fall into the same buckets as each other
+# args:     timestamps: timestamps to place
+#           start: timestamp at which bucket 0 begins
+#           bucketwidth: duration covered by each bucket
+#           numbuckets: number of buckets; earlier and later timestamps are clipped to the first and last one
+# return:   array of bucket numbers
+def timebuckets(timestamps, start, bucketwidth, numbuckets):
+    # a single float64 working array, since composites run to millions of samples
+    buckets = np.subtract(timestamps, start, dtype=float)
+    buckets /= bucketwidth
+    np.floor(buckets, out=buckets)
+    np.clip(buckets, 0, numbuckets - 1, out=buckets)
+    return buckets.astype(int)
+
+# lay out the buckets of a CompositeIndex over the timestamps of a composite, which takes a full scan, so it's
+# done wherever the composite is written rather than by the audio process taking it up
+# args:     timestamps: ascending timestamp column of a composite array
+#           bucketsamples: average number of samples per bucket
+# return:   (start, bucketwidth, bucketstarts, maxbucketsize), where bucketstarts holds the offset of the first
+#           sample of each bucket followed by the number of samples
+def indexlayout(timestamps, bucketsamples=COMPOSITE_INDEX_BUCKET_SAMPLES):
+    numbuckets = max(1, len(timestamps) // bucketsamples)
+    start = float(timestamps[0]) if len(timestamps) else 0.0
+    span = float(timestamps[-1]) - start if len(timestamps) else 0.0
+    bucketwidth = span / numbuckets if span > 0 else 1.0
+
+    # samples are assigned to buckets with the same arithmetic used for lookups, so a timestamp's bucket
+    # always holds the boundary between the samples before it and the samples at or after it
+    bucketcounts = np.bincount(timebuckets(timestamps, start, bucketwidth, numbuckets), minlength=numbuckets)
+    bucketstarts = np.concatenate(([0], np.cumsum(bucketcounts)))
+    maxbucketsize = int(bucketcounts.max()) if len(timestamps) else 0
+
+    return (start, bucketwidth, bucketstarts, maxbucketsize)
+
 # helper method to add a loop to the composite
 # args:     composite: composite loop
 #           loop: new loop to add
-def mergeloops(composite, loop):
+#           compositesum: CompositeNorm of composite, scanned for if not given
+#           loopsum: CompositeNorm of loop, scanned for if not given
+# return:   (merged composite, CompositeNorm of merged composite)
+def mergeloops(composite, loop, compositesum=None, loopsum=None):
     if composite is None:
-        return loop
+        return (loop, loopsum if loopsum is not None else scannorm(loop))
 
-    composite = composite[composite['timestamp'] < MAX_LOOP_DURATION]
+    cutoff = composite['timestamp'] < MAX_LOOP_DURATION
+    if compositesum is None or not cutoff.all():
+        composite = composite[cutoff]
+        compositesum = scannorm(composite)
+    else:
+        composite = composite.copy()
+        compositesum = CompositeNorm(compositesum.total, compositesum.count)
 
     if loop is None:
-        return composite
+        return (composite, compositesum)
 
-    compositeindex = lastcompositeindex = loopindex = 0
-    compositenorm = np.mean(composite[:]['value'], dtype=int)
-    
-    # add all of loop to composite, looping through composite multiple times if necessary
-    while loopindex < len(loop):
+    if not len(composite):
+        return (loop, loopsum if loopsum is not None else scannorm(loop))
 
-        if compositeindex >= len(composite):
-            compositeindex = 0
-    
-        inputvalue, inputtimestamp = loop[loopindex]
+    compositenorm = compositesum.value()
 
-        while compositeindex < len(composite) - 1 and inputtimestamp > composite[compositeindex + 1]['timestamp']:
-            compositeindex += 1
+    # find the composite sample closest to each loop sample, using the same lookup as the pedal's playback
+    compositeindices = CompositeIndex(composite['timestamp']).lookup(loop['timestamp'])
+    lastcompositeindices = np.concatenate(([0], compositeindices[:-1]))
 
-        # play & write to the closer of the two samples adjoining the current timestamp (or the index sample if the index is at the end of the array)
-        compositeindex = compositeindex if (compositeindex == len(composite) - 1 or inputtimestamp - composite[compositeindex]['timestamp'] <= composite[compositeindex + 1]['timestamp'] - inputtimestamp) else compositeindex + 1
+    # merge input and composite value by adding them and subtracting the mean of the composite array
+    # write to all indices between the last written one and this one
+    # which will result in some pretty square sonic waves, but it's better than having composite array
+    # indices that aren't written to by subsequent loops
+    # each sample's range is accumulated into a difference array, so the whole loop is added in one pass
+    deltas = loop['value'] - compositenorm
+    steps = np.zeros(len(composite) + 1, dtype=np.int64)
+    np.add.at(steps, lastcompositeindices + 1, deltas)
+    np.add.at(steps, compositeindices + 1, -deltas)
+    compositesum.add(addclipped(composite['value'], np.cumsum(steps[:-1])))
 
-        compositevalue = composite[compositeindex]['value']
+    return (composite, compositesum)
 
-        # merge input and output value by adding them and subtracting the mean of the composite array
-        outputvalue = inputvalue + compositevalue - compositenorm
+# convert a loop or composite array of any format version to the current format
+# args:     arr: structured array with value and timestamp fields
+# return:   arr itself if already in the current format, otherwise a converted copy
+def toloopformat(arr):
+    if arr.dtype == LOOP_ARRAY_DTYPE:
+        return arr
+    if arr.dtype.names is None or not {'value', 'timestamp'} <= set(arr.dtype.names):
+        raise ValueError("Not a loop array: %s" % str(arr.dtype))
+    return arr.astype(LOOP_ARRAY_DTYPE)
 
-        # add merged input and composite, and average timestamps of composite recording and current input
-        # write to all indices between the last written one and this one
-        # which will result in some pretty square sonic waves, but it's better than having composite array
-        # indices that aren't written to by subsequent loops
-        if lastcompositeindex <= compositeindex:
-            composite[lastcompositeindex + 1 : compositeindex + 1]['value'] +=  inputvalue - compositenorm
+# read a loop or composite payload written by saveloop or encodeloop, or a plain .npy file of any format version
+# args:     data: payload bytes
+# return:   (array in the current format, CompositeNorm of array)
+def loadloop(data):
+    if data[:len(LOOP_ENCODED_MAGIC)] == LOOP_ENCODED_MAGIC:
+        return decodeloop(data)
 
+    if data[:len(LOOP_PAYLOAD_MAGIC)] == LOOP_PAYLOAD_MAGIC and len(data) >= LOOP_PAYLOAD_HEADER.size:
+        _, _, total, count = LOOP_PAYLOAD_HEADER.unpack_from(data)
+        arr = toloopformat(np.load(BytesIO(data[LOOP_PAYLOAD_HEADER.size:]), allow_pickle=False))
+        if count == len(arr):
+            return (arr, CompositeNorm(total, count))
+        return (arr, scannorm(arr))
 
-        # if the composite index looped around since last pass
-        # even if the composite array has changed size since the last pass, and lastcompositeindex is larger
-        # than the end of the array, this won't throw an error, it'll just only write the [ : compositeindex + 1] piece
-        else:
-            composite[lastcompositeindex + 1 : ] = composite[ : compositeindex + 1] = (outputvalue, (inputtimestamp + composite[compositeindex]['timestamp']) / 2)
-            compositedata[lastcompositeindex + 1 : ]['value'] += inputvalue - compositenorm
-            compositedata[ : compositeindex + 1]['value'] += inputvalue - compositenorm
+    arr = toloopformat(np.load(BytesIO(data), allow_pickle=False))
+    return (arr, scannorm(arr))
+
+# serialize a loop or composite array in the current format, along with the sum of its values
+# args:     arr: loop or composite array
+#           arrsum: CompositeNorm of arr, scanned for if not given
+# return:   payload bytes
+def saveloop(arr, arrsum=None):
+    arr = toloopformat(arr)
+    if arrsum is None or arrsum.count != len(arr):
+        arrsum = scannorm(arr)
+
+    # write numpy array to a virtual bytes file after the header, and then save the bytes output
+    loopfile = BytesIO()
+    loopfile.write(LOOP_PAYLOAD_HEADER.pack(LOOP_PAYLOAD_MAGIC, LOOP_FORMAT_VERSION, arrsum.total, arrsum.count))
+    np.save(loopfile, arr)
+    return loopfile.getvalue()
+
+# split an array of fixed-width numbers into byte planes (every first byte, then every second byte...), which puts
+# the mostly-zero high bytes of small deltas next to each other where the compressor can make the most of them
+# args:     arr: 1-D array of fixed-width numbers
+# return:   byte planes, back to back
+def splitbytes(arr):
+    return np.ascontiguousarray(arr).view(np.uint8).reshape(-1, arr.dtype.itemsize).T.tobytes()
+
+# reverse splitbytes
+# args:     data: byte planes, back to back
+#           dtype: dtype of the numbers
+# return:   1-D array of numbers
+def joinbytes(data, dtype):
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).ravel()
+
+# serialize a loop or composite array in the current format, delta-encoded and compressed
+# audio changes little from one sample to the next and timestamps are evenly spaced, so the differences between
+# consecutive values and consecutive timestamp bit patterns are small and repetitive. both are taken with wraparound,
+# which makes the encoding lossless whatever the array holds
+# args:     arr: loop or composite array
+#           arrsum: CompositeNorm of arr, scanned for if not given
+#           encoding: one of LOOP_ENCODINGS
+# return:   encoded payload bytes
+def encodeloop(arr, arrsum=None, encoding=LOOP_STORE_ENCODING):
+    arr = toloopformat(arr)
+    if arrsum is None or arrsum.count != len(arr):
+        arrsum = scannorm(arr)
+
+    codec = LOOP_ENCODINGS[encoding]
+    values = np.ascontiguousarray(arr['value'])
+    timestamps = np.ascontiguousarray(arr['timestamp']).view('<u4')
+    body = splitbytes(np.diff(values, prepend=values.dtype.type(0))) + splitbytes(np.diff(timestamps, prepend=timestamps.dtype.type(0)))
+
+    header = LOOP_ENCODED_HEADER.pack(LOOP_ENCODED_MAGIC, LOOP_FORMAT_VERSION, codec, arrsum.total, arrsum.count)
+    return header + LOOP_CODECS[codec][1](body)
+
+# read a payload written by encodeloop
+# args:     data: encoded payload bytes
+# return:   (array in the current format, CompositeNorm of array)
+def decodeloop(data):
+    if data[:len(LOOP_ENCODED_MAGIC)] != LOOP_ENCODED_MAGIC or len(data) < LOOP_ENCODED_HEADER.size:
+        raise ValueError("Not an encoded loop")
+    _, formatversion, codec, total, count = LOOP_ENCODED_HEADER.unpack_from(data)
+    if formatversion != LOOP_FORMAT_VERSION or codec not in LOOP_CODECS:
+        raise ValueError("Unsupported loop encoding: format version %d, codec %d" % (formatversion, codec))
+
+    try:
+        body = LOOP_CODECS[codec][2](data[LOOP_ENCODED_HEADER.size:])
+    except (zlib.error, lzma.LZMAError):
+        raise ValueError("Corrupt encoded loop")
+    if len(body) != count * LOOP_ARRAY_DTYPE.itemsize:
+        raise ValueError("Corrupt encoded loop")
 
-        lastcompositeindex = compositeindex
+    valuessize = count * LOOP_ARRAY_DTYPE['value'].itemsize
+    arr = np.zeros(count, dtype=LOOP_ARRAY_DTYPE)
+    arr['value'] = np.cumsum(joinbytes(body[:valuessize], LOOP_ARRAY_DTYPE['value']), dtype=LOOP_ARRAY_DTYPE['value'])
+    arr['timestamp'] = np.cumsum(joinbytes(body[valuessize:], '<u4'), dtype='<u4').view(LOOP_ARRAY_DTYPE['timestamp'])
+    return (arr, CompositeNorm(total, count))
 
-        # save input to loop array to upload to server
-        # store timestamp relative to composite playback head, and sort array by timestamps before submitting
-        loop[loopindex] = (inputvalue, inputtimestamp)
-        loopindex += 1 
+# name of the encoding a payload is in
+# args:     data: payload bytes
+# return:   one of LOOP_ENCODINGS, or None if the payload isn't encoded
+def loopencoding(data):
+    if data[:len(LOOP_ENCODED_MAGIC)] == LOOP_ENCODED_MAGIC and len(data) >= LOOP_ENCODED_HEADER.size:
+        codec = LOOP_ENCODED_HEADER.unpack_from(data)[2]
+        if codec in LOOP_CODECS:
+            return LOOP_CODECS[codec][0]
+    return None
 
-    return composite
+# loop encodings listed in an Accept-Encoding header, in the order given, leaving out any refused with q=0
+# args:     header: Accept-Encoding header value, or None
+# return:   list of names in LOOP_ENCODINGS
+def acceptedencodings(header):
+    accepted = []
+    for item in (header or "").split(","):
+        name, _, params = item.partition(";")
+        name, params = name.strip(), params.replace(" ", "")
+        try:
+            quality = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            quality = 0.0
+        if name in LOOP_ENCODINGS and quality > 0:
+            accepted.append(name)
+    return accepted
+
+# bring a stored loop or composite payload into an encoding the receiver accepts
+# args:     data: payload bytes, in any form loadloop reads
+#           accepted: loop encodings the receiver accepts, most preferred first
+# return:   (payload bytes, name of its encoding or None for a plain saveloop payload)
+#           data itself is returned whenever it's already in an accepted encoding
+def negotiateloop(data, accepted):
+    encoding = loopencoding(data)
+    if encoding in accepted:
+        return (data, encoding)
+    if accepted:
+        return (encodeloop(*loadloop(data), encoding=accepted[0]), accepted[0])
+    return (saveloop(*loadloop(data)), None)
+
+# content hash of a loop, the same whatever form the loop is stored or sent in, so a pedal and the server can tell whether
+# they hold the same loop without sending it
+# args:     arr: loop array
+# return:   hex digest string
+def loophash(arr):
+    return hashlib.sha256(np.ascontiguousarray(toloopformat(arr)).tobytes()).hexdigest()
+
+# join several loop payloads into one, so they can be sent in a single response
+# args:     loops: list of (loop index, payload bytes)
+# return:   bundle bytes
+def packloops(loops):
+    return b"".join([LOOP_BUNDLE_HEADER.pack(loopindex, len(payload)) + payload for loopindex, payload in loops])
+
+# split a bundle written by packloops
+# args:     data: bundle bytes
+# return:   list of (loop index, payload bytes)
+def unpackloops(data):
+    loops = []
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < LOOP_BUNDLE_HEADER.size:
+            raise ValueError("Truncated loop bundle")
+        loopindex, length = LOOP_BUNDLE_HEADER.unpack_from(data, offset)
+        offset += LOOP_BUNDLE_HEADER.size
+        if length < 0 or len(data) - offset < length:
+            raise ValueError("Truncated loop bundle")
+        loops.append((loopindex, data[offset : offset + length]))
+        offset += length
+    return loops
+
+# find the ranges of values that differ between two versions of a composite
+# args:     old: previous composite array
+#           new: current composite array
+#           gap: longest unchanged run to send along with the changed ranges around it
+# return:   (starts, lengths) of the changed ranges, or None if the composites differ in length or timestamps,
+#           which only a full composite can bring a pedal up to date with
+def diffcomposites(old, new, gap=COMPOSITE_DELTA_GAP):
+    if old is None or new is None or len(old) != len(new) or not np.array_equal(old['timestamp'], new['timestamp']):
+        return None
+
+    changed = np.flatnonzero(old['value'] != new['value'])
+    if not len(changed):
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+
+    # a new range begins wherever the run of unchanged samples since the last change is too long to send
+    breaks = np.flatnonzero(np.diff(changed) > gap + 1)
+    starts = changed[np.concatenate(([0], breaks + 1))]
+    ends = changed[np.concatenate((breaks, [len(changed) - 1]))] + 1
+    return (starts, ends - starts)
+
+# serialize the changes between two versions of a composite
+# args:     old: previous composite array
+#           new: current composite array
+#           newsum: CompositeNorm of new, scanned for if not given
+# return:   delta payload bytes, or None if only a full composite will do
+def savedelta(old, new, newsum=None):
+    ranges = diffcomposites(old, new)
+    if ranges is None:
+        return None
+    starts, lengths = ranges
+    if newsum is None or newsum.count != len(new):
+        newsum = scannorm(new)
+
+    values = [new['value'][start : start + length] for start, length in zip(starts.tolist(), lengths.tolist())]
+    return packdelta(starts, lengths, np.concatenate(values) if values else np.zeros(0), newsum)
+
+# args:     starts, lengths: ranges of the delta, applied in order
+#           values: replacement values of every range, back to back
+#           compositesum: CompositeNorm of the patched composite
+# return:   delta payload bytes
+def packdelta(starts, lengths, values, compositesum):
+    deltafile = BytesIO()
+    deltafile.write(COMPOSITE_DELTA_HEADER.pack(COMPOSITE_DELTA_MAGIC, LOOP_FORMAT_VERSION, compositesum.total, compositesum.count, len(starts)))
+    for arr, dtype in ((starts, '<u4'), (lengths, '<u4'), (values, LOOP_ARRAY_DTYPE['value'])):
+        deltafile.write(np.asarray(arr).astype(dtype).tobytes())
+    return deltafile.getvalue()
+
+# read a delta payload written by savedelta or chaindeltas
+# args:     data: payload bytes
+# return:   (starts, lengths, values, CompositeNorm of the patched composite)
+def loaddelta(data):
+    if data[:len(COMPOSITE_DELTA_MAGIC)] != COMPOSITE_DELTA_MAGIC or len(data) < COMPOSITE_DELTA_HEADER.size:
+        raise ValueError("Not a composite delta")
+    _, _, total, count, numranges = COMPOSITE_DELTA_HEADER.unpack_from(data)
+
+    offset = COMPOSITE_DELTA_HEADER.size
+    starts = np.frombuffer(data, dtype='<u4', count=numranges, offset=offset).astype(int)
+    lengths = np.frombuffer(data, dtype='<u4', count=numranges, offset=offset + 4 * numranges).astype(int)
+    valuedtype = LOOP_ARRAY_DTYPE['value']
+    values = np.frombuffer(data, dtype=valuedtype, offset=offset + 8 * numranges)
+    if len(values) != lengths.sum() or (numranges and (starts + lengths).max() > count):
+        raise ValueError("Corrupt composite delta")
+    return (starts, lengths, values, CompositeNorm(total, count))
+
+# join consecutive deltas into one that takes a composite from the first one's base version to the last one's version
+# args:     deltas: delta payloads in version order
+# return:   delta payload bytes
+def chaindeltas(deltas):
+    parts = [loaddelta(delta) for delta in deltas]
+    return packdelta(*[np.concatenate([part[field] for part in parts]) for field in range(3)], parts[-1][3])
+
+# replace ranges of values in a composite, in place
+# args:     composite: composite array, or a view of one
+#           starts, lengths: ranges of the delta, applied in order, so later ranges win where they overlap
+#           values: replacement values of every range, back to back
+def applydelta(composite, starts, lengths, values):
+    offset = 0
+    for start, length in zip(starts.tolist(), lengths.tolist()):
+        composite['value'][start : start + length] = values[offset : offset + length]
+        offset += length
 
 # actually combines given numpy data arrays using same timestamp-maintaining algorithm as the pedal
 # args: loops:      array of recorded loops
 #       composite:  base loop to record atop
 #       bytestore:  load loops from byte-string and store composite to byte-string instead of treating them as numpy arrays (default True)
-# return:   byte representation of composite array given by numpy.save()
+# return:   payload representation of composite array given by encodeloop(), or (composite array, CompositeNorm) if not bytestore
 def combineloops(loops, composite=None, bytestore=True):
     if len(loops):
         if bytestore:
-            compositeaudio = None
+            compositeaudio = compositesum = None
             if composite:
-                compositeaudio = np.load(BytesIO(composite), allow_pickle=False)
+                compositeaudio, compositesum = loadloop(composite)
             for loop in loops:
-                loopaudio = np.load(BytesIO(loop.npdata), allow_pickle=False)
-                compositeaudio = mergeloops(compositeaudio, loopaudio)
-
-            # write returnaudio numpy array to a virtual bytes file, and then save the bytes output
-            returnfile = BytesIO()
-            np.save(returnfile, compositeaudio)
-            returndata = returnfile.getvalue()
-                
-            return returndata
+                loopaudio, loopsum = loadloop(loop.npdata)
+                compositeaudio, compositesum = mergeloops(compositeaudio, loopaudio, compositesum, loopsum)
+
+            return encodeloop(compositeaudio, compositesum)
         else:
+            compositesum = None
             for loop in loops:
-                composite = mergeloops(composite, loop)
+                composite, compositesum = mergeloops(composite, loop, compositesum)
 
-            return composite
+            return (composite, compositesum)
     else:
         return None
-
-
@@ -5,23 +5,62 @@
 import numpy as np
 from enum import Enum
 import time
+import logging
 import queue
+import mmap
+import os
+import gc
+import ctypes
+import ctypes.util
+from collections import deque
 
-from . import rpi, vrpi
+from common import *
+
+from . import rpi, vrpi, frpi
 
 AUDIO_OUT       = {
     'PWM0'  : 18,
     'PWM1'  : 13
 }
 
-# loops can be up to 2 minutes long
-MAX_LOOP_DURATION = 120
-
-# numpy dtype to define loop & composite array entries
-LOOP_ARRAY_DTYPE = [('value', int), ('timestamp', float)]
-
-# add 10 seconds worth of loop time to the array each time its length is met
-ARRAY_SIZE_SEC = 10
+# assumed sample rate until the audio loop has measured one
+DEFAULT_SAMPLE_PERIOD = 1 / 44100.0
+
+# extra room planned into recording buffers on top of MAX_LOOP_DURATION at the measured sample rate,
+# to absorb sample rate drift over the course of a loop
+BUFFER_HEADROOM = 1.1
+
+# number of samples read, mixed and written per pass of the audio loop
+# every block size reproduces the original sample-by-sample behavior exactly, but a pass has a fixed cost that only
+# larger blocks pay off: single-sample blocks can't keep up with 44.1 kHz. 128 samples is under 3 ms of audio
+AUDIO_BLOCK_SIZE = 128
+
+# number of samples between debug log passes
+DEBUG_INTERVAL = 1000000
+
+# sample clock calibration
+# the clock takes a monotonic reading every CLOCK_POINT_SAMPLES samples, and measures the sample period over the
+# readings from the last CLOCK_WINDOW seconds. drift between sample time and monotonic time is slewed out over
+# CLOCK_SLEW_SAMPLES samples, never changing the period by more than CLOCK_MAX_SLEW
+CLOCK_POINT_SAMPLES = 1024
+CLOCK_WINDOW        = 2.0
+CLOCK_SLEW_SAMPLES  = 44100
+CLOCK_MAX_SLEW      = 0.01
+
+# real-time profile defaults
+# cpu: core the audio process is pinned to (None for the last core, leaving core 0 to the OS and the UI)
+# priority: SCHED_FIFO priority, granted only with CAP_SYS_NICE or a matching RLIMIT_RTPRIO
+# gc: "freeze" moves everything allocated during setup out of the collector's reach, "disable" turns the collector
+#     off for the lifetime of the audio loop
+REALTIME_CPU        = None
+REALTIME_PRIORITY   = 70
+REALTIME_GC         = "freeze"
+
+# mlockall flags from <sys/mman.h>
+# MCL_ONFAULT (Linux 4.4+) locks pages as they're first touched, so lazily paged buffers stay lazy
+MCL_CURRENT = 1
+MCL_FUTURE  = 2
+MCL_ONFAULT = 4
 
 # array of default keyword arguments passed to run method
 AP_KW_DEFAULTS = {
@@ -31,7 +70,28 @@ AP_KW_DEFAULTS = {
                         'audioout'  : None
                        },
 
-    'itertimestamp' : False
+    'itertimestamp' : False,
+
+    # virtual input gives way to control commands while it waits, so they take effect between the same two samples
+    # every time, however the process is scheduled. used with a pedal stepped by a vrpi.VirtualClock (virtualize only)
+    'virtualtime'   : False,
+
+    # process audio files instead, as fast as possible (takes precedence over virtualize)
+    # audioin: .npy or WAV input file, audioout: .npy or WAV output file
+    'files'         : {
+                        'audioin'   : None,
+                        'audioout'  : None
+                       },
+
+    'blocksize'     : AUDIO_BLOCK_SIZE,
+
+    # opt-in real-time profile for the audio process (Linux only)
+    # each knob is only used when realtime is set, and can be turned off individually with False
+    'realtime'      : False,
+    'rtcpu'         : REALTIME_CPU,
+    'rtpriority'    : REALTIME_PRIORITY,
+    'rtmlock'       : True,
+    'rtgc'          : REALTIME_GC
 }
 
 # enum to map control commands passed from main thread to program state dict keys
@@ -40,30 +100,312 @@ class Control(str, Enum):
     ToggleMonitoring    = "monitoring"
     ToggleRecording     = "recording"
 
+# ---------------------------------------------------------------------------------------------------------------------
+#   RecordingBuffer - preallocated buffer the first loop is recorded into, which then becomes the composite
+#                     sized for MAX_LOOP_DURATION at the measured sample rate and reused between loops, so the audio
+#                     loop never grows or copies arrays. backed by an anonymous mapping, so the pages past the end
+#                     of a finalized loop are handed back to the OS, keeping peak memory at one full-length loop.
+#                     the CompositeIndex of the loop is laid out block by block as it's recorded, in buckets a
+#                     fixed number of sample periods wide, so it's ready to play the moment the loop ends
+# ---------------------------------------------------------------------------------------------------------------------
+
+class RecordingBuffer():
+
+    # args:     dtype: numpy dtype of loop & composite array entries
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self.mapping = None
+        self.data = None
+        self.bucketstarts = None
+
+    # make sure the buffer can hold a full-length loop at the given sample period, allocating only if it can't
+    # args:     sampleperiod: measured average sample period
+    # return:   writable array spanning the whole buffer
+
+    def plan(self, sampleperiod):
+        capacity = int(MAX_LOOP_DURATION / sampleperiod * BUFFER_HEADROOM)
+        if self.data is None or len(self.data) < capacity:
+            # pages of a private anonymous mapping aren't resident until they're written to
+            self.mapping = mmap.mmap(-1, capacity * self.dtype.itemsize, flags=mmap.MAP_PRIVATE)
+            self.data = np.frombuffer(self.mapping, dtype=self.dtype)
+            self.bucketstarts = np.zeros(capacity // COMPOSITE_INDEX_BUCKET_SAMPLES + 2, dtype=np.int64)
+
+        # recorded timestamps start from zero
+        self.bucketwidth = sampleperiod * COMPOSITE_INDEX_BUCKET_SAMPLES
+        self.bucketstarts[0] = 0
+        self.lastbucket = -1
+        self.maxbucketsize = 0
+        return self.data
+
+    # lay out the index buckets of samples just recorded into the buffer, after those recorded before them
+    # args:     start: offset of the first sample recorded
+    #           count: number of samples recorded
+
+    def record(self, start, count):
+        if not count:
+            return
+
+        # the last bucket takes any samples past the ones the buffer was planned for
+        buckets = timebuckets(self.data['timestamp'][start : start + count], 0.0, self.bucketwidth, len(self.bucketstarts) - 1)
+        lastbucket = int(buckets[-1])
+        if lastbucket > self.lastbucket:
+            newbuckets = np.arange(self.lastbucket + 1, lastbucket + 1)
+            self.bucketstarts[newbuckets] = start + np.searchsorted(buckets, newbuckets, side="left")
+
+            # every bucket before the newest one is complete
+            sizes = np.diff(self.bucketstarts[max(self.lastbucket, 0) : lastbucket + 1])
+            if len(sizes):
+                self.maxbucketsize = max(self.maxbucketsize, int(sizes.max()))
+            self.lastbucket = lastbucket
+
+    # index over the samples recorded, once recording has ended
+    # args:     length: number of samples recorded
+    # return:   CompositeIndex of the recorded samples
+
+    def lookup(self, length):
+        numbuckets = max(self.lastbucket, 0) + 1
+        self.bucketstarts[numbuckets] = length
+        maxbucketsize = max(self.maxbucketsize, length - int(self.bucketstarts[numbuckets - 1]))
+        return CompositeIndex(self.data['timestamp'][:length], layout=(0.0, self.bucketwidth, self.bucketstarts[:numbuckets + 1], maxbucketsize))
+
+    # finish recording into the buffer and release the pages past the end of the recording
+    # args:     length: number of samples recorded
+    # return:   view of the recorded samples
+
+    def finalize(self, length):
+        self.releasepages(length * self.dtype.itemsize)
+        return self.data[:length]
+
+    # release every page of the buffer, once nothing is playing from it anymore
+
+    def release(self):
+        self.releasepages(0)
+
+    def releasepages(self, start):
+        if self.mapping is not None and hasattr(self.mapping, "madvise"):
+            start = -(-start // mmap.PAGESIZE) * mmap.PAGESIZE
+            if start < len(self.mapping):
+                # locked pages (real-time profile) can't be released, and simply stay resident
+                try:
+                    self.mapping.madvise(mmap.MADV_DONTNEED, start, len(self.mapping) - start)
+                except OSError:
+                    pass
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   SampleClock - audio time base that counts samples, instead of reading the wall clock for every block
+#                 the sample period is calibrated against the monotonic clock over a sliding window, so it follows
+#                 the actual sample rate as it changes, and is immune to wall clock adjustments. any drift between
+#                 the two is slewed out gradually, keeping timestamps strictly increasing. while no samples flow
+#                 (monitoring is off) time keeps passing, and the clock picks up from the monotonic clock when
+#                 samples resume
+# ---------------------------------------------------------------------------------------------------------------------
+
+class SampleClock():
+
+    # args:     sampleperiod: assumed sample period until one has been measured
+    #           fixed: don't calibrate, and advance time by exactly one sample period per sample or idle pass
+    #                  (deterministic timestamps for unit testing, or unpaced file processing)
+    #           source: monotonic clock in nanoseconds
+    #           nominalperiod: sample period of the actual audio, if a fixed clock's period isn't one
+
+    def __init__(self, sampleperiod=DEFAULT_SAMPLE_PERIOD, fixed=False, source=time.monotonic_ns, nominalperiod=None):
+        self.period = self.step = sampleperiod
+        self.nominalperiod = nominalperiod if nominalperiod is not None else sampleperiod
+        self.fixed = fixed
+        self.source = source
+
+        self.origin = source()
+        self.time = 0.0
+        self.samples = 0
+
+        # calibration readings: (sample count, monotonic time)
+        self.window = deque()
+        self.nextpoint = 0
+        self.drift = 0.0
+        self.resync = not fixed
+
+        self.offsets = np.arange(1)
+
+    # measured sample rate, in Hz
+
+    def rate(self):
+        return 1.0 / self.period
+
+    # sample period of the actual audio, for sizing buffers
+
+    def audioperiod(self):
+        return self.nominalperiod if self.fixed else self.period
+
+    # note a pass of the audio loop without samples
+
+    def idle(self):
+        if self.fixed:
+            self.time += self.period
+        else:
+            self.resync = True
+
+    # count a block of samples
+    # args:     count: number of samples in the block
+    # return:   timestamp of each sample in the block, in seconds
+
+    def tick(self, count):
+        if self.resync:
+            now = self.source()
+            self.time = (now - self.origin) / 1e9
+            self.window.clear()
+            self.window.append((self.samples, now))
+            self.nextpoint = self.samples + CLOCK_POINT_SAMPLES
+            self.resync = False
+
+        if len(self.offsets) < count:
+            self.offsets = np.arange(count)
+
+        timestamps = self.time + self.step * (self.offsets[:count] + 1)
+        self.time += self.step * count
+        self.samples += count
+
+        if not self.fixed and self.samples >= self.nextpoint:
+            self.calibrate()
+
+        return timestamps
+
+    # take a monotonic reading, and remeasure the sample period and drift
+
+    def calibrate(self):
+        now = self.source()
+        self.window.append((self.samples, now))
+        while len(self.window) > 2 and now - self.window[1][1] >= CLOCK_WINDOW * 1e9:
+            self.window.popleft()
+
+        firstsamples, firsttime = self.window[0]
+        if self.samples > firstsamples:
+            self.period = (now - firsttime) / 1e9 / (self.samples - firstsamples)
+
+        # positive drift means sample time is running ahead of monotonic time
+        self.drift = self.time - (now - self.origin) / 1e9
+        correction = max(-CLOCK_MAX_SLEW, min(CLOCK_MAX_SLEW, self.drift / self.period / CLOCK_SLEW_SAMPLES))
+        self.step = self.period * (1 - correction)
+
+        self.nextpoint = self.samples + CLOCK_POINT_SAMPLES
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   overdub:    add a block of input to the composite values, writing each sample to all indices between the previous
+#               sample's index (exclusive) and its own (inclusive), or to its own index if the playhead hasn't moved
+#               values saturate at the limits of the value dtype instead of wrapping around
+#   args:   values:     composite value column, modified in place
+#           indices:    nondecreasing composite indices for the block, as returned by CompositeIndex.lookup
+#           lastindex:  composite index of the sample preceding the block
+#           deltas:     input values minus the composite norm
+#           valuesum:   CompositeNorm of the composite, updated in place with the values written
+#   return: composite value heard by each sample, including earlier overdubs to the same index within the block
+# ---------------------------------------------------------------------------------------------------------------------
+
+def overdub(values, indices, lastindex, deltas, valuesum=None):
+    previous = np.concatenate(([lastindex], indices[:-1]))
+
+    # a sample hears the deltas of earlier samples in its run of identical indices
+    runstarts = np.flatnonzero(np.concatenate(([True], indices[1:] != indices[:-1])))
+    priordeltas = np.cumsum(deltas) - deltas
+    played = values[indices] + priordeltas - np.repeat(priordeltas[runstarts], np.diff(np.append(runstarts, len(indices))))
+    limits = np.iinfo(values.dtype)
+    np.clip(played, limits.min, limits.max, out=played)
+
+    # accumulate each sample's write range into a difference array, then apply it with one slice addition
+    lows = np.where(previous < indices, previous + 1, indices)
+    base = lows[0]
+    steps = np.zeros(indices[-1] - base + 2, dtype=np.int64)
+    np.add.at(steps, lows - base, deltas)
+    np.add.at(steps, indices - base + 1, -deltas)
+    written = addclipped(values[base : indices[-1] + 1], np.cumsum(steps[:-1]))
+
+    if valuesum is not None:
+        valuesum.add(written)
+
+    return played
+
+# ---------------------------------------------------------------------------------------------------------------------
+#   applyrealtime:  apply the real-time profile to the calling process. every knob is best-effort: one that isn't
+#                   supported or permitted is skipped and reported, and the rest are still applied
+#   args:   args:   run keyword arguments
+#   return: (list of knobs applied, list of knobs skipped with the reason)
+# ---------------------------------------------------------------------------------------------------------------------
+
+def applyrealtime(args):
+    applied = []
+    skipped = []
+
+    if args['rtcpu'] is not False:
+        if hasattr(os, "sched_setaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            cpu = cpus[-1] if args['rtcpu'] is None else args['rtcpu']
+            try:
+                os.sched_setaffinity(0, {cpu})
+                applied.append("pinned to cpu %d" % cpu)
+            except OSError as e:
+                skipped.append("cpu %s affinity (%s)" % (cpu, e.strerror or e))
+        else:
+            skipped.append("cpu affinity (unsupported)")
+
+    if args['rtpriority']:
+        if hasattr(os, "sched_setscheduler"):
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(args['rtpriority']))
+                applied.append("SCHED_FIFO priority %d" % args['rtpriority'])
+            except OSError as e:
+                skipped.append("SCHED_FIFO priority %d (%s)" % (args['rtpriority'], e.strerror or e))
+        else:
+            skipped.append("SCHED_FIFO (unsupported)")
+
+    if args['rtmlock']:
+        libcname = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libcname, use_errno=True) if libcname else None
+        if libc is not None and hasattr(libc, "mlockall"):
+            # fall back to locking everything up front on kernels without MCL_ONFAULT
+            if libc.mlockall(MCL_CURRENT | MCL_FUTURE | MCL_ONFAULT) == 0:
+                applied.append("memory locked on fault")
+            elif libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+                applied.append("memory locked")
+            else:
+                skipped.append("memory lock (%s)" % os.strerror(ctypes.get_errno()))
+        else:
+            skipped.append("memory lock (unsupported)")
+
+    if args['rtgc'] == "freeze":
+        gc.collect()
+        gc.freeze()
+        applied.append("gc frozen")
+    elif args['rtgc'] == "disable":
+        gc.disable()
+        applied.append("gc disabled")
+
+    return applied, skipped
+
 # ----------------------------------------------------------------------------------------------------
 #   run:    process tasked with processing and recording audio input
-#   args:   controlqueue:       FIFO inbound queue containing pedal state change information
-#           compositequeue:     FIFO inbound queue containing downloaded composite numpy arrays
-#           loopqueue:          FIFO outbound queue used by AudioProcessor to export recorded loops
-#           logqueue:           FIFO outbound queue to pass logs to parent Pedal process
+#   args:   controlblock:       shared-memory ControlBlock carrying Control commands from the pedal
+#           compositebuffer:    shared-memory CompositeBuffer the Pedal publishes downloaded composites to
+#           looparena:          shared-memory LoopArena that loops are recorded into
+#           telemetry:          shared-memory Telemetry counters updated as the audio loop runs
+#           loopqueue:          FIFO outbound queue used by AudioProcessor to export handles to recorded loops
+#           logring:            shared-memory LogRing to pass logs to parent Pedal process without blocking
 # ----------------------------------------------------------------------------------------------------
 
-def run(controlqueue, compositequeue, loopqueue, logqueue, kwargs):
+def run(controlblock, compositebuffer, looparena, telemetry, loopqueue, logring, kwargs):
 
-    logqueue.put(("INFO", "AudioProcessor - Starting execution..."))
+    logring.put(logging.INFO, "AudioProcessor - Starting execution...")
 
-    args = AP_KW_DEFAULTS
+    args = dict(AP_KW_DEFAULTS)
 
     # only override the keyword arguments that appear in the PEDAL_KW_DEFAULTS dict
     args.update((k, v) for k, v in kwargs.items() if k in list(AP_KW_DEFAULTS.keys()))
 
-    # simple helper method to append whitespace to array
-    # return: new array with whitespace appended
-    def extendarray(arr, avgsampleperiod=(1 / 44100.0)):
-        return np.append(arr, np.zeros((int(ARRAY_SIZE_SEC / avgsampleperiod)), dtype=LOOP_ARRAY_DTYPE)) if arr is not None else np.zeros((int(ARRAY_SIZE_SEC / avgsampleperiod)), dtype=LOOP_ARRAY_DTYPE) 
+    if args['files']['audioin']:
+        audioin     = frpi.SPI(args['files']['audioin'])
+        audioout    = frpi.PWM(args['files']['audioout'], len(audioin), audioin.rate)
 
-    if args['virtualize']:
-        audioin     = vrpi.SPI(args['vqueues']['audioin'])
+    elif args['virtualize']:
+        audioin     = vrpi.SPI(args['vqueues']['audioin'], interrupt=controlblock.pending if args['virtualtime'] else None)
         audioout    = vrpi.PWM(args['vqueues']['audioout'])
 
     else:
@@ -76,73 +418,131 @@ def run(controlqueue, compositequeue, loopqueue, logqueue, kwargs):
         'recording'     : False,
     }
 
+    # publish the initial status, so the pedal can read the flags the audio process is actually running with
+    for command in Control:
+        controlblock.setflag(command, status[command.value])
+
     # initialize values for composite iteration & timestamp calculation
     # compositepassstart: timestamp when the composite loop was last started or restarted
     # looprecstart: timestamp of the beginning of loop recording
     #               (only used when composite is empty. otherwise, all loop timestamp data
     #               is stored relative to the compositepassstart timestamp)
-    # monitors: used for diagnostics & calculating avgsampleperiod
-    compositeindex = lastcompositeindex = compositepassstart = compositenorm = loopindex = looprecstart = monitors = passtime = 0
+    # monitors: used for diagnostics (specifically calculating monitoring frequency)
+    compositeindex = compositepassstart = compositenorm = loopindex = looprecstart = looptotal = monitors = 0
+
+    # running sum of the composite values, kept up to date by every write so the norm never needs a rescan
+    compositesum = CompositeNorm()
+
+    # every timestamp comes from the sample clock
+    # need deterministic timestamps for unit testing, so itertimestamp advances by one per sample
+    # files are processed unpaced, so their clock runs on the file's sample rate instead of the monotonic clock
+    if args['itertimestamp']:
+        clock = SampleClock(1, fixed=True, nominalperiod=DEFAULT_SAMPLE_PERIOD)
+    elif args['files']['audioin']:
+        clock = SampleClock(1 / audioin.rate, fixed=True)
+    else:
+        clock = SampleClock(DEFAULT_SAMPLE_PERIOD)
+    uptime = time.monotonic()
+
+    # the first loop is recorded into a preallocated buffer, which becomes the composite once the loop ends
+    recordingbuffer     = RecordingBuffer(LOOP_ARRAY_DTYPE)
+    compositedata       = recordingbuffer.plan(clock.audioperiod())
 
-    avgsampleperiod = (1 / 44100.0)
-    uptime = time.time()
+    logring.put(logging.INFO, "AudioProcessor - Reserved %d-sample recording buffer and %d x %d-sample loop arena", len(compositedata), looparena.numslots, looparena.slotcapacity)
 
-    compositedata       = extendarray(None)
-    loopdata            = extendarray(None)
+    # applied last, so that everything allocated during setup is frozen out of the garbage collector
+    if args['realtime']:
+        applied, skipped = applyrealtime(args)
+        logring.put(logging.INFO, "AudioProcessor - Real-time profile applied: %s" % (", ".join(applied) or "nothing"))
+        if skipped:
+            logring.put(logging.WARNING, "AudioProcessor - Real-time profile skipped: %s" % ", ".join(skipped))
+
+    # loops are recorded straight into a slot of the shared loop arena, handed out when recording starts
+    loopdata            = None
+
+    # time-bucket index over the composite timestamps, replaced along with the composite array
+    # it's laid out by whoever writes the composite, so it's never built here
+    compositelookup     = None
 
     emptycomposite = True
 
+    # input and output buffers reused by every block
+    blocksize   = max(1, int(args['blocksize']))
+    inputblock  = np.zeros(blocksize, dtype=int)
+    outputblock = np.zeros(blocksize, dtype=int)
+
     while status['running']:
 
         # IPC tasks
 
         # pull new composite
-        while not compositequeue.empty():
-            compositedata = compositequeue.get()
+        # swapping slots is zero-copy, and only the newest of several published composites is ever seen
+        swapped, newcomposite, newcompositesum, newcompositelookup = compositebuffer.swap()
+        if swapped:
+            compositedata = newcomposite
+            compositesum = newcompositesum
+            compositelookup = newcompositelookup
+            telemetry.swap(compositebuffer.swaplatency)
 
             # composite is returning to empty state
+            # the recording buffer is recycled, and any first loop left in it is dropped
             if compositedata is None:
-                compositedata = extendarray(None)
+                recordingbuffer.release()
+                compositedata = recordingbuffer.plan(clock.audioperiod())
                 emptycomposite = True
                 looprecstart = compositepass = 0
             else:
+                recordingbuffer.release()
                 emptycomposite = False
-            
+
             # recalculate compositenorm
-            compositenorm = np.mean(compositedata[:]['value'], dtype=int)
+            compositenorm = compositesum.value()
+
+        # a single shared memory read per block unless a command has arrived
+        while controlblock.pending():
+            statuschange = controlblock.get()
 
-        while not controlqueue.empty():
-            statuschange = controlqueue.get()
+            # written but not visible to this process yet, so it's taken up on the next block
+            if statuschange is None:
+                break
 
             # these need to be in the loop, so that each signal is responded even if there are multiple in the queue
             # otherwise, two "ToggleLoop" commands would cancel each other out
 
             if statuschange == Control.ToggleRecording:
-                # a new loop has been recorded, submit it to the output queue
+                # a new loop has been recorded, submit a handle to it to the output queue
+                # the samples themselves stay in the arena, where the Pedal process reads them in place
                 if status['recording']:
-                    logqueue.put(("INFO", "AudioProcessor - Ending loop..."))
+                    logring.put(logging.INFO, "AudioProcessor - Ending loop...")
 
-                    loopqueue.put(loopdata[:loopindex])
+                    loopqueue.put(looparena.handle(loopindex, looptotal))
             
                     if emptycomposite:
-                        compositedata = compositedata[:loopindex]
+                        compositedata = recordingbuffer.finalize(loopindex)
+                        compositelookup = recordingbuffer.lookup(loopindex)
                         emptycomposite = False
 
                     if args['virtualize']:
-                        logqueue.put(("INFO", "NEW COMPOSITE LENGTH: %d" % len(compositedata)))
+                        logring.put(logging.INFO, "NEW COMPOSITE LENGTH: %d", len(compositedata))
 
                     # recalculate compositenorm
-                    compositenorm = np.mean(compositedata[:]['value'], dtype=int)
+                    compositenorm = compositesum.value()
 
-                    loopindex = 0
-                    loopdata = np.zeros_like(compositedata)
+                    loopindex = looptotal = 0
 
                 else:
-                    logqueue.put(("INFO", "AudioProcessor - Starting loop..."))
+                    logring.put(logging.INFO, "AudioProcessor - Starting loop...")
                     # reset first loop record variable
                     looprecstart = 0
+                    loopdata = looparena.begin()
+
+                    # plan for a full-length first loop at the sample rate measured so far
+                    if emptycomposite:
+                        compositedata = recordingbuffer.plan(clock.audioperiod())
+                        compositesum = CompositeNorm()
 
             status[statuschange.value] = not status[statuschange.value]
+            controlblock.setflag(statuschange, status[statuschange.value])
 
             # avoid executing another I/O round if running status has been updated
             if not status['running']:
@@ -150,134 +550,148 @@ def run(controlqueue, compositequeue, loopqueue, logqueue, kwargs):
 
         if not status['running']:
             break
-            
-            # need deterministic timestamps for unit testing
-        if args['itertimestamp']:
-            passtime += 1
 
-        else:
-            # current timestamp
-            passtime = time.time()
+        if not status['monitoring']:
+            clock.idle()
+            monitors += 1
+            continue
+
+        try:
+            count = audioin.read_block(inputblock)
+        except queue.Empty:
+            logring.put(logging.INFO, "exhausted queue")
+            break
+        except EOFError:
+            logring.put(logging.INFO, "AudioProcessor - Reached end of input file")
+            break
+
+        # a command arrived while waiting for input
+        if not count:
+            continue
 
-        # used for diagnostics (specifically calculating sampling frequency)
-        monitors += 1
+        # processing time is measured from here, excluding the wait for input
+        blockstart = time.perf_counter_ns()
 
-        # update average cycle period every 100 cycles
-        if not monitors % 100:
-            avgsampleperiod = (passtime - uptime) / monitors
+        inputs = inputblock[:count]
+        outputs = outputblock[:count]
+
+        # timestamp of each sample in the block
+        passtimes = clock.tick(count)
 
         # determines whether some debug information is printed
-        debugpass = not (monitors - 1) % 1000000
+        debugpass = (monitors + count - 1) // DEBUG_INTERVAL * DEBUG_INTERVAL >= monitors
 
-        if status['monitoring']:
-   
-            try:
-                inputbits = audioin.read()
-                if debugpass:
-                    logqueue.put(("INFO", "read from queue"))
-            except queue.Empty:
-                if debugpass:
-                    logqueue.put(("INFO", "exhausted queue"))
-                break
+        monitors += count
 
-            outputbits = inputbits
+        if debugpass:
+            logring.put(logging.INFO, "read %d samples from queue", count)
+            logring.put(logging.INFO, "Sample clock: %f Hz, drift %f ms", clock.rate(), clock.drift * 1000)
 
-            # no composite loop data to play
-            if emptycomposite:
+        # no composite loop data to play
+        if emptycomposite:
 
-                # reset composite-related variables
-                if compositeindex or lastcompositeindex or compositepassstart:
-                    compositeindex = lastcompositeindex = compositepassstart = 0
+            # reset composite-related variables
+            if compositeindex or compositepassstart:
+                compositeindex = compositepassstart = 0
 
-                if status['recording']:
+            if status['recording']:
 
-                    # if looprecstart is zero, this is the first recording pass
-                    if not looprecstart:
-                        looprecstart = passtime
+                # if looprecstart is zero, this is the first recording pass
+                if not looprecstart:
+                    looprecstart = passtimes[0]
 
-                    looprectimestamp = passtime - looprecstart
+                looprectimestamps = passtimes - looprecstart
 
-                    # don't record past maximum loop length
-                    if looprectimestamp < MAX_LOOP_DURATION or args['itertimestamp']:
+                # don't record past maximum loop length, or past the end of the arena slot or recording buffer
+                reccount = count if args['itertimestamp'] else int(np.searchsorted(looprectimestamps, MAX_LOOP_DURATION, side="left"))
+                reccount = min(reccount, len(loopdata) - loopindex, len(compositedata) - loopindex)
 
-                        # loop length is unbounded. add 10 seconds to loop np array
-                        if loopindex >= len(loopdata):
-                            loopdata = extendarray(loopdata, avgsampleperiod)
+                # save input to both composite and loopdata array to upload to server
+                # store timestamp relative to composite playback head, and sort array by timestamps before submitting
+                for recarray in (loopdata, compositedata):
+                    recarray['value'][loopindex : loopindex + reccount] = inputs[:reccount]
+                    recarray['timestamp'][loopindex : loopindex + reccount] = looprectimestamps[:reccount]
+                recordingbuffer.record(loopindex, reccount)
+                loopindex += reccount
 
-                        # composite is also unbound on first loop
-                        if loopindex >= len(compositedata):
-                            compositedata = extendarray(compositedata)
+                if reccount < count:
+                    telemetry.dropped(count - reccount)
 
-                        # save input to both composite and loopdata array to upload to server
-                        # store timestamp relative to composite playback head, and sort array by timestamps before submitting
-                        loopdata[loopindex] = compositedata[loopindex] = (inputbits, looprectimestamp)
-                        loopindex += 1
+                recordedtotal = int(inputs[:reccount].sum())
+                looptotal += recordedtotal
+                compositesum.add(recordedtotal, reccount)
 
-            else:
+            outputs[:] = inputs
+
+        else:
+
+            # split the block into composite passes, since the pass start time changes each time the end of the composite is reached
+            passoffset = 0
+            while passoffset < count:
 
                 # compositepassstart of zero indicates this is the first pass where composite will be played 
                 # if playback & recording have reached the end of the composite, return to the start, and note the time new playback began
                 if not compositepassstart or compositeindex >= len(compositedata) - 1:
                     compositeindex = 0
-                    compositepassstart = passtime
+                    compositepassstart = passtimes[passoffset]
 
-                # playback timestamp relative to the start of the composite
-                inputtimestamp = passtime - compositepassstart
+                # playback timestamps relative to the start of the composite
+                inputtimestamps = passtimes[passoffset:] - compositepassstart
 
                 if debugpass:
-                    logqueue.put(("INFO", "Input timestamp: %f" % inputtimestamp))
-
-                # search in the composite for the closest timestamps higher and lower than the current timestamp (relative to composite start time)
-                # could use binary search, but in practice this should be within a small number of array indices away from the current composite index
-                # each time, as long as sampling rate stays constant. so, though the worst-case big-o of this is worse, it'll perform better on average
-
-                lastcompositeindex = compositeindex
+                    logring.put(logging.INFO, "Input timestamp: %f", inputtimestamps[0])
 
-                while compositeindex < len(compositedata) - 1 and inputtimestamp > compositedata[compositeindex + 1]['timestamp']:
-                    compositeindex += 1 
+                # constant-time lookup, however far the playhead has moved since the last block
+                indices = compositelookup.lookup(inputtimestamps, compositeindex)
 
-                # play & write to the closer of the two samples adjoining the current timestamp (or the index sample if the index is at the end of the array)
-                compositeindex = compositeindex if (compositeindex == len(compositedata) - 1 or inputtimestamp - compositedata[compositeindex]['timestamp'] <= compositedata[compositeindex + 1]['timestamp'] - inputtimestamp) else compositeindex + 1
-
-                compositebits = compositedata[compositeindex]['value']
-
-                # merge input and output bits by adding them and subtracting the mean of the composite array
-                outputbits = inputbits + compositebits - compositenorm
+                # the pass ends with the sample that plays the final composite index
+                passlength = min(int(np.searchsorted(indices, len(compositedata) - 1, side="left")) + 1, len(indices))
+                indices = indices[:passlength]
+                passinputs = inputs[passoffset : passoffset + passlength]
 
                 if status['recording']:
 
                     if debugpass:
-                        logqueue.put(("INFO", "Last composite index: %d" % lastcompositeindex))
-                        logqueue.put(("INFO", "Composite index: %d" % compositeindex))
+                        logring.put(logging.INFO, "Composite indices: %d - %d", indices[0], indices[-1])
 
                     # add merged input and composite
                     # write to all indices between the last written one and this one
                     # which will result in some pretty square sonic waves, but it's better than having composite array
                     # indices that aren't written to by subsequent loops
-                    if lastcompositeindex == compositeindex:
-                        compositedata[compositeindex]['value'] += inputbits - compositenorm
+                    compositebits = overdub(compositedata['value'], indices, compositeindex, passinputs - compositenorm, compositesum)
 
-                    elif lastcompositeindex < compositeindex:
-                        compositedata[lastcompositeindex + 1 : compositeindex + 1]['value'] += inputbits - compositenorm
+                    # save input to loopdata array to upload to server, up to the end of the arena slot
+                    # store timestamp relative to composite playback head, and sort array by timestamps before submitting
+                    reccount = min(passlength, len(loopdata) - loopindex)
+                    loopdata['value'][loopindex : loopindex + reccount] = passinputs[:reccount]
+                    loopdata['timestamp'][loopindex : loopindex + reccount] = inputtimestamps[:reccount]
+                    loopindex += reccount
+                    looptotal += int(passinputs[:reccount].sum())
 
-                    # if the composite index looped around since last pass
-                    # even if the compositedata array has changed size since the last pass, and lastcompositeindex is larger
-                    # than the end of the array, this won't throw an error, it'll just only write the [ : compositeindex + 1] piece
-                    else:
-                        compositedata[lastcompositeindex + 1 : ]['value'] += inputbits - compositenorm
-                        compositedata[ : compositeindex + 1]['value'] += inputbits - compositenorm
+                    if reccount < passlength:
+                        telemetry.dropped(passlength - reccount)
 
-                    # loop length is unbounded. add 10 seconds to loop np array
-                    if loopindex >= len(loopdata):
-                        loopdata = extendarray(loopdata, avgsampleperiod)
+                else:
+                    compositebits = compositedata['value'][indices]
 
-                    # save input to loopdata array to upload to server
-                    # store timestamp relative to composite playback head, and sort array by timestamps before submitting
-                    loopdata[loopindex] = (inputbits, inputtimestamp)
-                    loopindex += 1
+                # merge input and output bits by adding them and subtracting the mean of the composite array
+                outputs[passoffset : passoffset + passlength] = passinputs + compositebits - compositenorm
+
+                compositeindex = indices[-1]
+                passoffset += passlength
 
-            # write to AUX output
-            audioout.write(outputbits)
+        # write to AUX output
+        audioout.write_block(outputs)
+
+        telemetry.block(count, time.perf_counter_ns() - blockstart, count * clock.audioperiod() * 1e9)
+        telemetry.clock(clock.rate(), clock.drift)
 
     # Deinitialization actions
-    logqueue.put(("INFO", "Monitoring frequency: %f" % (monitors / (time.time() - uptime))))
+    if args['realtime'] and args['rtgc'] == "disable":
+        gc.enable()
+
+    if args['files']['audioin']:
+        audioout.close()
+
+    logring.put(logging.INFO, "Monitoring frequency: %f", monitors / (time.monotonic() - uptime))
+    logring.put(logging.INFO, "Sample clock: %f Hz, drift %f ms", clock.rate(), clock.drift * 1000)
@@ -0,0 +1,156 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------
+#   File-backed classes offering the same audio functionality as rpi.py, reading input samples from a WAV or .npy file and writing
+#   output samples to one, as fast as the audio processor can go. used for offline processing and throughput measurement
+# ---------------------------------------------------------------------------------------------------------------------------------------
+
+import struct
+import wave
+import numpy as np
+
+# sample rate assumed for .npy input, which doesn't record one
+DEFAULT_SAMPLE_RATE = 44100
+
+# the ADC and PWM work in 12-bit unsigned samples
+SAMPLE_BITS     = 12
+SAMPLE_MIDPOINT = 1 << (SAMPLE_BITS - 1)
+SAMPLE_MAX      = (1 << SAMPLE_BITS) - 1
+
+# numpy dtypes of integer PCM WAV samples, by sample width in bytes
+WAV_DTYPES = {
+    1 : np.dtype('u1'),
+    2 : np.dtype('<i2'),
+    4 : np.dtype('<i4')
+}
+
+# locate the sample data of an integer PCM WAV file
+# args:     path: WAV file path
+# return:   (data offset in bytes, number of frames, channels, sample width in bytes, sample rate)
+def wavlayout(path):
+    with open(path, "rb") as wavfile:
+        riff, _, wavetag = struct.unpack("<4sI4s", wavfile.read(12))
+        if riff != b"RIFF" or wavetag != b"WAVE":
+            raise ValueError("Not a WAV file: %s" % path)
+
+        fmt = None
+        while True:
+            header = wavfile.read(8)
+            if len(header) < 8:
+                raise ValueError("WAV file has no data chunk: %s" % path)
+            chunkid, chunksize = struct.unpack("<4sI", header)
+
+            if chunkid == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", wavfile.read(16))
+                wavfile.seek(chunksize - 16 + (chunksize & 1), 1)
+            elif chunkid == b"data":
+                if fmt is None:
+                    raise ValueError("WAV file has no format chunk: %s" % path)
+                formattag, channels, rate, _, _, bits = fmt
+                if formattag != 1 or bits // 8 not in WAV_DTYPES:
+                    raise ValueError("Only 8, 16 and 32-bit integer PCM WAV files are supported: %s" % path)
+                samplewidth = bits // 8
+                return (wavfile.tell(), chunksize // (channels * samplewidth), channels, samplewidth, rate)
+            else:
+                # chunks are padded to an even length
+                wavfile.seek(chunksize + (chunksize & 1), 1)
+
+class SPI:
+
+    # args:     path: .npy file of 12-bit samples (or a loop array, whose values are used), or integer PCM WAV file,
+    #                 of which only the first channel is used
+
+    def __init__(self, path):
+        self.type = "spi"
+        self.path = path
+
+        if path.endswith(".wav"):
+            offset, frames, channels, samplewidth, self.rate = wavlayout(path)
+            self.samples = np.memmap(path, dtype=WAV_DTYPES[samplewidth], mode="r", offset=offset, shape=(frames, channels))[:, 0]
+            # scale full-scale PCM to the ADC's range, centering signed samples on its midpoint
+            self.shift = samplewidth * 8 - SAMPLE_BITS
+            self.center = samplewidth > 1
+        else:
+            self.samples = np.load(path, mmap_mode="r")
+            if self.samples.dtype.names is not None:
+                self.samples = self.samples['value']
+            self.rate = DEFAULT_SAMPLE_RATE
+            self.shift = 0
+            self.center = False
+
+        self.position = 0
+
+    # number of samples in the file
+
+    def __len__(self):
+        return len(self.samples)
+
+    def read(self):
+        buf = np.zeros(1, dtype=int)
+        self.read_block(buf)
+        return int(buf[0])
+
+    def read_bytes(self, buflen):
+        buf = np.zeros(buflen, dtype=int)
+        return buf[:self.read_block(buf)].tolist()
+
+    # fill a caller-supplied numpy buffer with up to len(buf) samples
+    # return:   number of samples written to buf, less than len(buf) only at the end of the file
+    # raises:   EOFError once every sample has been read
+    def read_block(self, buf):
+        count = min(len(buf), len(self.samples) - self.position)
+        if count <= 0:
+            raise EOFError("End of audio input file %s" % self.path)
+
+        block = self.samples[self.position : self.position + count]
+        if self.shift > 0:
+            block = block.astype(int) >> self.shift
+        elif self.shift < 0:
+            block = block.astype(int) << -self.shift
+        if self.center:
+            block = block + SAMPLE_MIDPOINT
+        buf[:count] = block
+
+        self.position += count
+        return count
+
+class PWM:
+
+    # args:     path: .npy file to write raw output samples to, or WAV file to write them to clipped to 12 bits
+    #           length: number of samples that will be written, which sizes a .npy output file up front
+    #           rate: sample rate recorded in a WAV output file
+
+    def __init__(self, path, length, rate=DEFAULT_SAMPLE_RATE):
+        self.path = path
+        self.position = 0
+
+        if path.endswith(".wav"):
+            self.wavfile = wave.open(path, "wb")
+            self.wavfile.setnchannels(1)
+            self.wavfile.setsampwidth(2)
+            self.wavfile.setframerate(rate)
+            self.samples = None
+        else:
+            self.wavfile = None
+            self.samples = np.lib.format.open_memmap(path, mode="w+", dtype=np.int32, shape=(length,))
+
+    def write(self, val):
+        self.write_block(np.array([val]))
+
+    def write_bytes(self, buf):
+        self.write_block(np.array(buf))
+
+    def write_block(self, buf):
+        if self.wavfile is not None:
+            block = np.clip(buf, 0, SAMPLE_MAX)
+            self.wavfile.writeframes(((block - SAMPLE_MIDPOINT) << (16 - SAMPLE_BITS)).astype('<i2').tobytes())
+        else:
+            count = min(len(buf), len(self.samples) - self.position)
+            self.samples[self.position : self.position + count] = buf[:count]
+        self.position += len(buf)
+
+    # flush the output file
+
+    def close(self):
+        if self.wavfile is not None:
+            self.wavfile.close()
+        else:
+            self.samples.flush()
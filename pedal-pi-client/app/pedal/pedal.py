@@ -4,8 +4,9 @@
 
 import uuid
 import socket
+import os
+import collections
 import json
-import requests
 import time
 import atexit
 import threading
@@ -18,7 +19,7 @@ import logging
 
 from common import *
 
-from . import rpi, vrpi, audioprocessor
+from . import rpi, vrpi, audioprocessor, sharedbuffers, transport
 
 # -------------
 #   Constants
@@ -28,12 +29,35 @@ SERVER_URL = "http://192.168.1.72:5000/"
 
 END_LOOP_SLEEP = 0.0
 
+# seconds the end command waits for room in a full control block before the audio process is terminated instead
+AUDIO_END_TIMEOUT = 2
+
 # delays to pause between execution of Raspberry Pi and strangeloop server monitoring threads
+# the composite thread only pauses while it can't watch the server, e.g. when offline
 RPI_POLL_INTERVAL = 0.01
 COMPOSITE_POLL_INTERVAL = 2
 
-# numpy dtype to define loop & composite array entries
-LOOP_ARRAY_DTYPE = [('value', int), ('timestamp', float)]
+# time an input is left alone for after each change, while its contacts bounce
+DEBOUNCE_LOCKOUT = 0.05
+
+# how often the upload thread checks for queued loops, and how long it waits to try again after failing to reach the server
+UPLOAD_POLL_INTERVAL = 0.1
+UPLOAD_RETRY_INTERVAL = 5
+
+# number of finished uploads kept for the UI to show
+UPLOAD_HISTORY = 16
+
+# states of a queued upload
+UPLOAD_QUEUED       = "queued"
+UPLOAD_SERIALIZING  = "serializing"
+UPLOAD_UPLOADING    = "uploading"
+UPLOAD_DONE         = "done"
+UPLOAD_FAILED       = "failed"
+UPLOAD_CANCELLED    = "cancelled"
+
+# how often the process logging thread drains the audio processor's log ring, and how many records it takes at once
+LOG_DRAIN_INTERVAL = 0.05
+LOG_DRAIN_BATCH = 64
 
 # add 10 seconds worth of loop time to the array each time its length is met
 ARRAY_SIZE_SEC = 10
@@ -81,6 +105,10 @@ PEDAL_KW_DEFAULTS = {
 
     # use virtual rpi queues instead of true RPi components
     'virtualize'    : False,
+
+    # run the pedal threads on a step-driven vrpi.VirtualClock (self.clock) instead of the system clock, so a test
+    # harness decides when time passes. also passed on to the audio processor (virtualize only)
+    'virtualtime'   : False,
     'vqueues'       : {
                         'pushbutton1'   : None,
                         'pushbutton2'   : None,
@@ -89,6 +117,9 @@ PEDAL_KW_DEFAULTS = {
                         'led'           : None
                       },
 
+    # directory serialized loops are kept in until the server has them, so they survive a restart (None keeps them in memory)
+    'uploadspool'   : None,
+
     # subdict to pass to AudioProcessor process
     'apargs'        : {}
 }
@@ -97,6 +128,212 @@ PEDAL_KW_DEFAULTS = {
 #   Classes
 # -----------
 
+# -------------------------------------------------------------------------------------------------------------
+#   Debouncer - non-blocking debounce state machine for one GPIO input, polled by the RPi monitoring thread
+#               a change is reported as soon as its edge is seen, and the input is then left alone for the
+#               lockout while its contacts bounce, instead of the whole thread sleeping through it
+# -------------------------------------------------------------------------------------------------------------
+
+class Debouncer():
+
+    # args:     gpio: rpi.GPIO or vrpi.GPIO input
+    #           lockout: seconds to leave the input alone for after each change
+
+    def __init__(self, gpio, lockout=DEBOUNCE_LOCKOUT):
+        self.gpio = gpio
+        self.lockout = lockout
+
+        self.gpio.detect()
+        self.level = self.gpio.read()
+
+        # time the current lockout ends, or None outside of one
+        self.until = None
+
+    # check the input for a change, only reading its level once an edge has been latched
+    # args:     now: current time in seconds
+    # return:   new level if the input changed, None otherwise
+
+    def poll(self, now):
+        if self.until is not None:
+            if now < self.until:
+                return None
+
+            # bounces latched during the lockout are cleared, and the level read again in case it settled elsewhere
+            self.until = None
+            self.gpio.event()
+
+        elif not self.gpio.event():
+            return None
+
+        level = self.gpio.read()
+        if level == self.level:
+            return None
+
+        self.level = level
+        self.until = now + self.lockout
+        return level
+
+# -------------------------------------------------------------------------------------------------------------
+#   UploadJob - one loop waiting to be uploaded, with the progress the UI shows for it
+# -------------------------------------------------------------------------------------------------------------
+
+class UploadJob():
+
+    # args:     loopindex: index of the loop in the offline loops dict
+    #           loopsum: CompositeNorm of the loop, scanned for if not given
+    #           payload: serialized loop, if it already is
+
+    def __init__(self, loopindex, loopsum=None, payload=None):
+        self.loopindex = loopindex
+        self.loopsum = loopsum
+        self.payload = payload
+        self.state = UPLOAD_QUEUED
+        self.attempts = 0
+        self.queued = time.time()
+        self.finished = None
+
+    # return:   dict of the job's progress
+
+    def status(self):
+        return {'index' : self.loopindex, 'state' : self.state, 'attempts' : self.attempts, 'bytes' : len(self.payload) if self.payload is not None else None,
+                'queued' : self.queued, 'finished' : self.finished}
+
+# -------------------------------------------------------------------------------------------------------------
+#   UploadQueue - loops waiting to be uploaded to the strangeloop server by the upload thread, oldest first
+#                 a loop stays queued until the server has it or turns it down, so loops recorded offline or while
+#                 the server can't be reached go up once the pedal is back online. given a spool directory, each
+#                 serialized loop is also kept on disk until then, so that it survives a restart
+# -------------------------------------------------------------------------------------------------------------
+
+class UploadQueue():
+
+    # args:     spool: directory to keep serialized loops in, or None to keep them in memory only
+
+    def __init__(self, spool=None):
+        self.spool = spool
+        if self.spool:
+            os.makedirs(self.spool, exist_ok=True)
+
+        self.condition = threading.Condition()
+
+        # queued jobs by loop index, oldest first, and the index of the one being uploaded, or None
+        self.jobs = collections.OrderedDict()
+        self.inflight = None
+
+        # most recently finished jobs, oldest first
+        self.finished = collections.deque(maxlen=UPLOAD_HISTORY)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.jobs)
+
+    # queue a loop for upload, unless it already is
+    # a loop that comes serialized is spooled straight away. the rest are serialized & spooled by prepare's caller
+    # args:     see UploadJob
+    # return:   whether the loop was queued
+
+    def put(self, loopindex, loopsum=None, payload=None):
+        with self.condition:
+            if loopindex in self.jobs:
+                return False
+            job = self.jobs[loopindex] = UploadJob(loopindex, loopsum, payload)
+            if self.spool and not os.path.exists(self.spoolpath(loopindex)):
+                self.save(job)
+            return True
+
+    # take the oldest queued job that hasn't been serialized yet, to be serialized, saved and handed back to finish
+    # return:   UploadJob, or None if every queued loop is serialized
+
+    def prepare(self):
+        with self.condition:
+            job = next((job for job in self.jobs.values() if job.payload is None), None)
+            if job is not None:
+                self.inflight = job.loopindex
+            return job
+
+    # take the oldest queued job that's ready to upload, to be handed back to finish
+    # return:   UploadJob, or None if nothing serialized is queued
+
+    def take(self):
+        with self.condition:
+            job = next((job for job in self.jobs.values() if job.payload is not None), None)
+            if job is None:
+                return None
+            self.inflight = job.loopindex
+            job.attempts += 1
+            return job
+
+    # hand back a job taken from the queue
+    # args:     job: UploadJob returned by take
+    #           state: UPLOAD_QUEUED to try again later, or the state it finished in
+
+    def finish(self, job, state):
+        with self.condition:
+            self.inflight = None
+            job.state = state
+            if state != UPLOAD_QUEUED:
+                job.finished = time.time()
+                self.jobs.pop(job.loopindex, None)
+                self.finished.append(job.status())
+                job.payload = None
+                self.unspool(job.loopindex)
+            self.condition.notify_all()
+
+    # drop a loop from the queue, first waiting for it to finish if it's being uploaded right now
+    # args:     loopindex: index of the loop
+    # return:   whether the loop was still queued
+
+    def cancel(self, loopindex):
+        with self.condition:
+            self.condition.wait_for(lambda: self.inflight != loopindex)
+            job = self.jobs.pop(loopindex, None)
+            if job is None:
+                return False
+            job.state = UPLOAD_CANCELLED
+            job.finished = time.time()
+            self.finished.append(job.status())
+            self.unspool(loopindex)
+            return True
+
+    # write a job's serialized loop to the spool directory, whole or not at all
+
+    def save(self, job):
+        if self.spool and job.payload is not None:
+            path = self.spoolpath(job.loopindex)
+            with open(path + ".tmp", "wb") as spoolfile:
+                spoolfile.write(job.payload)
+            os.replace(path + ".tmp", path)
+
+    # serialized loops left in the spool directory, e.g. by a previous run
+    # return:   list of (loop index, payload bytes), oldest first
+
+    def load(self):
+        if not self.spool:
+            return []
+
+        spooled = []
+        for filename in os.listdir(self.spool):
+            name, extension = os.path.splitext(filename)
+            if extension == ".sloop" and name.isdigit():
+                path = os.path.join(self.spool, filename)
+                with open(path, "rb") as spoolfile:
+                    spooled.append((os.path.getmtime(path), int(name), spoolfile.read()))
+        return [(loopindex, payload) for _, loopindex, payload in sorted(spooled)]
+
+    def spoolpath(self, loopindex):
+        return os.path.join(self.spool, "%d.sloop" % loopindex)
+
+    def unspool(self, loopindex):
+        if self.spool and os.path.exists(self.spoolpath(loopindex)):
+            os.remove(self.spoolpath(loopindex))
+
+    # progress of every queued job and the most recently finished ones
+    # return:   dict with the number of loops 'queued', and 'jobs', a list of UploadJob.status() dicts, oldest first
+
+    def status(self):
+        with self.condition:
+            return {'queued' : len(self.jobs), 'jobs' : list(self.finished) + [job.status() for job in self.jobs.values()]}
+
 # ------------------------------------------------------------------------------
 #   Pedal - class handling all the basic functionality of a looper pedal
 #           the Flask UI receives and interacts with an instance of this class
@@ -105,16 +342,19 @@ PEDAL_KW_DEFAULTS = {
 class Pedal():
     
     # ----------------------------------------------------------------
-    #   ProcessLoggingThread - Thread superclass that reads input
-    #                          from process queue and logs it to the
-    #                          pedal logger in a safe way
+    #   ProcessLoggingThread - Thread superclass that drains the
+    #                          process log ring in batches and logs
+    #                          it to the pedal logger in a safe way
     # ----------------------------------------------------------------
 
     class ProcessLoggingThread(threading.Thread):
-        def __init__(self, pedal, logqueue):
+        def __init__(self, pedal, logring):
             threading.Thread.__init__(self)
             self.pedal = pedal
-            self.logqueue = logqueue
+            self.logring = logring
+
+            # dropped record count already reported
+            self.dropped = 0
 
             self.pedal.slplogger.debug("Initialized process logging thread")
 
@@ -122,17 +362,37 @@ class Pedal():
         
             self.pedal.slplogger.debug("Started process logging thread")
 
-            while self.pedal.running or not self.logqueue.empty():
+            # keep going until the audio processor has exited, so its shutdown logs aren't lost
+            while self.pedal.running or self.pedal.audioprocess.is_alive():
+                if not self.drain():
+                    time.sleep(LOG_DRAIN_INTERVAL)
 
-                # block until messagae is avaliable
-                level, message = self.logqueue.get()
-                self.pedal.slplogger.log(getattr(logging, level), message)
+            while self.drain():
+                pass
+
+            self.pedal.slplogger.debug("Stopped process logging thread")
+
+        # log one batch of records
+        # return:   number of records logged
+
+        def drain(self):
+            batch = self.logring.drain(LOG_DRAIN_BATCH)
+            for level, message in batch:
+                self.pedal.slplogger.log(level, message)
+
+            dropped = self.logring.dropped()
+            if dropped != self.dropped:
+                self.pedal.slplogger.warning("Process log ring full, dropped %d records" % (dropped - self.dropped))
+                self.dropped = dropped
+
+            return len(batch)
 
 
     # ----------------------------------------------------------------
-    #   CompositePollingThread - Thread superclass that periodically 
-    #                            polls strangeloop server for new 
-    #                            additions to the composite loop
+    #   CompositePollingThread - Thread superclass that waits on the
+    #                            strangeloop server's /watch endpoint
+    #                            and downloads the composite loop
+    #                            only when it has changed
     # ----------------------------------------------------------------
 
     class CompositePollingThread(threading.Thread):
@@ -144,7 +404,6 @@ class Pedal():
             threading.Thread.__init__(self)
             self.stop = threading.Event()
             self.pedal = pedal
-            self.timestamp = None
 
             self.pedal.slplogger.debug("Initialized composite polling thread")
 
@@ -155,17 +414,104 @@ class Pedal():
             self.pedal.slplogger.debug("Started composite polling thread")
 
             while self.pedal.running: 
-                time.sleep(COMPOSITE_POLL_INTERVAL)
+                if self.stop.is_set():
+                    self.pedal.sleep(COMPOSITE_POLL_INTERVAL)
+                    continue
+
+                # held open by the server until the composite differs from the version being played
+                version = self.pedal.watchcomposite(self.pedal.compositeversion)
+
+                if version == NONE_RETURN:
+                    continue
+
+                # offline or unsessioned
+                if not isinstance(version, int):
+                    self.pedal.sleep(COMPOSITE_POLL_INTERVAL)
+                    continue
+
+                # the composite isn't replaced while a loop is recording or a single loop is playing back
+                while self.pedal.running and (self.pedal.recording or self.pedal.playing):
+                    self.pedal.sleep(COMPOSITE_POLL_INTERVAL)
 
-                # timestamp to determine whether any new data needs to be downloaded
-                if not self.stop.is_set() and not self.pedal.recording and not self.pedal.playing and self.pedal.getcomposite(timestamp=self.timestamp) == SUCCESS_RETURN:
-                    self.timestamp = dt.utcnow().timestamp()
+                if self.pedal.running and not self.stop.is_set() and self.pedal.getcomposite(version=self.pedal.compositeversion) == SUCCESS_RETURN:
+                    self.pedal.slplogger.debug("Downloaded composite version %s" % self.pedal.compositeversion)
 
-                    self.pedal.slplogger.debug("Downloaded new composite at %s" % dt.utcfromtimestamp(self.timestamp).strftime("%Y-%m-%d-%H:%M:%S"))
+            self.pedal.endthread()
 
             self.pedal.slplogger.debug("Ended composite polling thread")
 
 
+    # ----------------------------------------------------------------
+    #   UploadThread - Thread superclass that serializes queued loops
+    #                  and uploads them to the strangeloop server,
+    #                  so recording never waits on the network
+    # ----------------------------------------------------------------
+
+    class UploadThread(threading.Thread):
+
+        # overloaded Thread constructor
+        # args:     pedal: parent Pedal object that instantiated this thread
+
+        def __init__(self, pedal):
+            threading.Thread.__init__(self)
+            self.pedal = pedal
+
+            self.pedal.slplogger.debug("Initialized upload thread")
+
+        # main thread execution loop
+
+        def run(self):
+
+            self.pedal.slplogger.debug("Started upload thread")
+
+            while self.pedal.running:
+                # every queued loop is serialized and spooled straight away, whatever the session state, so loops
+                # recorded offline survive a restart too
+                job = self.pedal.uploads.prepare()
+                if job is not None:
+                    self.serialize(job)
+                    continue
+
+                # loops stay queued while the pedal is out of a session
+                job = self.pedal.uploads.take() if self.pedal.sessionid else None
+                if job is None:
+                    self.pedal.sleep(UPLOAD_POLL_INTERVAL)
+                    continue
+
+                job.state = UPLOAD_UPLOADING
+                serverresponse = self.pedal.uploadloop(job.loopindex, payload=job.payload)
+
+                # kept for later if the server couldn't be reached, or the pedal left its session in the meantime
+                if serverresponse == OFFLINE_RETURN or not self.pedal.sessionid:
+                    self.pedal.uploads.finish(job, UPLOAD_QUEUED)
+                    self.pedal.sleep(UPLOAD_RETRY_INTERVAL)
+                else:
+                    self.pedal.uploads.finish(job, UPLOAD_DONE if serverresponse == SUCCESS_RETURN else UPLOAD_FAILED)
+
+            self.pedal.endthread()
+
+            self.pedal.slplogger.debug("Ended upload thread")
+
+        # sort a retained loop by timestamp and serialize it, in the encoding the server stores loops in
+        # the sorted copy replaces the retained loop as a whole, so nothing reading the loops dict sees it half sorted
+        # args:     job: UploadJob returned by UploadQueue.prepare
+
+        def serialize(self, job):
+            loopdata = self.pedal.loops.get(job.loopindex)
+            if loopdata is None:
+                self.pedal.uploads.finish(job, UPLOAD_CANCELLED)
+                return
+
+            job.state = UPLOAD_SERIALIZING
+
+            loopdata = sortloop(loopdata)
+            self.pedal.loops[job.loopindex] = loopdata
+
+            job.payload = encodeloop(loopdata, job.loopsum)
+            self.pedal.uploads.save(job)
+            self.pedal.uploads.finish(job, UPLOAD_QUEUED)
+
+
     # ---------------------------------------------------------------------
     #   RPiMonitoringThread - Thread superclass to monitor RPi components 
     #                       and change pedal state accordingly
@@ -189,56 +535,57 @@ class Pedal():
             self.pedal.slplogger.debug("Started RPi Polling Thread")
 
             looprecstart = 0
+
+            # button reads are unreliable for a little while after a press, so each input is debounced on its own
+            # pushbuttons act on the edge of a press, switches on their debounced level
+            pushbutton1     = Debouncer(self.pedal.pushbutton1)
+            pushbutton2     = Debouncer(self.pedal.pushbutton2)
+            toggleswitch    = Debouncer(self.pedal.toggleswitch)
+            footswitch      = Debouncer(self.pedal.footswitch)
             
             while self.pedal.running:
-                time.sleep(self.pedal.rpisleep)
+                self.pedal.sleep(self.pedal.rpisleep)
 
-                # button reads are unreliable for a little while after a press
-                debounce_delay = False
+                now = self.pedal.now()
 
-                pushbutton1_val     = self.pedal.pushbutton1.read()
-                pushbutton2_val     = self.pedal.pushbutton2.read()
-                toggleswitch_val    = self.pedal.toggleswitch.read()
-                footswitch_val      = self.pedal.footswitch.read()
+                pushbutton1_val     = pushbutton1.poll(now)
+                pushbutton2_val     = pushbutton2.poll(now)
+                toggleswitch.poll(now)
+                footswitch.poll(now)
+                footswitch_val      = footswitch.level
 
                 # pedal functions are only available when pedal is in monitor mode
                 if footswitch_val == FOOTSWITCH_MON and not self.pedal.monitoring:
                     self.pedal.slplogger.info("Footswitch set to monitor mode")
-                    self.pedal.audiocontrolqueue.put(audioprocessor.Control.ToggleMonitoring)
+                    self.pedal.controlaudio(audioprocessor.Control.ToggleMonitoring)
                     self.pedal.monitoring = True
-                    debounce_delay = True
 
                 # in bypass mode, the pedal can neither read from input nor write to output
                 elif footswitch_val == FOOTSWITCH_BYPASS and self.pedal.monitoring:
                     self.pedal.slplogger.info("Footswitch set to bypass mode")
-                    self.pedal.audiocontrolqueue.put(audioprocessor.Control.ToggleMonitoring)
+                    self.pedal.controlaudio(audioprocessor.Control.ToggleMonitoring)
                     self.pedal.monitoring = False
                     if self.pedal.recording:
                         self.pedal.endloop()
-                    debounce_delay = True
 
                 # you can only remove a loop if you aren't currently recording one
                 if pushbutton1_val == PUSHBUTTON_PRESS and not self.pedal.recording:
                     self.pedal.slplogger.info("Loop removed")
                     self.pedal.removeloop()
-                    debounce_delay = True
 
                 # start loop
                 if pushbutton2_val == PUSHBUTTON_PRESS and footswitch_val == FOOTSWITCH_MON and not self.pedal.recording and not self.pedal.playing:
                     self.pedal.slplogger.info("Loop started")
                     # store timestamp when loop started so that recording can time out after 2 minutes
-                    looprecstart = dt.utcnow().timestamp()
+                    looprecstart = now
                     self.pedal.startloop()
-                    debounce_delay = True
 
                 # end loop on loop button press or recording timeout
-                elif (pushbutton2_val == PUSHBUTTON_PRESS and footswitch_val == FOOTSWITCH_MON and self.pedal.recording) or (self.pedal.recording and dt.utcnow().timestamp() - looprecstart > MAX_LOOP_DURATION):
+                elif (pushbutton2_val == PUSHBUTTON_PRESS and footswitch_val == FOOTSWITCH_MON and self.pedal.recording) or (self.pedal.recording and now - looprecstart > MAX_LOOP_DURATION):
                     self.pedal.slplogger.info("Loop ended")
                     self.pedal.endloop()
-                    debounce_delay = True
 
-                if debounce_delay:
-                    rpi.debounce_delay()
+            self.pedal.endthread()
 
             self.pedal.slplogger.debug("Ended RPi Polling Thread")
 
@@ -258,6 +605,12 @@ class Pedal():
 
         self.slplogger.info("Initializing Pedal object")
 
+        # virtual time base, with the audio processor's input giving way to commands so each step settles
+        self.clock = None
+        if self.virtualtime:
+            self.clock = vrpi.VirtualClock()
+            self.apargs = dict(self.apargs, virtualtime=True)
+
         if self.virtualize:
 
             self.pushbutton1    = vrpi.GPIO(self.vqueues['pushbutton1'], vrpi.GPIO.FSEL.INPUT, PUSHBUTTON_RELEASE)
@@ -280,6 +633,9 @@ class Pedal():
         uuidnode = uuid.getnode()
         self.mac = ':'.join(("%012X" % uuidnode)[i:i+2] for i in range(0, 12, 2))
 
+        # every server call goes through one pooled transport, so connections are kept open between calls
+        self.transport = transport.ServerTransport(SERVER_URL)
+
         # recieve device domain name on local network for AJAX callbacks in flask
         # recieve IP for flask CORS config
         self.domainname = socket.getfqdn()
@@ -296,19 +652,29 @@ class Pedal():
         self.avgsampleperiod = 1 / 41000
 
         # initialice IPC threads for audioprocessor
-        self.audiocontrolqueue      = multiprocessing.Queue()
-        self.audiocompositequeue    = multiprocessing.Queue()
+        self.audiocontrol           = sharedbuffers.ControlBlock(audioprocessor.Control)
+        self.audiocomposite         = sharedbuffers.CompositeBuffer(LOOP_ARRAY_DTYPE)
+        self.audioloops             = sharedbuffers.LoopArena(LOOP_ARRAY_DTYPE)
+        self.audiotelemetry         = sharedbuffers.Telemetry()
         self.audioloopqueue         = multiprocessing.Queue()
-        self.audiologqueue          = multiprocessing.Queue()
+        self.audiologring           = sharedbuffers.LogRing()
+
+        # a virtual time step isn't over until the audio processor has taken up every command sent during it
+        if self.clock:
+            self.clock.watch(lambda: not self.audiocontrol.backlog())
 
         # initialize process threads
-        self.processlogthread       = Pedal.ProcessLoggingThread(pedal=self, logqueue=self.audiologqueue)
+        self.processlogthread       = Pedal.ProcessLoggingThread(pedal=self, logring=self.audiologring)
         self.compositepollthread    = Pedal.CompositePollingThread(pedal=self)
         self.monitorrpithread       = Pedal.RPiMonitoringThread(pedal=self)
-        self.audioprocess           = multiprocessing.Process(target=audioprocessor.run, args=(self.audiocontrolqueue, self.audiocompositequeue, self.audioloopqueue, self.audiologqueue, self.apargs))
+        self.uploadthread           = Pedal.UploadThread(pedal=self)
+        self.audioprocess           = multiprocessing.Process(target=audioprocessor.run, args=(self.audiocontrol, self.audiocomposite, self.audioloops, self.audiotelemetry, self.audioloopqueue, self.audiologring, self.apargs))
 
         # process thread flags
         self.running = True
+
+        # set once the pedal is ending, cutting short the pedal threads' sleeps
+        self.ending = threading.Event()
         self.monitoring = False
         self.recording = False
     
@@ -319,6 +685,22 @@ class Pedal():
         # store a local dict of all loops made on this pedal, so that they can be uploaded individually
         self.loops = {}
 
+        # loops waiting for the upload thread, including any spooled by a previous run, which are played again
+        self.uploads = UploadQueue(self.uploadspool)
+        for loopindex, payload in self.uploads.load():
+            try:
+                self.loops[loopindex] = loadloop(payload)[0]
+                self.uploads.put(loopindex, payload=payload)
+            except ValueError:
+                self.slplogger.error("Dropped unreadable spooled loop %d" % loopindex)
+                self.uploads.unspool(loopindex)
+        if self.loops:
+            self.slplogger.info("Restored %d spooled loops" % len(self.loops))
+            self.genofflinecomposite()
+
+        # server version of the composite being played, or None if it didn't come from the server as is
+        self.compositeversion = None
+
         # do not start composite polling thread until pedal goes online
         self.compositepollstarted = False
 
@@ -332,7 +714,8 @@ class Pedal():
 
         # start process threads
         self.processlogthread.start()
-        self.monitorrpithread.start()
+        self.startthread(self.monitorrpithread)
+        self.startthread(self.uploadthread)
 
         # child process will inherit "ignore SIGINT", so that it can be exited gracefully from parent process
         # from: https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python
@@ -344,8 +727,8 @@ class Pedal():
         # restore previous SIGINT handler
         signal.signal(signal.SIGINT, originalsiginthandler)        
 
-        # check initial session membership
-        sessionresp = self.getsession(timeout=1)
+        # check initial session membership, without holding up startup to retry
+        sessionresp = self.getsession(timeout=1, retries=0)
 
         if self.createsession:
             self.slplogger.info("Creating new session: %s" % self.newsession("rick"))
@@ -358,16 +741,53 @@ class Pedal():
         self.slplogger.info("Deinitializing Pedal object")
 
         self.running = False
+        self.ending.set()
+
+        # release threads sleeping on virtual time, so they see the running flag
+        if self.clock:
+            self.clock.close()
 
         # call process audio destructor
+        # an audio process that died, or stopped taking up commands, is stopped the hard way instead
         if self.audioprocess:
-            self.audiocontrolqueue.put(audioprocessor.Control.EndProcess)
+            if not self.controlaudio(audioprocessor.Control.EndProcess, timeout=AUDIO_END_TIMEOUT):
+                self.audioprocess.terminate()
             self.audioprocess.join()
 
+        # the pedal threads can be holding views into the shared memory blocks, or patching the composite, until they exit
+        # a thread that's mid-request finishes it first, which the transport's timeouts keep bounded
+        for thread in (self.monitorrpithread, self.uploadthread, self.compositepollthread):
+            if thread.is_alive():
+                thread.join()
+
+        if self.processlogthread.is_alive():
+            self.processlogthread.join()
+
+        self.audiocontrol.close()
+        self.audiocomposite.close()
+        self.audioloops.close()
+        self.audiotelemetry.close()
+        self.audiologring.close()
+
+        self.transport.close()
+
         self.led.turn_off()
 
         self.slplogger.info("Deinitialized Pedal object")
 
+    # send a command to the audio process, waiting for room in the control block only while the process is running
+    # args:     command: audioprocessor.Control command
+    #           timeout: seconds to wait for room at most, or None to wait as long as the audio process is alive
+    # return:   whether the command was sent
+
+    def controlaudio(self, command, timeout=None):
+        try:
+            self.audiocontrol.put(command, timeout=timeout, alive=lambda: self.audioprocess.exitcode is None)
+            return True
+        except (TimeoutError, BrokenPipeError) as e:
+            self.slplogger.error("Unable to send %s to the audio process: %s" % (command.name, e))
+            return False
+
     # --------------------------------
     #   Session Manipulation Methods
     # --------------------------------
@@ -381,7 +801,7 @@ class Pedal():
         try:
             self.slplogger.info("Creating new session")
 
-            serverresponse = requests.post(SERVER_URL + "newsession", data={'mac' : self.mac, 'nickname' : nickname}).text
+            serverresponse = self.transport.post("newsession", data={'mac' : self.mac, 'nickname' : nickname}).text
             
             self.slplogger.info("New session creation returned %s" % serverresponse)
 
@@ -389,7 +809,7 @@ class Pedal():
 
             return serverresponse
         
-        except requests.exceptions.ConnectionError:
+        except transport.OFFLINE_ERRORS:
 
             self.slplogger.info("New session creation failed. Unable to connect to server")  
             return OFFLINE_RETURN
@@ -402,7 +822,7 @@ class Pedal():
         try: 
             self.slplogger.info("Ending session %s" % self.sessionid if self.sessionid else "None")
 
-            serverresponse = requests.post(SERVER_URL + "endsession", data={'mac' : self.mac}).text
+            serverresponse = self.transport.post("endsession", data={'mac' : self.mac}).text
 
             self.slplogger.info("Session end returned %s" % serverresponse)
 
@@ -410,7 +830,7 @@ class Pedal():
 
             return serverresponse
 
-        except requests.exceptions.ConnectionError:
+        except transport.OFFLINE_ERRORS:
 
             self.slplogger.info("Session end failed. Unable to connect to server")  
             return OFFLINE_RETURN
@@ -425,14 +845,14 @@ class Pedal():
         try:
             self.slplogger.info("Joining session %s" % sessionid)
 
-            serverresponse = requests.post(SERVER_URL + "joinsession", data={'mac' : self.mac, 'nickname' : nickname, 'sessionid' : sessionid}).text
+            serverresponse = self.transport.post("joinsession", data={'mac' : self.mac, 'nickname' : nickname, 'sessionid' : sessionid}).text
 
             self.slplogger.info("Session join returned %s" % serverresponse)
 
             self.getsession()
 
             return serverresponse
-        except requests.exceptions.ConnectionError:
+        except transport.OFFLINE_ERRORS:
 
             self.slplogger.info("Session join failed. Unable to connect to server")  
             return OFFLINE_RETURN
@@ -445,14 +865,14 @@ class Pedal():
         try:
             self.slplogger.info("Leaving session %s" % self.sessionid if self.sessionid else "None")
 
-            serverresponse = requests.post(SERVER_URL + "leavesession", data={'mac' : self.mac}).text
+            serverresponse = self.transport.post("leavesession", data={'mac' : self.mac}).text
 
             self.slplogger.info("Session leave returned %s" % serverresponse)
 
             self.getsession()
         
             return serverresponse
-        except requests.exceptions.ConnectionError:
+        except transport.OFFLINE_ERRORS:
 
             self.slplogger.info("Leave session failed. Unable to connect to server")  
             return OFFLINE_RETURN
@@ -462,14 +882,14 @@ class Pedal():
     # ---------------------------------
 
     # update pedal object sessionid & owner variables (without actually returning them)
-    # args:     **kwargs to pass to request GET call
+    # args:     **kwargs to pass to ServerTransport.post, e.g. timeout or retries
     # return:   server response or OFFLINE_RETURN on failure to connect
 
     def getsession(self, **kwargs):
         try:
             self.slplogger.info("Refreshing session")
 
-            serverresponse = requests.post(SERVER_URL + "getsession", data={'mac' : self.mac}, **kwargs).text
+            serverresponse = self.transport.post("getsession", data={'mac' : self.mac}, **kwargs).text
 
             self.slplogger.info("Session refresh returned %s" % serverresponse)
 
@@ -488,7 +908,7 @@ class Pedal():
 
                 return SUCCESS_RETURN
             return serverresponse 
-        except requests.exceptions.ConnectionError:
+        except transport.OFFLINE_ERRORS:
 
             self.slplogger.info("Session refresh failed. Unable to connect to server")  
             return OFFLINE_RETURN
@@ -500,7 +920,7 @@ class Pedal():
         try:
             self.slplogger.info("Refreshing member list")
 
-            serverresponse = requests.post(SERVER_URL + "getmembers", data={'mac' : self.mac}).text
+            serverresponse = self.transport.post("getmembers", data={'mac' : self.mac}).text
 
             self.slplogger.info("Member list refresh returned %s" % serverresponse)
 
@@ -510,83 +930,125 @@ class Pedal():
                 self.sessionmembers = serverresponse.split(",")
                 return SUCCESS_RETURN
             return serverresponse
-        except requests.exceptions.ConnectionError:
+        except transport.OFFLINE_ERRORS:
 
             self.slplogger.info("Member list refresh failed. Unable to connect to server")  
             return OFFLINE_RETURN
 
     # reconcile online loop collection with offline activity
+    # loops are told apart by their content hashes, so only the loops this pedal is missing are downloaded, all at once,
+    # and local loops the session is missing or holds a different version of are queued for the upload thread
     # return:   SUCCESS_RETURN on successful reconciliation, FAILURE_RETURN on >=1 failure or OFFLINE_RETURN on failure to connect
 
     def updateloops(self):
         try:
             self.slplogger.info("Reconciling online loops with offline loops")
 
-            serverresponse = requests.post(SERVER_URL + "getloopids", data={'mac' : self.mac}).text
+            serverresponse = self.transport.post("getloophashes", data={'mac' : self.mac}).text
 
-            self.slplogger.info("Loop id list refresh returned %s" % serverresponse)
+            self.slplogger.info("Loop hash list refresh returned %s" % serverresponse[:100])
 
-            if len(serverresponse) and serverresponse not in [NONE_RETURN, FAILURE_RETURN]:
+            if serverresponse not in [NONE_RETURN, FAILURE_RETURN]:
                 try:
-                    onlineloopindices = [int(loopid) for loopid in serverresponse.split(",")]
+                    onlineloops = {}
+                    for entry in [entry for entry in serverresponse.split(",") if entry]:
+                        loopindex, onlinehash, length = entry.split(":")
+                        onlineloops[int(loopindex)] = (onlinehash, int(length))
+                except ValueError:
+                    self.slplogger.error("Invalid loop hash data from server")
+                    return FAILURE_RETURN
 
-                    updateresponse = SUCCESS_RETURN
+                updateresponse = SUCCESS_RETURN
+
+                # download all loops not present in offline dict
+                missingindices = [loopindex for loopindex in onlineloops if loopindex not in self.loops]
+                if missingindices:
+                    onlineloopdata, onlineloopstatus = self.getloops(missingindices)
+                    if onlineloopstatus == OFFLINE_RETURN:
+                        return OFFLINE_RETURN
+                    if onlineloopstatus != SUCCESS_RETURN:
+                        updateresponse = FAILURE_RETURN
+                    self.loops.update(onlineloopdata)
+
+                # delete all loops different from offline dict, and queue local loops in those indices for upload
+                # lengths are compared first, which saves hashing most loops that differ
+                for loopindex, (onlinehash, length) in onlineloops.items():
+                    if loopindex not in missingindices and (len(self.loops[loopindex]) != length or loophash(self.loops[loopindex]) != onlinehash):
+                        if self.removeloop(loopindex, onlineonly=True) != SUCCESS_RETURN:
+                            updateresponse = FAILURE_RETURN
+                        else:
+                            self.uploads.put(loopindex)
 
-                    for onlineloopindex in onlineloopindices:
-                        onlineloop, onlineloopstatus = self.getloop(onlineloopindex)
-                        if onlineloopstatus == SUCCESS_RETURN:
+                # queue all loops not present in online session for upload, e.g. those recorded offline
+                for offlineloopindex in [index for index in self.loops.keys() if index not in onlineloops]:
+                    self.uploads.put(offlineloopindex)
 
-                            # download all loops not present in offline dict
-                            if onlineloopindex not in self.loops:
-                                self.loops[onlineloopindex] = onlineloop
+                return updateresponse
 
-                            # delete all loops different from offline dict, and upload local loops in those indices
-                            elif not np.array_equal(onlineloop, self.loops[onlineloopindex]):
-                                if self.removeloop(onlineloopindex, onlineonly=True) != SUCCESS_RETURN or self.uploadloop(onlineloopindex) != SUCCESS_RETURN:
-                                    updateresponse = FAILURE_RETURN
+            return FAILURE_RETURN
 
-                    # upload all loops not present in online session
-                    for offlineloopindex in [index for index in self.loops.keys() if index not in onlineloopindices]:
-                        if self.uploadloop(offlineloopindex) != SUCCESS_RETURN:
-                            updateresponse = FAILURE_RETURN
+        except transport.OFFLINE_ERRORS:
 
-                    return updateresponse
-    
-                except ValueError:
-                    self.slplogger.error("Invalid loop id data from server")
-                    return FAILURE_RETURN
+            self.slplogger.info("Loop reconciliation failed. Unable to connect to server")  
+            return OFFLINE_RETURN
 
-        except requests.exceptions.ConnectionError:
+    # wait for the session composite on the server to change
+    # args:     version: composite version last downloaded, or None to get the current version straight away
+    # return:   new composite version, NONE_RETURN if unchanged within WATCH_TIMEOUT, FAILURE_RETURN if unsessioned, 
+    #           OFFLINE_RETURN on failure to connect
 
-            self.slplogger.info("Loop reconciliation failed. Unable to connect to server")  
+    def watchcomposite(self, version=None):
+        try:
+            serverresponse = self.transport.post("watch", data={'mac' : self.mac, 'version' : version}).text
+
+            try:
+                return int(serverresponse)
+            except ValueError:
+                return serverresponse
+
+        except transport.OFFLINE_ERRORS:
+
+            self.slplogger.info("Composite watch failed. Unable to connect to server")
             return OFFLINE_RETURN
 
     # requests current composite from server 
     # args:     timestamp: timestamp of last update
+    #           version: server version of the composite being played, so that only the changes since are downloaded
+    #                    and patched into it
     # returns:  SUCCESS_RETURN if updated, NONE_RETURN otherwise, OFFLINE_RETURN on failure to connect
 
-    def getcomposite(self, timestamp=None):
+    def getcomposite(self, timestamp=None, version=None):
         try:
-            self.slplogger.info("Downloading composite for timestamp %s" % (dt.utcfromtimestamp(timestamp).strftime("%Y-%m-%d-%H:%M:%S") if timestamp else "None"))
+            self.slplogger.info("Downloading composite for timestamp %s, version %s" % (dt.utcfromtimestamp(timestamp).strftime("%Y-%m-%d-%H:%M:%S") if timestamp else "None", version))
 
-            serverresponse = requests.post(SERVER_URL + "getcomposite", data={'mac' : self.mac, 'timestamp' : timestamp})
+            serverresponse = self.transport.post("getcomposite", data={'mac' : self.mac, 'timestamp' : timestamp, 'version' : version}, headers={'Accept-Encoding' : LOOP_ACCEPT_ENCODING})
 
-            self.slplogger.info("Downloaded new composite: %s" % str(serverresponse.text[:min(10, len(serverresponse.text))]))
+            self.slplogger.info("Downloaded new composite: %s" % str(serverresponse.content[:10]))
 
-            if serverresponse.text not in [NONE_RETURN, FAILURE_RETURN] and serverresponse.content:
-                if serverresponse.text == EMPTY_RETURN:
-                    self.audiocompositequeue.put(None)
+            if serverresponse.content and serverresponse.content not in [NONE_RETURN.encode(), FAILURE_RETURN.encode()]:
+                newversion = serverresponse.headers.get(COMPOSITE_VERSION_HEADER)
+                try:
+                    if serverresponse.content == EMPTY_RETURN.encode():
+                        self.pushcomposite(None)
+
+                    elif serverresponse.content.startswith(COMPOSITE_DELTA_MAGIC):
+                        # the composite being played has to still be the version the delta was made against
+                        if version is None or self.compositeversion != version or not self.pushdelta(serverresponse.content):
+                            self.slplogger.info("Composite delta since version %s no longer applies, downloading full composite" % version)
+                            return self.getcomposite()
+
+                    else:
+                        self.pushcomposite(*loadloop(serverresponse.content))
+
+                    self.compositeversion = int(newversion) if newversion else None
                     return SUCCESS_RETURN
-                else:
-                    try:
-                        self.audiocompositequeue.put(np.load(BytesIO(serverresponse.content), allow_pickle=False))
-                        return SUCCESS_RETURN
-                    except ValueError:
-                        self.slplogger.error("Server returned invalid composite numpy array: %s" % serverresponse[: min(100, len(serverresponse))])
+
+                except ValueError:
+                    self.slplogger.error("Server returned invalid composite numpy array: %s" % serverresponse.content[:100])
 
             return FAILURE_RETURN
 
-        except requests.exceptions.ConnectionError:
+        except transport.OFFLINE_ERRORS:
 
             self.slplogger.info("Composite download failed. Unable to connect to server")  
             return OFFLINE_RETURN
@@ -600,15 +1062,15 @@ class Pedal():
     def startloop(self):
         self.recording = True
 
-        self.audiocontrolqueue.put(audioprocessor.Control.ToggleRecording)
+        self.controlaudio(audioprocessor.Control.ToggleRecording)
 
         self.led.turn_on()
 
         return SUCCESS_RETURN
 
-    # stop recording loop, add loop data to composite, and send
-    # loop to strangeloop server, if pedal is in online session
-    # return:   server response if online, SUCCESS_RETURN if offline
+    # stop recording loop, add loop data to composite, and queue the loop
+    # for the upload thread to send to the strangeloop server once the pedal is in an online session
+    # return:   SUCCESS_RETURN once the loop is queued
 
     def endloop(self):
 
@@ -618,25 +1080,35 @@ class Pedal():
 
         time.sleep(END_LOOP_SLEEP)
 
-        self.audiocontrolqueue.put(audioprocessor.Control.ToggleRecording)
+        self.controlaudio(audioprocessor.Control.ToggleRecording)
 
-        # get loop from audioprocessor object
+        # get loop handle from audioprocessor object, and read the loop in place
         # when using vqueues, this will cause a sort of deadlock that prevents the loop from being started again
         if self.virtualize:
+            loophandle = loopsum = None
             loopdata = np.zeros((int(ARRAY_SIZE_SEC / self.avgsampleperiod)), dtype=LOOP_ARRAY_DTYPE)
         else:
-            loopdata = self.audioloopqueue.get()
+            loophandle = self.audioloopqueue.get()
+            loopsum = CompositeNorm(loophandle.total, loophandle.length)
+            loopdata = self.audioloops.view(loophandle)
+
+            if loopdata is None:
+                self.slplogger.error("Loop %d was recorded over before it could be read" % loophandle.generation)
+                return FAILURE_RETURN
 
-        # insert loop into offline loops dict
         loopindex = 1
         if len(self.loops):
             loopindex = max(list(self.loops.keys())) + 1
-        self.loops[loopindex] = loopdata
 
-        # if pedal in online session, upload json-encoded loop numpy array
-        if self.sessionid:
+        # insert a private copy of the loop into offline loops dict
+        retainedloop = self.audioloops.retain(loophandle) if loophandle is not None else loopdata
+        if retainedloop is None:
+            self.slplogger.error("Loop %d was recorded over before it could be retained" % loophandle.generation)
+            return FAILURE_RETURN
+        self.loops[loopindex] = retainedloop
 
-            return self.uploadloop(loopindex)
+        # the upload thread sorts and serializes the retained copy
+        self.uploads.put(loopindex, loopsum)
 
         return SUCCESS_RETURN
 
@@ -644,7 +1116,7 @@ class Pedal():
     # in offline session, only most recent loop is removeable
     # args:     loopindex:  device-unique id for loop to be removed (online only)
     #           onlineonly: only remove loop index from online session, keeping data in offline loop dict
-    # return:   server response (or SUCCESS_RETURN for offline session)
+    # return:   server response (or SUCCESS_RETURN for offline session), OFFLINE_RETURN on failure to connect
 
     def removeloop(self, loopindex=None, onlineonly=False):
         if loopindex == None and len(self.loops):
@@ -654,10 +1126,17 @@ class Pedal():
             if self.playing and self.playbacklooploopindex == loopindex:
                 self.stopplayback()
 
+            # a loop still waiting to be uploaded never reaches the server
+            self.uploads.cancel(loopindex)
+
             if self.sessionid:
                 self.slplogger.info("Removing loop %d from session %s" % (loopindex, self.sessionid))
 
-                serverresponse = requests.post(SERVER_URL + "removeloop", data={'mac' : self.mac, 'index' : loopindex}).text
+                try:
+                    serverresponse = self.transport.post("removeloop", data={'mac' : self.mac, 'index' : loopindex}).text
+                except transport.OFFLINE_ERRORS:
+                    self.slplogger.info("Loop removal failed. Unable to connect to server")
+                    return OFFLINE_RETURN
                 
                 self.slplogger.info("Loop removal returned %s" % serverresponse)
 
@@ -693,7 +1172,7 @@ class Pedal():
         if not self.recording and loopindex in self.loops:
             self.playing = True
             self.playbackloopindex = loopindex
-            self.audiocompositequeue.put(self.loops[loopindex])
+            self.pushcomposite(self.loops[loopindex])
             return SUCCESS_RETURN
         else:
             return FAILURE_RETURN
@@ -705,43 +1184,49 @@ class Pedal():
         if self.playing:
             self.playing = False
             if self.sessionid:
-                self.compositepollthread.timestamp = None
+                self.getcomposite()
             else:
                 self.genofflinecomposite()
             return SUCCESS_RETURN
         else:
             return FAILURE_RETURN
 
-    # submit given loop array to server
+    # submit given loop array to server, blocking until the server has answered
+    # the loop's hash is offered first, and the loop itself only sent if the server doesn't already store one like it
+    # loops recorded on the pedal are queued for the upload thread instead, which calls this
     # args:     loopindex: index of loop to upload in offline loops dictionary
+    #           payload: already serialized loop to upload instead of the offline loops dict entry
     # return:   serverresponse or OFFLINE_RETURN on connection failure
 
-    def uploadloop(self, loopindex):
+    def uploadloop(self, loopindex, payload=None):
     
         if self.sessionid:
 
-            loopdata = self.loops[loopindex]
-
-            # sort loop array by timestamps before uploading
-            loopdata.sort(order="timestamp")
+            if payload is None:
+                # a sorted copy, leaving the offline loop as it is
+                loopdata = sortloop(self.loops[loopindex])
 
-             # write returnaudio numpy array to a virtual bytes file, and then save the bytes output
-            loopfile = BytesIO()
-            np.save(loopfile, loopdata)
-
-            # seek start of loopfile so that requests module can send it
-            loopfile.seek(0)
+                # uploaded in the encoding the server stores loops in, so it can keep them as they are
+                payload = encodeloop(loopdata)
+            else:
+                loopdata = loadloop(payload)[0]
 
             try:
                 self.slplogger.info("Uploading loop %d to session %s" % (loopindex, self.sessionid))
 
-                serverresponse = requests.post(SERVER_URL + "addloop", data={'mac' : self.mac, 'index' : loopindex}, files={'npdata' : loopfile}).text
+                # servers that predate /haveloop answer 404, and get the loop itself
+                response = self.transport.post("haveloop", data={'mac' : self.mac, 'index' : loopindex, 'hash' : loophash(loopdata)})
+                serverresponse = response.text
+                if response.status_code == 404 or serverresponse == NONE_RETURN:
+                    serverresponse = self.transport.post("addloop", data={'mac' : self.mac, 'index' : loopindex}, files={'npdata' : BytesIO(payload)}).text
+                else:
+                    self.slplogger.info("Server already had loop %d, skipped sending it" % loopindex)
 
                 self.slplogger.info("Loop upload %s" % ("successful" if serverresponse == SUCCESS_RETURN else "unsuccessful"))
       
                 return serverresponse
 
-            except requests.exceptions.ConnectionError:
+            except transport.OFFLINE_ERRORS:
 
                 self.slplogger.info("Loop upload failed. Unable to connect to server")  
                 return OFFLINE_RETURN
@@ -753,6 +1238,32 @@ class Pedal():
     #   Helper Methods
     # ------------------
 
+    # current monotonic time in seconds, virtual if virtualtime is set
+
+    def now(self):
+        return self.clock.time() if self.clock else time.monotonic()
+
+    # pause the calling pedal thread, on virtual time if virtualtime is set, returning early once the pedal is ending
+
+    def sleep(self, seconds):
+        if self.clock:
+            self.clock.sleep(seconds)
+        else:
+            self.ending.wait(seconds)
+
+    # start a pedal thread, counting it in to every virtual time step
+
+    def startthread(self, thread):
+        if self.clock:
+            self.clock.register(thread)
+        thread.start()
+
+    # count the calling pedal thread out of virtual time steps as it exits
+
+    def endthread(self):
+        if self.clock:
+            self.clock.unregister()
+
     # items that need to be completed when pedal enters online session
 
     def goonline(self):
@@ -762,10 +1273,10 @@ class Pedal():
 
         if not self.compositepollstarted:
             self.compositepollstarted = True
-            self.compositepollthread.start()
+            self.startthread(self.compositepollthread)
 
         # pull full composite from server whenever entering online state
-        self.compositepollthread.timestamp = None
+        self.compositeversion = None
         self.compositepollthread.stop.clear()
 
     # items that need to be completed when pedal leaves online session
@@ -786,7 +1297,74 @@ class Pedal():
         # sort loops in ascending order of index, so that the first loop serves as the base
         sortedloops = [loop for _, loop in sorted(self.loops.items(), key=lambda item: item[0])]
         composite = combineloops(sortedloops, bytestore=False)
-        self.audiocompositequeue.put(composite)
+        if composite is None:
+            self.pushcomposite(None)
+        else:
+            self.pushcomposite(*composite)
+
+    # hands a composite to the audio processor through the shared composite buffer
+    # args:     composite: composite numpy array, or None for an empty composite
+    #           compositesum: CompositeNorm of composite, scanned for if not given
+
+    def pushcomposite(self, composite, compositesum=None):
+        self.compositeversion = None
+        if self.audiocomposite.put(composite, compositesum) < (len(composite) if composite is not None else 0):
+            self.slplogger.warning("Composite of %d samples truncated to composite buffer capacity of %d" % (len(composite), self.audiocomposite.capacity))
+
+    # apply a composite delta from the server to the composite being played, in the audio processor's shared buffer
+    # args:     delta: delta payload
+    # return:   whether the delta applied, which it doesn't if the composite being played has a different length
+
+    def pushdelta(self, delta):
+        return self.audiocomposite.patch(*loaddelta(delta))
+
+    # live audio processor counters, plus the depths of the queues between the pedal and the audio processor
+    # and the server transport's counters
+    # return:   dict of telemetry fields, with a 'queues' subdict of queue depths (None where the platform can't tell)
+    #           and a 'transport' subdict of ServerTransport.stats()
+
+    def telemetry(self):
+        telemetry = self.audiotelemetry.snapshot()
+        telemetry['queues'] = {'control' : self.audiocontrol.backlog(), 'log' : self.audiologring.backlog(), 'upload' : len(self.uploads)}
+        telemetry['droppedlogs'] = self.audiologring.dropped()
+        telemetry['transport'] = self.transport.stats()
+
+        try:
+            telemetry['queues']['loop'] = self.audioloopqueue.qsize()
+        except NotImplementedError:
+            telemetry['queues']['loop'] = None
+
+        return telemetry
+
+    # progress of the loops queued for upload, and of the most recently finished uploads
+    # return:   see UploadQueue.status
+
+    def uploadstatus(self):
+        return self.uploads.status()
+
+    # downloads several loops from the server in one request
+    # args:     loopindices: indices of loops to download
+    # return:   (dict of loop index to loop data, status) where status = SUCCESS_RETURN, FAILURE_RETURN if any loop wasn't
+    #           found, OFFLINE_RETURN on failure to connect
+
+    def getloops(self, loopindices):
+        try:
+            self.slplogger.info("Downloading loops %s" % ",".join([str(loopindex) for loopindex in loopindices]))
+
+            serverresponse = self.transport.post("getloops", data={'mac' : self.mac, 'indices' : ",".join([str(loopindex) for loopindex in loopindices])}, headers={'Accept-Encoding' : LOOP_ACCEPT_ENCODING})
+
+            if serverresponse.content != FAILURE_RETURN.encode():
+                try:
+                    loops = {loopindex : loadloop(payload)[0] for loopindex, payload in unpackloops(serverresponse.content)}
+                    self.slplogger.info("Downloaded %d loops" % len(loops))
+                    return (loops, SUCCESS_RETURN if set(loops) == set(loopindices) else FAILURE_RETURN)
+                except ValueError:
+                    self.slplogger.error("Server returned invalid loop bundle: %s" % serverresponse.content[:100])
+            return ({}, FAILURE_RETURN)
+        except transport.OFFLINE_ERRORS:
+
+            self.slplogger.info("Loop download failed. Unable to connect to server")  
+            return ({}, OFFLINE_RETURN)
 
     # downloads and returns a given loop from the server 
     # args:     loopindex: index of loop to download
@@ -796,17 +1374,17 @@ class Pedal():
         try:
             self.slplogger.info("Downloading loop %d" % loopindex)
 
-            serverresponse = requests.post(SERVER_URL + "getloop", data={'mac' : self.mac, 'index' : loopindex})
+            serverresponse = self.transport.post("getloop", data={'mac' : self.mac, 'index' : loopindex}, headers={'Accept-Encoding' : LOOP_ACCEPT_ENCODING})
 
             self.slplogger.info("Downloaded loop %d: %s" % (loopindex, str(serverresponse.text[:min(10, len(serverresponse.text))])))
 
             if serverresponse.text not in [NONE_RETURN, FAILURE_RETURN] and serverresponse.content:
                 try:
-                    return (np.load(BytesIO(serverresponse.content), allow_pickle=False), SUCCESS_RETURN)
+                    return (loadloop(serverresponse.content)[0], SUCCESS_RETURN)
                 except ValueError:
                     self.slplogger.error("Server returned invalid loop numpy array: %s" % serverresponse[: min(100, len(serverresponse))])
             return (None, FAILURE_RETURN)
-        except requests.exceptions.ConnectionError:
+        except transport.OFFLINE_ERRORS:
 
             self.slplogger.info("Loop download failed. Unable to connect to server")  
             return (None, OFFLINE_RETURN)
@@ -5,6 +5,7 @@
 import libbcm2835._bcm2835 as soc
 from enum import Enum
 import ctypes
+import numpy as np
 
 soc_init = False
 spi_init = False
@@ -16,6 +17,20 @@ RPI_DEBOUNCE_DELAY = 1000
 # duration, in ms, to wait after initialization to read/write from components
 RPI_INIT_DELAY = 250
 
+# MCP3202 conversion: start bit, then configuration, with the 12-bit result in the low nibble of the second
+# byte received and all of the third. each conversion is its own transfer, since chip select has to be released
+# between conversions
+SPI_COMMAND = b"\x01\x00\x00"
+SPI_CONVERSION_BYTES = 3
+
+# number of conversions the SPI transfer buffers are sized for up front
+SPI_BURST_SAMPLES = 256
+
+# 12-bit output samples are split over two 6-bit PWM channels: the low bits to channel 1, the high bits to channel 0
+PWM_CHANNEL_BITS = 6
+PWM_CHANNEL_MASK = (1 << PWM_CHANNEL_BITS) - 1
+PWM_MAX = (1 << (2 * PWM_CHANNEL_BITS)) - 1
+
 # delay to account for button debouncing, though I'm not sure it's a HUGE deal with a footswitch specifically
 def debounce_delay(delay=RPI_DEBOUNCE_DELAY):
     soc.bcm2835_delay(delay)
@@ -59,6 +74,20 @@ class GPIO(Component):
     def read(self):
         return soc.bcm2835_gpio_lev(self.pin) if self.mode == GPIO.FSEL.INPUT else 0
 
+    # latch rising and falling edges in the event detect status register, so changes between reads aren't missed
+    def detect(self):
+        if self.mode == GPIO.FSEL.INPUT:
+            soc.bcm2835_gpio_ren(self.pin)
+            soc.bcm2835_gpio_fen(self.pin)
+            soc.bcm2835_gpio_set_eds(self.pin)
+
+    # whether an edge has been latched since the last call, clearing the latch
+    def event(self):
+        if self.mode == GPIO.FSEL.INPUT and soc.bcm2835_gpio_eds(self.pin):
+            soc.bcm2835_gpio_set_eds(self.pin)
+            return True
+        return False
+
     def write(self, val):
         if self.mode == GPIO.FSEL.OUTPUT:
             soc.bcm2835_gpio_write(self.pin, val)
@@ -81,6 +110,12 @@ class SPI(Component):
         if not spi_init:
             self.__spi_bus_init__()
             spi_init = True
+
+        # transfer buffers are allocated once and reused by every read
+        self.send_buf = ctypes.create_string_buffer(SPI_COMMAND, SPI_CONVERSION_BYTES)
+        self.reserve(SPI_BURST_SAMPLES)
+        self.single = np.zeros(1, dtype=int)
+
         soc.bcm2835_delay(RPI_INIT_DELAY)
 
     def __del__(self):
@@ -100,17 +135,41 @@ class SPI(Component):
         soc.bcm2835_spi_chipSelect(soc.BCM2835_SPI_CS0)
         soc.bcm2835_spi_setChipSelectPolarity(soc.BCM2835_SPI_CS0, soc.LOW)
 
+    # size the receive buffer for a burst of conversions
+    # each conversion receives into its own fixed window of one shared buffer, so a burst allocates nothing
+    # args:     samples: number of conversions per burst
+    def reserve(self, samples):
+        self.recv_buf = ctypes.create_string_buffer(samples * SPI_CONVERSION_BYTES)
+        self.recv_windows = [(ctypes.c_char * SPI_CONVERSION_BYTES).from_buffer(self.recv_buf, i * SPI_CONVERSION_BYTES) for i in range(samples)]
+        self.recv_bytes = np.frombuffer(self.recv_buf, dtype=np.uint8).reshape(samples, SPI_CONVERSION_BYTES)
+
     def read(self):
-        send_buf = ctypes.create_string_buffer(b"\x01\x00\x00")
-        recv_buf = ctypes.create_string_buffer(b"\x00\x00\x00")
-        soc.bcm2835_spi_transfernb(send_buf, recv_buf, 3)
-        return int.from_bytes(recv_buf[2], "big") + ((int.from_bytes(recv_buf[1], "big") & 0x0F) << 8); 
+        self.read_block(self.single)
+        return int(self.single[0])
 
     def read_bytes(self, buflen):
-        retbuf = [0] * buflen
-        for i in range(buflen):
-            retbuf[i] = self.read()
-        return retbuf
+        retbuf = np.zeros(buflen, dtype=int)
+        self.read_block(retbuf)
+        return retbuf.tolist()
+
+    # fill a caller-supplied numpy or ctypes buffer with len(buf) conversions, decoded all at once
+    # return:   number of samples written to buf
+    def read_block(self, buf):
+        if not isinstance(buf, np.ndarray):
+            buf = np.ctypeslib.as_array(buf)
+
+        count = len(buf)
+        if count > len(self.recv_windows):
+            self.reserve(count)
+
+        transfer = soc.bcm2835_spi_transfernb
+        send_buf = self.send_buf
+        for window in self.recv_windows[:count]:
+            transfer(send_buf, window, SPI_CONVERSION_BYTES)
+
+        received = self.recv_bytes[:count]
+        buf[:] = ((received[:, 1] & 0x0F).astype(np.int64) << 8) | received[:, 2]
+        return count
         
 class PWM(Component):
     def __init__(self, pins):
@@ -135,10 +194,22 @@ class PWM(Component):
         soc.bcm2835_pwm_set_mode(1, 1, 1)
         soc.bcm2835_pwm_set_range(1, 64)
 
+    # values outside the 12-bit range are clipped, so overdubbed sums can't wrap around
     def write(self, val):
-        soc.bcm2835_pwm_set_data(1, val & 0x3F)
-        soc.bcm2835_pwm_set_data(0, val >> 6)
+        val = min(max(val, 0), PWM_MAX)
+        soc.bcm2835_pwm_set_data(1, val & PWM_CHANNEL_MASK)
+        soc.bcm2835_pwm_set_data(0, val >> PWM_CHANNEL_BITS)
 
     def write_bytes(self, buf):
-        for val in buf:
-            self.write(val)
+        self.write_block(np.asarray(buf))
+
+    # write a numpy array of samples, clipped and split into both channels in one step
+    def write_block(self, buf):
+        clipped = np.clip(buf, 0, PWM_MAX)
+        lows = (clipped & PWM_CHANNEL_MASK).tolist()
+        highs = (clipped >> PWM_CHANNEL_BITS).tolist()
+
+        setdata = soc.bcm2835_pwm_set_data
+        for low, high in zip(lows, highs):
+            setdata(1, low)
+            setdata(0, high)
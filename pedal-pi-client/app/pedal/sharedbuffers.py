@@ -0,0 +1,737 @@
+# ---------------------------------------------------------------------------------------------------------------
+#   sharedbuffers - shared-memory structures used to pass audio data between the Pedal and AudioProcessor
+#                   processes without pickling it through a multiprocessing pipe
+# ---------------------------------------------------------------------------------------------------------------
+
+import threading
+import multiprocessing
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+
+from common import *
+
+# -------------
+#   Constants
+# -------------
+
+# highest sample rate the composite buffers are sized for
+MAX_SAMPLE_RATE = 48000
+
+# composite buffer slots hold a full-length loop at the maximum sample rate
+COMPOSITE_BUFFER_SAMPLES = MAX_LOOP_DURATION * MAX_SAMPLE_RATE
+
+# composite buffer header fields (int64 each)
+# generation:   incremented every time a new composite is published
+# applied:      generation most recently taken up by the audio process
+# active:       slot the audio process is currently playing from
+# pending:      slot holding a published composite not yet taken up, or -1
+# lengths:      number of samples in each slot (0 for an empty composite)
+# totals:       sum of the values in each slot, so the audio process gets the composite norm without a scan
+# published:    monotonic time the newest composite was published, in nanoseconds
+# numbuckets:   number of CompositeIndex buckets laid out over each slot
+# maxbuckets:   number of samples in the fullest of those buckets
+HEADER_GENERATION   = 0
+HEADER_APPLIED      = 1
+HEADER_ACTIVE       = 2
+HEADER_PENDING      = 3
+HEADER_LENGTHS      = 4
+HEADER_TOTALS       = 6
+HEADER_PUBLISHED    = 8
+HEADER_NUMBUCKETS   = 9
+HEADER_MAXBUCKETS   = 11
+HEADER_FIELDS       = 13
+
+# composite buffer index fields, per slot (float64 each)
+# start:        timestamp at which the first CompositeIndex bucket of the slot begins
+# bucketwidth:  duration covered by each bucket
+INDEX_START         = 0
+INDEX_BUCKETWIDTH   = 1
+INDEX_FIELDS        = 2
+
+# loop arena slots hold a full-length loop at the maximum sample rate
+LOOP_BUFFER_SAMPLES = MAX_LOOP_DURATION * MAX_SAMPLE_RATE
+
+# number of loop arena slots recorded into in rotation
+# a loop stays readable until this many further recordings have been started
+LOOP_ARENA_SLOTS = 2
+
+# number of commands the control block can hold before the audio process has taken them up
+CONTROL_BLOCK_COMMANDS = 64
+
+# how long a writer waits for room in a full control block before checking again
+CONTROL_BLOCK_WAIT = 0.001
+
+# control block header fields (int64 each)
+# sequence:     number of commands ever written
+# consumed:     number of commands the audio process has taken up
+CONTROL_SEQUENCE    = 0
+CONTROL_CONSUMED    = 1
+CONTROL_FIELDS      = 2
+
+# control block ring entries hold the command number in their low bits, and above it the sequence number the
+# command was written at, plus one so that a zeroed entry never passes for the first command
+CONTROL_COMMAND_BITS = 8
+
+# audio processor telemetry fields (float64 each)
+# samples:          samples processed while monitoring
+# blocks:           blocks processed while monitoring
+# rate:             sample rate measured by the sample clock, in Hz
+# drift:            sample clock time minus monotonic time, in seconds
+# lateblocks:       blocks that took longer to process than they take to play
+# latesamples:      samples in those blocks
+# droppedsamples:   input samples that couldn't be recorded into a full loop slot or recording buffer
+# swaps:            composites taken up
+# swaplatency:      time between the newest composite being published and taken up, in seconds
+# maxswaplatency:   longest swaplatency seen
+# maxblocktime:     longest block processing time seen, in seconds
+TELEMETRY_FIELDS = ["samples", "blocks", "rate", "drift", "lateblocks", "latesamples", "droppedsamples", "swaps", "swaplatency", "maxswaplatency", "maxblocktime"]
+
+# block processing time histogram: bucket 0 counts blocks under 1 microsecond, bucket i blocks under 2^i
+# microseconds, and the last bucket everything slower
+TELEMETRY_HISTOGRAM_BUCKETS = 20
+
+# number of log records the log ring holds before new ones are dropped
+LOG_RING_RECORDS = 256
+
+# bytes of message text kept per log record; longer messages are truncated
+LOG_RECORD_BYTES = 240
+
+# numeric arguments kept per log record, formatted into the message by the reader
+LOG_RECORD_ARGS = 4
+
+# log ring header fields (int64 each)
+# written:      number of records ever written
+# read:         number of records drained
+# dropped:      number of records dropped because the ring was full
+LOG_WRITTEN         = 0
+LOG_READ            = 1
+LOG_DROPPED         = 2
+LOG_FIELDS          = 3
+
+# log ring record layout
+LOG_RECORD_DTYPE = np.dtype([('level', '<i2'), ('argcount', '<i2'), ('args', '<f8', (LOG_RECORD_ARGS,)), ('message', 'S%d' % LOG_RECORD_BYTES)])
+
+# lightweight reference to a loop recorded into a LoopArena
+# offset:       sample offset of the loop in the arena
+# length:       number of samples recorded
+# generation:   recording number, used to detect that the slot has since been recorded over
+# total:        sum of the loop's values, kept by the audio process as it records
+LoopHandle = namedtuple("LoopHandle", ["offset", "length", "generation", "total"])
+
+# -----------
+#   Classes
+# -----------
+
+# ---------------------------------------------------------------------------------------------------------------
+#   CompositeBuffer - double-buffered composite handoff in shared memory
+#                     the Pedal process writes into whichever slot the audio process isn't playing, then flips
+#                     the generation counter. the audio process picks up the newest composite at a block boundary
+#                     as a view into the slot, without copying. composites published before the audio process
+#                     gets around to them are simply overwritten, so only the newest is ever applied. each slot
+#                     carries the CompositeIndex laid out over its samples when they were written, so the audio
+#                     process never scans a composite to take it up
+# ---------------------------------------------------------------------------------------------------------------
+
+class CompositeBuffer():
+
+    # args:     dtype: numpy dtype of composite array entries
+    #           capacity: maximum number of samples per slot
+
+    def __init__(self, dtype, capacity=COMPOSITE_BUFFER_SAMPLES):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.maxbuckets = max(1, capacity // COMPOSITE_INDEX_BUCKET_SAMPLES)
+
+        # header, index fields, samples and index bucket starts, each for both slots
+        size = HEADER_FIELDS * 8 + 2 * INDEX_FIELDS * 8 + 2 * capacity * self.dtype.itemsize + 2 * (self.maxbuckets + 1) * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.owner = True
+
+        # guards the header only; held for a handful of integer writes, never while copying sample data
+        self.lock = multiprocessing.Lock()
+
+        # serializes writers within the Pedal process (polling thread, monitoring thread, flask views)
+        self.writelock = threading.Lock()
+
+        self.attach()
+
+        self.header[:] = 0
+        self.header[HEADER_PENDING] = -1
+
+        # time between publishing and taking up the last composite swapped to, in nanoseconds (audio process only)
+        self.swaplatency = 0
+
+    # map numpy views onto the shared memory block
+
+    def attach(self):
+        offset = HEADER_FIELDS * 8
+        self.header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=self.shm.buf)
+        self.bounds = np.ndarray((2, INDEX_FIELDS), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        offset += 2 * INDEX_FIELDS * 8
+        self.slots = np.ndarray((2, self.capacity), dtype=self.dtype, buffer=self.shm.buf, offset=offset)
+        offset += 2 * self.capacity * self.dtype.itemsize
+        self.bucketstarts = np.ndarray((2, self.maxbuckets + 1), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+
+    # only the shared memory name and the header lock travel to a spawned process
+
+    def __getstate__(self):
+        return {'dtype' : self.dtype, 'capacity' : self.capacity, 'name' : self.shm.name, 'lock' : self.lock}
+
+    def __setstate__(self, state):
+        self.dtype = state['dtype']
+        self.capacity = state['capacity']
+        self.maxbuckets = max(1, self.capacity // COMPOSITE_INDEX_BUCKET_SAMPLES)
+        self.lock = state['lock']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self.writelock = threading.Lock()
+        self.swaplatency = 0
+        self.attach()
+
+    # publish a new composite (Pedal process)
+    # args:     composite: composite numpy array, or None to return the audio process to an empty composite
+    #           compositesum: CompositeNorm of composite, scanned for if not given
+    # return:   number of samples published, which is less than len(composite) if it exceeded the slot capacity
+
+    def put(self, composite, compositesum=None):
+        with self.writelock:
+
+            # withdraw any composite the audio process hasn't taken up yet, so it can't swap to the slot being written
+            with self.lock:
+                self.header[HEADER_PENDING] = -1
+                slot = 1 - int(self.header[HEADER_ACTIVE])
+
+            length = 0 if composite is None else min(len(composite), self.capacity)
+            if length:
+                self.slots[slot][:length] = composite[:length]
+                self.index(slot, length)
+
+            # a truncated composite no longer matches its sum
+            if length and (compositesum is None or compositesum.count != length):
+                compositesum = scannorm(self.slots[slot][:length])
+
+            self.publish(slot, length, compositesum.total if length else 0)
+
+            return length
+
+    # publish a new composite made by replacing ranges of values in the newest one, which never leaves shared memory (Pedal process)
+    # args:     starts, lengths: ranges to replace, applied in order
+    #           values: replacement values of every range, back to back
+    #           compositesum: CompositeNorm of the patched composite
+    # return:   whether the patch was published; False if the newest composite isn't compositesum.count samples long
+
+    def patch(self, starts, lengths, values, compositesum):
+        with self.writelock:
+
+            # the newest composite is the one waiting to be taken up, if there is one
+            with self.lock:
+                active = int(self.header[HEADER_ACTIVE])
+                pending = int(self.header[HEADER_PENDING])
+                source = pending if pending >= 0 else active
+                length = int(self.header[HEADER_LENGTHS + source])
+                if not length or length != compositesum.count:
+                    return False
+                self.header[HEADER_PENDING] = -1
+
+            # the audio process keeps playing the active slot, so it's copied to the other one to be patched there,
+            # along with its index, which stays valid since patches never change the timestamps
+            slot = 1 - active
+            if source != slot:
+                self.slots[slot][:length] = self.slots[source][:length]
+                self.copyindex(source, slot)
+            applydelta(self.slots[slot][:length], starts, lengths, values)
+
+            self.publish(slot, length, compositesum.total)
+
+            return True
+
+    # lay out the CompositeIndex of a written slot next to its samples (writelock held)
+    # args:     slot: slot written to
+    #           length: number of samples written
+
+    def index(self, slot, length):
+        start, bucketwidth, bucketstarts, maxbucketsize = indexlayout(self.slots[slot]['timestamp'][:length])
+        self.bounds[slot, INDEX_START] = start
+        self.bounds[slot, INDEX_BUCKETWIDTH] = bucketwidth
+        self.bucketstarts[slot][:len(bucketstarts)] = bucketstarts
+        self.header[HEADER_NUMBUCKETS + slot] = len(bucketstarts) - 1
+        self.header[HEADER_MAXBUCKETS + slot] = maxbucketsize
+
+    # copy the index of one slot to another whose samples have the same timestamps (writelock held)
+
+    def copyindex(self, source, slot):
+        numbuckets = int(self.header[HEADER_NUMBUCKETS + source])
+        self.bounds[slot] = self.bounds[source]
+        self.bucketstarts[slot][:numbuckets + 1] = self.bucketstarts[source][:numbuckets + 1]
+        self.header[HEADER_NUMBUCKETS + slot] = numbuckets
+        self.header[HEADER_MAXBUCKETS + slot] = self.header[HEADER_MAXBUCKETS + source]
+
+    # hand a written slot to the audio process (writelock held)
+
+    def publish(self, slot, length, total):
+        with self.lock:
+            self.header[HEADER_LENGTHS + slot] = length
+            self.header[HEADER_TOTALS + slot] = total
+            self.header[HEADER_PUBLISHED] = time.monotonic_ns()
+            self.header[HEADER_PENDING] = slot
+            self.header[HEADER_GENERATION] += 1
+
+    # take up the newest published composite, if there is one (audio process)
+    # never blocks: if the Pedal process is mid-publish, the swap is retried on the next call
+    # only references change hands, since the composite's index was laid out when it was written
+    # return:   (swapped, composite, compositesum, compositelookup) where composite is a view into the shared slot,
+    #           or None for an empty composite, compositesum is its CompositeNorm and compositelookup its
+    #           CompositeIndex, over views into the slot
+
+    def swap(self):
+        if self.header[HEADER_GENERATION] == self.header[HEADER_APPLIED]:
+            return (False, None, None, None)
+
+        if not self.lock.acquire(False):
+            return (False, None, None, None)
+        try:
+            slot = int(self.header[HEADER_PENDING])
+            if slot < 0:
+                return (False, None, None, None)
+
+            self.header[HEADER_PENDING] = -1
+            self.header[HEADER_ACTIVE] = slot
+            self.header[HEADER_APPLIED] = self.header[HEADER_GENERATION]
+            length = int(self.header[HEADER_LENGTHS + slot])
+            total = int(self.header[HEADER_TOTALS + slot])
+            numbuckets = int(self.header[HEADER_NUMBUCKETS + slot])
+            maxbucketsize = int(self.header[HEADER_MAXBUCKETS + slot])
+            self.swaplatency = time.monotonic_ns() - int(self.header[HEADER_PUBLISHED])
+        finally:
+            self.lock.release()
+
+        if not length:
+            return (True, None, CompositeNorm(), None)
+
+        composite = self.slots[slot][:length]
+        layout = (float(self.bounds[slot, INDEX_START]), float(self.bounds[slot, INDEX_BUCKETWIDTH]), self.bucketstarts[slot][:numbuckets + 1], maxbucketsize)
+        return (True, composite, CompositeNorm(total, length), CompositeIndex(composite['timestamp'], layout=layout))
+
+    # release the shared memory block, removing it if this is the creating process
+
+    def close(self):
+        self.header = self.bounds = self.slots = self.bucketstarts = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# ---------------------------------------------------------------------------------------------------------------
+#   LoopArena - shared-memory arena the audio process records loops straight into
+#               recordings rotate through a fixed number of slots. when a loop ends, the audio process passes a
+#               LoopHandle back instead of the samples, and the Pedal process reads the loop in place. each slot
+#               is stamped with the generation recorded into it, so a handle to a slot that has since been
+#               reused reads as stale instead of returning someone else's audio
+# ---------------------------------------------------------------------------------------------------------------
+
+class LoopArena():
+
+    # args:     dtype: numpy dtype of loop array entries
+    #           slots: number of slots to rotate through
+    #           slotcapacity: maximum number of samples per loop
+
+    def __init__(self, dtype, slots=LOOP_ARENA_SLOTS, slotcapacity=LOOP_BUFFER_SAMPLES):
+        self.dtype = np.dtype(dtype)
+        self.numslots = slots
+        self.slotcapacity = slotcapacity
+
+        # header: one generation stamp per slot
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * 8 + slots * slotcapacity * self.dtype.itemsize)
+        self.owner = True
+
+        self.attach()
+
+        self.slotgenerations[:] = 0
+
+        # generation of the recording in progress (audio process only)
+        self.generation = 0
+
+    # map numpy views onto the shared memory block
+
+    def attach(self):
+        self.slotgenerations = np.ndarray((self.numslots,), dtype=np.int64, buffer=self.shm.buf)
+        self.samples = np.ndarray((self.numslots * self.slotcapacity,), dtype=self.dtype, buffer=self.shm.buf, offset=self.numslots * 8)
+
+    def __getstate__(self):
+        return {'dtype' : self.dtype, 'numslots' : self.numslots, 'slotcapacity' : self.slotcapacity, 'name' : self.shm.name, 'generation' : self.generation}
+
+    def __setstate__(self, state):
+        self.dtype = state['dtype']
+        self.numslots = state['numslots']
+        self.slotcapacity = state['slotcapacity']
+        self.generation = state['generation']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self.attach()
+
+    # start recording a new loop into the next slot (audio process)
+    # return:   writable array spanning the whole slot
+
+    def begin(self):
+        self.generation += 1
+        slot = self.generation % self.numslots
+        self.slotgenerations[slot] = self.generation
+        return self.samples[slot * self.slotcapacity : (slot + 1) * self.slotcapacity]
+
+    # handle to the loop currently being recorded (audio process)
+    # args:     length: number of samples recorded
+    #           total: sum of the recorded values
+
+    def handle(self, length, total=0):
+        return LoopHandle((self.generation % self.numslots) * self.slotcapacity, length, self.generation, int(total))
+
+    # whether the slot a handle points to still holds its loop
+
+    def valid(self, handle):
+        return self.slotgenerations[handle.offset // self.slotcapacity] == handle.generation
+
+    # read a recorded loop in place (Pedal process)
+    # return:   view of the loop in shared memory, or None if its slot has been recorded over
+
+    def view(self, handle):
+        return self.samples[handle.offset : handle.offset + handle.length] if self.valid(handle) else None
+
+    # copy a recorded loop out of the arena, for loops that have to outlive their slot
+    # return:   private copy of the loop, or None if its slot was recorded over before or during the copy
+
+    def retain(self, handle):
+        loopdata = self.view(handle)
+        if loopdata is None:
+            return None
+        loopdata = loopdata.copy()
+        return loopdata if self.valid(handle) else None
+
+    # release the shared memory block, removing it if this is the creating process
+
+    def close(self):
+        self.slotgenerations = self.samples = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# ---------------------------------------------------------------------------------------------------------------
+#   ControlBlock - shared-memory command ring and status flags replacing the control queue
+#                  the Pedal process appends commands to the ring and bumps a sequence number; the audio process
+#                  compares the sequence number against its own count once per block, a single memory read, and
+#                  only touches the ring when they differ. commands are taken up one at a time in the order they
+#                  were written, so two toggles written back to back are both applied. the audio process mirrors
+#                  its status flags back into the block after every change. nothing orders the two processes'
+#                  view of shared memory, so each command is stamped with its sequence number, and the audio
+#                  process only takes it up once the stamp it reads matches (seqlock-style)
+# ---------------------------------------------------------------------------------------------------------------
+
+class ControlBlock():
+
+    # args:     commands: every command that can be sent, e.g. the Control enum, each with a status flag of its own
+    #           capacity: maximum number of commands waiting to be taken up
+
+    def __init__(self, commands, capacity=CONTROL_BLOCK_COMMANDS):
+        self.commands = list(commands)
+        self.capacity = capacity
+
+        self.shm = shared_memory.SharedMemory(create=True, size=(CONTROL_FIELDS + len(self.commands) + capacity) * 8)
+        self.owner = True
+
+        # serializes writers within the Pedal process
+        self.writelock = threading.Lock()
+
+        self.attach()
+
+        self.header[:] = 0
+        self.flags[:] = 0
+
+        # number of commands taken up (audio process only)
+        self.consumed = 0
+
+    # map numpy views onto the shared memory block
+
+    def attach(self):
+        self.header = np.ndarray((CONTROL_FIELDS,), dtype=np.int64, buffer=self.shm.buf)
+        self.flags = np.ndarray((len(self.commands),), dtype=np.int64, buffer=self.shm.buf, offset=CONTROL_FIELDS * 8)
+        self.ring = np.ndarray((self.capacity,), dtype=np.int64, buffer=self.shm.buf, offset=(CONTROL_FIELDS + len(self.commands)) * 8)
+
+    def __getstate__(self):
+        return {'commands' : self.commands, 'capacity' : self.capacity, 'name' : self.shm.name}
+
+    def __setstate__(self, state):
+        self.commands = state['commands']
+        self.capacity = state['capacity']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self.writelock = threading.Lock()
+        self.attach()
+        self.consumed = int(self.header[CONTROL_CONSUMED])
+
+    # send a command to the audio process (Pedal process)
+    # waits for the audio process to make room if the ring is full, rather than dropping a toggle
+    # args:     command: command to send
+    #           timeout: seconds to wait for room at most, or None to wait as long as the audio process is alive
+    #           alive: called while waiting, returning whether the audio process is still there to make room
+    # raises:   TimeoutError if there's no room in time, BrokenPipeError if the audio process is gone
+
+    def put(self, command, timeout=None, alive=None):
+        with self.writelock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            sequence = int(self.header[CONTROL_SEQUENCE])
+            while sequence - self.header[CONTROL_CONSUMED] >= self.capacity:
+                if alive is not None and not alive():
+                    raise BrokenPipeError("Audio process exited with %d commands waiting in the control block" % self.backlog())
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError("No room in the control block within %s seconds" % timeout)
+                time.sleep(CONTROL_BLOCK_WAIT)
+
+            # the audio process may see the new sequence number before the entry, so the entry is stamped with it
+            self.ring[sequence % self.capacity] = ((sequence + 1) << CONTROL_COMMAND_BITS) | self.commands.index(command)
+            self.header[CONTROL_SEQUENCE] = sequence + 1
+
+    # whether any commands are waiting (audio process)
+
+    def pending(self):
+        return self.header[CONTROL_SEQUENCE] != self.consumed
+
+    # number of commands written but not yet taken up, readable from either process
+
+    def backlog(self):
+        return int(self.header[CONTROL_SEQUENCE] - self.header[CONTROL_CONSUMED])
+
+    # take up the oldest waiting command (audio process)
+    # return:   command, or None if there are none waiting, or the oldest hasn't become visible yet
+
+    def get(self):
+        if not self.pending():
+            return None
+
+        # an entry still stamped with an older sequence number is the one being overwritten; it's read again next time
+        entry = int(self.ring[self.consumed % self.capacity])
+        if entry >> CONTROL_COMMAND_BITS != self.consumed + 1:
+            return None
+
+        command = self.commands[entry & ((1 << CONTROL_COMMAND_BITS) - 1)]
+        self.consumed += 1
+        self.header[CONTROL_CONSUMED] = self.consumed
+        return command
+
+    # status flag belonging to a command, as last published by the audio process
+
+    def flag(self, command):
+        return bool(self.flags[self.commands.index(command)])
+
+    def setflag(self, command, value):
+        self.flags[self.commands.index(command)] = value
+
+    # release the shared memory block, removing it if this is the creating process
+
+    def close(self):
+        self.header = self.flags = self.ring = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# ---------------------------------------------------------------------------------------------------------------
+#   Telemetry - live audio processor counters in shared memory
+#               the audio process updates a handful of numbers per block, and the Pedal process reads them at
+#               any time without interrupting it. single writer, so no locking; a reader may see a block's
+#               update half applied, which is fine for monitoring
+# ---------------------------------------------------------------------------------------------------------------
+
+class Telemetry():
+
+    def __init__(self):
+        self.shm = shared_memory.SharedMemory(create=True, size=(len(TELEMETRY_FIELDS) + TELEMETRY_HISTOGRAM_BUCKETS) * 8)
+        self.owner = True
+
+        self.attach()
+
+        self.values[:] = 0
+        self.histogram[:] = 0
+
+    # map numpy views onto the shared memory block
+
+    def attach(self):
+        self.values = np.ndarray((len(TELEMETRY_FIELDS),), dtype=np.float64, buffer=self.shm.buf)
+        self.histogram = np.ndarray((TELEMETRY_HISTOGRAM_BUCKETS,), dtype=np.float64, buffer=self.shm.buf, offset=len(TELEMETRY_FIELDS) * 8)
+
+        # field indices, looked up once instead of per update
+        self.fields = {name : index for index, name in enumerate(TELEMETRY_FIELDS)}
+
+    def __getstate__(self):
+        return {'name' : self.shm.name}
+
+    def __setstate__(self, state):
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self.attach()
+
+    # record a processed block (audio process)
+    # args:     count: number of samples in the block
+    #           elapsed: processing time, in nanoseconds
+    #           budget: time the block takes to play, in nanoseconds
+
+    def block(self, count, elapsed, budget):
+        values = self.values
+        fields = self.fields
+        values[fields['samples']] += count
+        values[fields['blocks']] += 1
+
+        self.histogram[min(int(elapsed // 1000).bit_length(), TELEMETRY_HISTOGRAM_BUCKETS - 1)] += 1
+
+        if elapsed > budget:
+            values[fields['lateblocks']] += 1
+            values[fields['latesamples']] += count
+
+        if elapsed > values[fields['maxblocktime']] * 1e9:
+            values[fields['maxblocktime']] = elapsed / 1e9
+
+    # record the sample clock's latest measurement (audio process)
+
+    def clock(self, rate, drift):
+        self.values[self.fields['rate']] = rate
+        self.values[self.fields['drift']] = drift
+
+    # record input samples that couldn't be recorded (audio process)
+
+    def dropped(self, count):
+        self.values[self.fields['droppedsamples']] += count
+
+    # record a composite swap (audio process)
+    # args:     latency: time between the composite being published and taken up, in nanoseconds
+
+    def swap(self, latency):
+        self.values[self.fields['swaps']] += 1
+        self.values[self.fields['swaplatency']] = latency / 1e9
+        self.values[self.fields['maxswaplatency']] = max(self.values[self.fields['maxswaplatency']], latency / 1e9)
+
+    # return:   dict of every field, plus the block processing time histogram as a list of counts
+
+    def snapshot(self):
+        snapshot = dict(zip(TELEMETRY_FIELDS, self.values.tolist()))
+        snapshot['blocktimes'] = self.histogram.tolist()
+        return snapshot
+
+    # release the shared memory block, removing it if this is the creating process
+
+    def close(self):
+        self.values = self.histogram = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# ---------------------------------------------------------------------------------------------------------------
+#   LogRing - fixed-size shared-memory ring of log records, written by the audio process and drained by the
+#             Pedal process's logging thread. writing never blocks and never grows anything: when the ring is
+#             full the record is dropped and counted instead. records carry numeric logging levels, so the
+#             reader hands them straight to logging. the writer never formats or encodes text per record: it
+#             copies a message encoded on first use and the numbers to format into it, and the reader formats
+# ---------------------------------------------------------------------------------------------------------------
+
+class LogRing():
+
+    # args:     capacity: number of records held before new ones are dropped
+
+    def __init__(self, capacity=LOG_RING_RECORDS):
+        self.capacity = capacity
+
+        self.shm = shared_memory.SharedMemory(create=True, size=LOG_FIELDS * 8 + capacity * LOG_RECORD_DTYPE.itemsize)
+        self.owner = True
+
+        self.attach()
+
+        self.header[:] = 0
+
+    # map numpy views onto the shared memory block
+
+    def attach(self):
+        self.header = np.ndarray((LOG_FIELDS,), dtype=np.int64, buffer=self.shm.buf)
+        self.records = np.ndarray((self.capacity,), dtype=LOG_RECORD_DTYPE, buffer=self.shm.buf, offset=LOG_FIELDS * 8)
+
+        # encoded messages by message, so each is only encoded the first time it's written
+        self.messages = {}
+
+    def __getstate__(self):
+        return {'capacity' : self.capacity, 'name' : self.shm.name}
+
+    def __setstate__(self, state):
+        self.capacity = state['capacity']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self.attach()
+
+    # write a log record (audio process)
+    # messages are kept encoded, so they should be constant format strings, with anything that varies passed as args
+    # args:     level: logging level number, e.g. logging.INFO
+    #           message: log message, formatted with args by the reader if there are any
+    #           args: up to LOG_RECORD_ARGS numbers to format into the message
+    # return:   whether the record was written, rather than dropped
+
+    def put(self, level, message, *args):
+        written = int(self.header[LOG_WRITTEN])
+        if written - self.header[LOG_READ] >= self.capacity:
+            self.header[LOG_DROPPED] += 1
+            return False
+
+        encoded = self.messages.get(message)
+        if encoded is None:
+            encoded = self.messages[message] = message.encode("utf-8", "replace")[:LOG_RECORD_BYTES]
+
+        record = self.records[written % self.capacity]
+        record['level'] = level
+        argcount = min(len(args), LOG_RECORD_ARGS)
+        record['argcount'] = argcount
+        if argcount:
+            record['args'][:argcount] = args[:argcount]
+        record['message'] = encoded
+        self.header[LOG_WRITTEN] = written + 1
+        return True
+
+    # take every waiting record, up to a batch size (Pedal process)
+    # args:     limit: maximum number of records to take
+    # return:   list of (level, message) tuples, oldest first
+
+    def drain(self, limit=LOG_RING_RECORDS):
+        read = int(self.header[LOG_READ])
+        count = min(int(self.header[LOG_WRITTEN]) - read, limit)
+
+        batch = []
+        for index in range(read, read + count):
+            record = self.records[index % self.capacity]
+            message = record['message'].decode("utf-8", "replace")
+            if record['argcount']:
+                message = self.format(message, record['args'][:record['argcount']].tolist())
+            batch.append((int(record['level']), message))
+
+        # the slots only become writable again once they've been copied out
+        self.header[LOG_READ] = read + count
+        return batch
+
+    # format a record's arguments into its message, leaving the message as it is if they don't fit it
+    # (e.g. once truncated, or given more arguments than a record holds)
+
+    def format(self, message, args):
+        try:
+            return message % tuple(args)
+        except (TypeError, ValueError):
+            return message
+
+    # number of records written but not yet drained
+
+    def backlog(self):
+        return int(self.header[LOG_WRITTEN] - self.header[LOG_READ])
+
+    # number of records dropped so far
+
+    def dropped(self):
+        return int(self.header[LOG_DROPPED])
+
+    # release the shared memory block, removing it if this is the creating process
+
+    def close(self):
+        self.header = self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
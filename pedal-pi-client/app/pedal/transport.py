@@ -0,0 +1,157 @@
+# ---------------------------------------------------------------------------------------------------------------
+#   transport - pooled, keep-alive HTTP transport for every call the Pedal makes to the strangeloop server, with
+#               per-endpoint timeouts, bounded retries with jittered backoff, and latency & byte counters
+# ---------------------------------------------------------------------------------------------------------------
+
+import threading
+import time
+import random
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from common import *
+
+# -------------
+#   Constants
+# -------------
+
+# connections kept open to the server, enough for the composite watch, the RPi thread and the flask views at once
+TRANSPORT_POOL_SIZE = 4
+
+# extra time given to a /watch request on top of the WATCH_TIMEOUT the server holds it open for
+WATCH_TIMEOUT_SLACK = 5
+
+# (connect, read) timeouts in seconds of each endpoint, and of any endpoint not listed
+# loop & composite transfers get longer to read, and /watch is held open by the server for up to WATCH_TIMEOUT
+TRANSPORT_DEFAULT_TIMEOUT = (3.05, 10)
+TRANSPORT_TIMEOUTS = {
+    'getloop'       : (3.05, 30),
+    'getloops'      : (3.05, 60),
+    'getcomposite'  : (3.05, 30),
+    'addloop'       : (3.05, 30),
+    'watch'         : (3.05, WATCH_TIMEOUT + WATCH_TIMEOUT_SLACK)
+}
+
+# endpoints the pedal calls whose requests are sent again after they may have reached the server, since repeating them
+# changes nothing and gets the same answer. any request is sent again if it never got a connection. left out on purpose:
+#   watch:      held open by the server for up to WATCH_TIMEOUT, and the composite thread watches again anyway
+#   haveloop:   stores the loop if the server has its payload, so a repeat would be refused as a loop already at that
+#               index; the upload thread requeues the whole upload instead
+TRANSPORT_IDEMPOTENT = {'getsession', 'getmembers', 'getloophashes', 'getloop', 'getloops', 'getcomposite'}
+
+# attempts after the first, and the backoff before each: a random time up to TRANSPORT_BACKOFF doubled for every attempt
+# already made, capped at TRANSPORT_MAX_BACKOFF, so pedals that lost the server at once don't come back in step
+TRANSPORT_RETRIES = 2
+TRANSPORT_BACKOFF = 0.2
+TRANSPORT_MAX_BACKOFF = 2
+
+# errors meaning the server couldn't be reached, once the retries are used up
+OFFLINE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+# counters kept for each endpoint
+TRANSPORT_COUNTERS = ["requests", "failures", "retries", "bytessent", "bytesreceived", "latency", "maxlatency"]
+
+# whether a failed request certainly never reached the server
+# args:     error: exception raised by requests
+def unsent(error):
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+# -------------------------------------------------------------------------------------------------------------
+#   ServerTransport - one requests.Session shared by all of the Pedal's threads, so calls reuse open
+#                     connections instead of setting up a new one each, and never wait on the server for ever
+# -------------------------------------------------------------------------------------------------------------
+
+class ServerTransport():
+
+    # args:     baseurl: server URL the endpoint names are appended to
+    #           retries: attempts after the first
+    #           sleep: called with the seconds to back off for
+
+    def __init__(self, baseurl, retries=TRANSPORT_RETRIES, sleep=time.sleep):
+        self.baseurl = baseurl
+        self.retries = retries
+        self.sleep = sleep
+
+        # retries are handled here, where they can be counted and told apart by endpoint
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TRANSPORT_POOL_SIZE, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    # send a POST request to a server endpoint
+    # args:     endpoint: endpoint name, e.g. "getsession"
+    #           data, files, headers: passed on to requests
+    #           timeout: (connect, read) timeouts or a single timeout for both, overriding the endpoint's
+    #           retries: attempts after the first, overriding the transport's
+    # return:   requests.Response
+    # raises:   one of OFFLINE_ERRORS once the retries are used up, or straight away if retrying isn't safe
+
+    def post(self, endpoint, data=None, files=None, headers=None, timeout=None, retries=None):
+        timeout = timeout or TRANSPORT_TIMEOUTS.get(endpoint, TRANSPORT_DEFAULT_TIMEOUT)
+        retries = self.retries if retries is None else retries
+
+        # the body is built once, so that uploads can be sent again without rewinding anything
+        request = self.session.prepare_request(requests.Request("POST", self.baseurl + endpoint, data=data, files=files, headers=headers))
+        bodysize = len(request.body or b"")
+
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                response = self.session.send(request, timeout=timeout)
+                content = response.content
+            except OFFLINE_ERRORS as error:
+                self.count(endpoint, time.monotonic() - start, bodysize, 0, failed=True)
+                if attempt >= retries or not (endpoint in TRANSPORT_IDEMPOTENT or unsent(error)):
+                    raise
+                attempt += 1
+                self.count(endpoint, retried=True)
+                self.sleep(random.uniform(0, min(TRANSPORT_MAX_BACKOFF, TRANSPORT_BACKOFF * 2 ** attempt)))
+                continue
+
+            self.count(endpoint, time.monotonic() - start, bodysize, len(content))
+            return response
+
+    # args:     endpoint: endpoint name
+    #           latency: seconds the attempt took, or None for a retry being counted
+    #           sent, received: bytes of request & response body
+    #           failed: whether the attempt raised
+    #           retried: count a retry instead of an attempt
+
+    def count(self, endpoint, latency=None, sent=0, received=0, failed=False, retried=False):
+        with self.lock:
+            counters = self.counters.setdefault(endpoint, dict.fromkeys(TRANSPORT_COUNTERS, 0))
+            if retried:
+                counters['retries'] += 1
+                return
+            counters['requests'] += 1
+            counters['failures'] += failed
+            counters['bytessent'] += sent
+            counters['bytesreceived'] += received
+            counters['latency'] += latency
+            counters['maxlatency'] = max(counters['maxlatency'], latency)
+
+    # copy of the counters of every endpoint called so far, with their totals under 'total'
+    # latency is the total seconds spent on requests, so latency / requests is the mean
+    # return:   dict of endpoint name to dict of TRANSPORT_COUNTERS
+
+    def stats(self):
+        with self.lock:
+            stats = {endpoint : dict(counters) for endpoint, counters in self.counters.items()}
+
+        total = dict.fromkeys(TRANSPORT_COUNTERS, 0)
+        for counters in stats.values():
+            for name in TRANSPORT_COUNTERS:
+                total[name] = max(total[name], counters[name]) if name == 'maxlatency' else total[name] + counters[name]
+        stats['total'] = total
+        return stats
+
+    # close every pooled connection
+
+    def close(self):
+        self.session.close()
@@ -3,9 +3,122 @@
 # ---------------------------------------------------------------------------------------------------------------------------------------
 
 from enum import Enum
+import queue as pyqueue
+import threading
+import time
+import numpy as np
 
 BLOCK_TIMEOUT=5
 
+# how often an interruptible SPI read checks whether it should give way
+INTERRUPT_POLL_INTERVAL = 0.001
+
+# how often the virtual clock re-checks its watched conditions while a step settles
+SETTLE_POLL_INTERVAL = 0.0001
+
+# ---------------------------------------------------------------------------------------------------------------------------------------
+#   VirtualClock - step-driven time base for simulating the pedal. threads sleep on it instead of the system clock, and only wake when
+#                  a test harness advances virtual time past their deadline. each step is only over once every registered thread is
+#                  asleep again and every watched condition holds, so a step has been fully acknowledged by the time advance returns
+# ---------------------------------------------------------------------------------------------------------------------------------------
+
+class VirtualClock:
+
+    # args:     start: initial virtual time in seconds
+    #           resolution: shortest virtual sleep, so zero-length poll intervals still let time advance
+    #           timeout: real seconds to wait for a step to be acknowledged before giving up
+
+    def __init__(self, start=0.0, resolution=0.001, timeout=BLOCK_TIMEOUT):
+        self.now = start
+        self.resolution = resolution
+        self.timeout = timeout
+        self.closed = False
+
+        self.condition = threading.Condition()
+
+        # wake-up deadline of each registered thread, or None while it's busy with a step
+        self.deadlines = {}
+
+        # conditions that have to hold before a step is over, e.g. another process having taken up its commands
+        self.watches = []
+
+    def time(self):
+        return self.now
+
+    # count a thread in to every step from now on, before it's started
+    # args:     thread: thread to register, defaults to the calling thread
+
+    def register(self, thread=None):
+        with self.condition:
+            self.deadlines[thread or threading.current_thread()] = None
+
+    # count the calling thread out, once it won't sleep on the clock again
+
+    def unregister(self):
+        with self.condition:
+            self.deadlines.pop(threading.current_thread(), None)
+            self.condition.notify_all()
+
+    # args:     predicate: callable that's true once whatever it watches has caught up with a step
+
+    def watch(self, predicate):
+        self.watches.append(predicate)
+
+    # block the calling thread until virtual time has advanced by the given number of seconds
+    # returns straight away once the clock has been closed
+
+    def sleep(self, seconds):
+        thread = threading.current_thread()
+        with self.condition:
+            if self.closed:
+                return
+            self.deadlines[thread] = self.now + max(seconds, self.resolution)
+            self.condition.notify_all()
+
+            # advance clears the deadline when it wakes the thread, so it counts as busy until it sleeps again
+            self.condition.wait_for(lambda: self.closed or self.deadlines.get(thread) is None)
+
+    # advance virtual time, waking sleeping threads in deadline order and waiting for each step to settle
+    # args:     seconds: virtual time to advance by
+
+    def advance(self, seconds):
+        with self.condition:
+            target = self.now + seconds
+            while not self.closed:
+                self.settle()
+                if self.closed:
+                    break
+
+                nextdeadline = min(self.deadlines.values(), default=None)
+                if nextdeadline is None or nextdeadline > target:
+                    break
+
+                self.now = nextdeadline
+                for thread, deadline in self.deadlines.items():
+                    if deadline <= self.now:
+                        self.deadlines[thread] = None
+                self.condition.notify_all()
+
+            self.now = max(self.now, target)
+
+    # wait until every registered thread is asleep and every watched condition holds
+    # raises:   TimeoutError if that doesn't happen within the clock's timeout
+
+    def settle(self):
+        with self.condition:
+            end = time.monotonic() + self.timeout
+            while not self.closed and (None in self.deadlines.values() or not all(watch() for watch in self.watches)):
+                if time.monotonic() > end:
+                    raise TimeoutError("Virtual clock step not acknowledged within %s seconds" % self.timeout)
+                self.condition.wait(SETTLE_POLL_INTERVAL)
+
+    # release every sleeping thread for good, e.g. so pedal threads can exit
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
 class GPIO:
     class FSEL(Enum):
         INPUT   = 0
@@ -29,6 +142,14 @@ class GPIO:
                 self.val = self.queue.get(timeout=BLOCK_TIMEOUT)
             return self.val
 
+    # queued values stand in for latched edges, so there's nothing to set up
+    def detect(self):
+        pass
+
+    # whether a value is waiting to be read
+    def event(self):
+        return self.mode == GPIO.FSEL.INPUT and not self.queue.empty()
+
     def write(self, val):
         if self.mode == GPIO.FSEL.OUTPUT:
             self.queue.put(val)
@@ -43,19 +164,91 @@ class GPIO:
     def toggle(self):
         self.write(not self.val)
 
+# audio queues carry numpy blocks of samples, one queue operation per block, though single integer samples are
+# accepted too. a vrpi.PWM writing into a queue feeds a vrpi.SPI reading from it, so tests and simulations use the
+# same classes on their end of the audio processor's queues
+
 class SPI:
-    def __init__(self, queue):
+
+    # args:     queue: queue of samples to read
+    #           interrupt: callable polled while waiting for input, reads give up without any samples once it's true
+
+    def __init__(self, queue, interrupt=None):
         self.type = "spi"
         self.queue = queue
+        self.interrupt = interrupt
+
+        # samples of the last block received that haven't been read yet
+        self.pending = np.zeros(0, dtype=int)
+
+    # next non-empty queue item as an array of samples
+    # args:     timeout: seconds to wait for an item before raising queue.Empty, 0 to not wait at all
+    def receive(self, timeout=BLOCK_TIMEOUT):
+        while True:
+            samples = np.atleast_1d(np.asarray(self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait(), dtype=int))
+            if len(samples):
+                return samples
+
+    # wait for the next block of samples, giving way to the interrupt
+    # return:   whether a block arrived
+    def wait(self):
+        if self.interrupt is None:
+            self.pending = self.receive()
+            return True
+
+        deadline = time.monotonic() + BLOCK_TIMEOUT
+        while not self.interrupt():
+            try:
+                self.pending = self.receive(timeout=INTERRUPT_POLL_INTERVAL)
+                return True
+            except pyqueue.Empty:
+                if time.monotonic() > deadline:
+                    raise
+        return False
 
     def read(self):
-        return self.queue.get(timeout=BLOCK_TIMEOUT)
+        if not len(self.pending):
+            self.pending = self.receive()
+        val = int(self.pending[0])
+        self.pending = self.pending[1:]
+        return val
 
     def read_bytes(self, buflen):
-        retbuf = [0] * buflen
-        for i in range(buflen):
-            retbuf[i] = self.read()
-        return retbuf
+        retbuf = np.zeros(buflen, dtype=int)
+        self.read_full(retbuf)
+        return retbuf.tolist()
+
+    # fill a caller-supplied numpy buffer with up to len(buf) samples
+    # blocks for the first sample only, then takes whatever is already queued, so a partial block is returned
+    # rather than waiting on input that may never arrive
+    # return:   number of samples written to buf, 0 if the wait for the first one was interrupted
+    def read_block(self, buf):
+        if not len(self.pending) and not self.wait():
+            return 0
+
+        count = 0
+        while True:
+            take = min(len(buf) - count, len(self.pending))
+            buf[count : count + take] = self.pending[:take]
+            self.pending = self.pending[take:]
+            count += take
+
+            if count == len(buf):
+                return count
+            try:
+                self.pending = self.receive(timeout=0)
+            except pyqueue.Empty:
+                return count
+
+    # fill a caller-supplied numpy buffer completely, waiting on each block in turn (never interrupted)
+    # return:   number of samples written to buf
+    def read_full(self, buf):
+        count = 0
+        while count < len(buf):
+            if not len(self.pending):
+                self.pending = self.receive()
+            count += self.read_block(buf[count:])
+        return count
         
 class PWM:
     def __init__(self, queue):
@@ -65,5 +258,8 @@ class PWM:
         self.queue.put(val)
 
     def write_bytes(self, buf):
-        for val in buf:
-            self.write(val)
+        self.write_block(np.asarray(buf))
+
+    # the block is copied, since the caller reuses its buffer and a multiprocessing queue only pickles it later
+    def write_block(self, buf):
+        self.queue.put(np.array(buf))
@@ -9,8 +9,16 @@ import multiprocessing
 import signal
 import platform
 import logging
+import threading
+import tempfile
+import wave
+import unittest.mock
+import socket
+import http.server
+from io import BytesIO
 
-from pedal import pedal
+from pedal import pedal, audioprocessor, rpi, vrpi, frpi, sharedbuffers, transport
+from common import *
 
 # unit tests specifically related to pedal operation - adding and removing loops, joining sessions, etc
 # stored here so that the pedal constructor can be imported directly without triggering app/__init__.py
@@ -33,6 +41,10 @@ sublogger = logging.getLogger("%s.pedal" % __name__)
 sublogger.setLevel(logging.WARNING)
 
 
+# virtual seconds for the pedal to take up two queued button presses & releases, debounce lockouts included
+BUTTONSTEP = 0.25
+
+# runs a whole Pedal on virtual queues and virtual time, so each scenario is stepped deterministically without sleeping
 class OfflineTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -51,7 +63,11 @@ class OfflineTestCase(unittest.TestCase):
             'audioout'  : multiprocessing.Queue()
         }
 
-        self.pedal = pedal.Pedal(loggername="%s.pedal" % __name__, rpisleep=0, virtualize=True, vqueues=self.pedalvqueues, apargs={'virtualize' : True, 'vqueues' : self.apvqueues, 'itertimestamp' : True})
+        # the test's end of the audio queues
+        self.audioin = vrpi.PWM(self.apvqueues['audioin'])
+        self.audioout = vrpi.SPI(self.apvqueues['audioout'])
+
+        self.pedal = pedal.Pedal(loggername="%s.pedal" % __name__, virtualize=True, virtualtime=True, vqueues=self.pedalvqueues, apargs={'virtualize' : True, 'vqueues' : self.apvqueues, 'itertimestamp' : True, 'blocksize' : 1})
 
     def tearDown(self):
         logger.info("tearing down...")
@@ -60,114 +76,875 @@ class OfflineTestCase(unittest.TestCase):
     
     # helper methods
     def writeinputbits(self, inputbits):
-        for ib in inputbits:
-            self.apvqueues['audioin'].put(ib)
-
-    def waitonaudioin(self):
-        while not self.apvqueues['audioin'].empty():
-            logger.info("waiting on audio in...")
-            time.sleep(0.5)
+        self.audioin.write_block(inputbits)
 
     def readoutputbits(self, outputbits):
-        for obi in range(outputbits.size):
-            outputbits[obi] = self.apvqueues['audioout'].get()
+        self.audioout.read_full(outputbits)
 
     def pushbutton(self, button):
         if button in self.pedalvqueues:
             self.pedalvqueues[button].put(pedal.PUSHBUTTON_PRESS)
             self.pedalvqueues[button].put(pedal.PUSHBUTTON_RELEASE)
 
-    # multithreaded queue behavior gets so odd that the best way to avoid headaches is to undertake each test one at a time, starting a new process each time
-    def test(self):
-        testManyLoops(self)
-
-# preliminary test to ensure reading input from queue works as expected
-def testQueueInput(self):
-    inputbits   = np.random.randint(low=1, high=500, size=100)
-    outputbits  = np.zeros_like(inputbits)
-    
-    self.pedal.run()
-
-    self.writeinputbits(inputbits)
-
-    self.readoutputbits(outputbits)
-    
-    assert np.array_equal(outputbits, inputbits)
-
-def testSingleLoop(self):
-    loop            = np.random.randint(low=1, high=200, size=200)
-    postloopinput   = np.random.randint(low=1, high=200, size=200)
-    norm            = np.mean(loop, dtype=int)
-    overdub         = loop + postloopinput - norm 
-    expectedoutput  = np.append(loop, overdub)
-
-    # needs to be "pressed" before starting or else audio processor will hang on and read first input before registering to start loop
-    self.pushbutton(ADDLOOPBUTTON)
-
-    time.sleep(1)
+    # advance virtual time, returning once the pedal threads and the audio processor have caught up
+    def step(self, seconds=BUTTONSTEP):
+        self.pedal.clock.advance(seconds)
+
+    # start the pedal, and step it far enough to switch monitoring on
+    def runpedal(self):
+        self.pedal.run()
+        self.step()
+
+    # preliminary test to ensure reading input from queue works as expected
+    def testQueueInput(self):
+        inputbits   = np.random.randint(low=1, high=500, size=100)
+        outputbits  = np.zeros_like(inputbits)
+        
+        self.runpedal()
+
+        self.writeinputbits(inputbits)
+        self.readoutputbits(outputbits)
+        
+        assert np.array_equal(outputbits, inputbits)
+
+    def testSingleLoop(self):
+        loop            = np.random.randint(low=1, high=200, size=200)
+        postloopinput   = np.random.randint(low=1, high=200, size=200)
+        norm            = np.mean(loop, dtype=int)
+        overdub         = loop + postloopinput - norm 
+        expectedoutput  = np.append(loop, overdub)
+        outputbits      = np.zeros_like(expectedoutput)
+
+        self.runpedal()
 
-    self.pedal.run()
-
-    time.sleep(1)
-
-    # write all but last bit, then press button, then add last bit
-    # otherwise it will hang for post-loop audio input before registering addloopbutton
-    self.writeinputbits(loop[:-1])
+        self.pushbutton(ADDLOOPBUTTON)
+        self.step()
 
-    time.sleep(1)
+        # reading the loop's output back first makes sure all of it has been recorded before the loop is ended
+        self.writeinputbits(loop)
+        self.readoutputbits(outputbits[:loop.size])
 
-    self.pushbutton(ADDLOOPBUTTON)
+        self.pushbutton(ADDLOOPBUTTON)
+        self.step()
 
-    time.sleep(1)
+        self.writeinputbits(postloopinput)
+        self.readoutputbits(outputbits[loop.size:])
 
-    self.writeinputbits(loop[-1:])
-    self.writeinputbits(postloopinput)
+        assert np.array_equal(outputbits, expectedoutput)
 
-    outputbits = np.zeros_like(expectedoutput)
-    self.readoutputbits(outputbits)
+    def testManyLoops(self):
+        expectedoutput = np.empty(0, dtype=int)
+        outputbits = np.empty(0, dtype=int)
 
-    # print("expected: %s" % str(expectedoutput))
-    # print("recieved: %s" % str(outputbits))
+        self.runpedal()
 
-    assert np.array_equal(outputbits, expectedoutput)
+        self.pushbutton(ADDLOOPBUTTON)
+        self.step()
+
+        for i in range(5):
+            loop = np.random.randint(low=1, high=200, size=50)
+            if len(expectedoutput) >= len(loop):
+                composite = expectedoutput[-1 * loop.size:]
+                norm = np.mean(composite, dtype=int)
+                overdub = composite + loop - norm
+                expectedoutput = np.append(expectedoutput, overdub)
+            else:
+                expectedoutput = np.append(expectedoutput, loop)
+
+            loopoutput = np.zeros_like(loop)
+            self.writeinputbits(loop)
+            self.readoutputbits(loopoutput)
+            outputbits = np.append(outputbits, loopoutput)
+
+            # end this loop, and start the next one
+            self.pushbutton(ADDLOOPBUTTON)
+            if i < 4:
+                self.pushbutton(ADDLOOPBUTTON)
 
-def testManyLoops(self):
-    expectedoutput = np.empty(0, dtype=int)
+            self.step()
 
-    pedalrun = False
+        assert np.array_equal(outputbits, expectedoutput)
 
-    for i in range(5):
-        loop = np.random.randint(low=1, high=200, size=50)
-        if len(expectedoutput) >= len(loop):
-            composite = expectedoutput[-1 * loop.size:]
-            norm = np.mean(composite, dtype=int)
-            overdub = composite + loop - norm
-            expectedoutput = np.append(expectedoutput, overdub)
-        else:
-            expectedoutput = np.append(expectedoutput, loop)
+        # loops recorded offline wait in the upload queue until the pedal goes online
+        assert self.pedal.uploadstatus()['queued'] == len(self.pedal.loops) == 5
 
-        if not pedalrun:
-            self.pushbutton(ADDLOOPBUTTON)
-            time.sleep(1)
-            self.pedal.run()
-            pedalrun = True
+# stand-in for the bcm2835 library, answering SPI transfers with the given 12-bit samples
+class FakeSoc():
+    def __init__(self, samples):
+        self.samples = iter(samples)
+        self.transfers = 0
+        self.pwmdata = {}
 
-        self.writeinputbits(loop[:-1])
+    # MCP3202 replies with garbage in the high nibble of the second byte
+    def bcm2835_spi_transfernb(self, send, recv, length):
+        value = next(self.samples)
+        recv[1] = bytes([0xF0 | value >> 8])
+        recv[2] = bytes([value & 0xFF])
+        self.transfers += 1
 
-        time.sleep(1)
+    # PWM writes are recorded per channel
+    def bcm2835_pwm_set_data(self, channel, data):
+        self.pwmdata.setdefault(channel, []).append(data)
 
-        self.pushbutton(ADDLOOPBUTTON)
-        if i < 4:
-            self.pushbutton(ADDLOOPBUTTON)
+    def __getattr__(self, name):
+        return lambda *args: 1
 
-        time.sleep(2)
+# applies the real-time profile in a child process and reports what was applied
+# module-level so the process can be started under spawn and forkserver, which pickle their target
+def applyrealtimeprofile(args, resultqueue):
+    resultqueue.put(audioprocessor.applyrealtime(args))
 
-        self.writeinputbits(loop[-1:])
+# drives audioprocessor.run directly in a thread, so control changes can be placed at exact sample positions
+class AudioProcessorTestCase(unittest.TestCase):
 
-    outputbits = np.zeros_like(expectedoutput)
-    self.readoutputbits(outputbits)
+    # helper methods
 
-    assert np.array_equal(outputbits, expectedoutput)
+    # run the audio processor over a list of (input samples, control changes) phases
+    # control changes are queued while the processor waits on the final sample of their phase, so
+    # they take effect after that sample regardless of block size
+    # return:   (output samples, list of exported loops)
+    def runphases(self, phases, **apargs):
+        self.queues = {name : queue.Queue() for name in ('loop', 'audioin', 'audioout')}
+        self.logring = sharedbuffers.LogRing()
+        self.control = sharedbuffers.ControlBlock(audioprocessor.Control)
+        self.composite = sharedbuffers.CompositeBuffer(pedal.LOOP_ARRAY_DTYPE, capacity=1000)
+        self.looparena = sharedbuffers.LoopArena(pedal.LOOP_ARRAY_DTYPE, slots=4, slotcapacity=1000)
+        self.telemetry = sharedbuffers.Telemetry()
+
+        apargs.update({'virtualize' : True, 'vqueues' : {'audioin' : self.queues['audioin'], 'audioout' : self.queues['audioout']}, 'itertimestamp' : True})
+        self.audioin = vrpi.PWM(self.queues['audioin'])
+        self.audioout = vrpi.SPI(self.queues['audioout'])
+
+        self.control.put(audioprocessor.Control.ToggleMonitoring)
+        audiothread = threading.Thread(target=audioprocessor.run, args=(self.control, self.composite, self.looparena, self.telemetry, self.queues['loop'], self.logring, apargs))
+        audiothread.start()
+
+        outputbits = []
+        for inputbits, controls in phases:
+            self.feed(inputbits[:-1], outputbits)
+            for control in controls:
+                self.control.put(control)
+            self.feed(inputbits[-1:], outputbits)
+
+        # one more sample unblocks the processor so it can see the end command
+        self.control.put(audioprocessor.Control.EndProcess)
+        self.queues['audioin'].put(0)
+        audiothread.join()
+
+        loops = []
+        while not self.queues['loop'].empty():
+            loophandle = self.queues['loop'].get()
+            loops.append(self.looparena.retain(loophandle))
+            assert loophandle.total == loops[-1]['value'].sum()
+
+        assert not self.control.flag(audioprocessor.Control.EndProcess)
+
+        # every sample fed in (including the one that unblocks the end command) was counted, in blocks whose processing times all landed in the histogram
+        telemetry = self.telemetry.snapshot()
+        assert telemetry['samples'] == sum(len(inputbits) for inputbits, _ in phases) + 1
+        assert sum(telemetry['blocktimes']) == telemetry['blocks'] > 0
+        self.telemetry.close()
+
+        assert self.logring.drain()[0] == (logging.INFO, "AudioProcessor - Starting execution...")
+        self.logring.close()
+
+        self.control.close()
+        self.composite.close()
+        self.looparena.close()
+
+        return np.array(outputbits), loops
+
+    def feed(self, inputbits, outputbits):
+        if len(inputbits):
+            self.audioin.write_block(inputbits)
+            block = np.zeros(len(inputbits), dtype=int)
+            self.audioout.read_full(block)
+            outputbits.extend(block.tolist())
+
+    # reference copy of the original sample-by-sample audio loop, with itertimestamp timing and monitoring on
+    # runs over the same phases as runphases, each phase's control changes taking effect after its final sample
+    # return:   (output samples, list of exported loops)
+    def runbaseline(self, phases):
+        dtype = [('value', int), ('timestamp', float)]
+        compositeindex = lastcompositeindex = compositepassstart = compositenorm = loopindex = looprecstart = passtime = 0
+        compositedata = np.zeros(10000, dtype=dtype)
+        loopdata = np.zeros(10000, dtype=dtype)
+        emptycomposite = True
+        recording = False
+
+        outputbits = []
+        loops = []
+        for inputphase, controls in phases:
+            for inputbits in inputphase:
+                passtime += 1
+                outputbits.append(inputbits)
+
+                if emptycomposite:
+                    compositeindex = lastcompositeindex = compositepassstart = 0
+
+                    if recording:
+                        if not looprecstart:
+                            looprecstart = passtime
+                        loopdata[loopindex] = compositedata[loopindex] = (inputbits, passtime - looprecstart)
+                        loopindex += 1
+
+                else:
+                    if not compositepassstart or compositeindex >= len(compositedata) - 1:
+                        compositeindex = 0
+                        compositepassstart = passtime
+
+                    inputtimestamp = passtime - compositepassstart
+
+                    lastcompositeindex = compositeindex
+                    while compositeindex < len(compositedata) - 1 and inputtimestamp > compositedata[compositeindex + 1]['timestamp']:
+                        compositeindex += 1
+                    compositeindex = compositeindex if (compositeindex == len(compositedata) - 1 or inputtimestamp - compositedata[compositeindex]['timestamp'] <= compositedata[compositeindex + 1]['timestamp'] - inputtimestamp) else compositeindex + 1
+
+                    outputbits[-1] = inputbits + compositedata['value'][compositeindex] - compositenorm
+
+                    if recording:
+                        if lastcompositeindex == compositeindex:
+                            compositedata['value'][compositeindex] += inputbits - compositenorm
+                        elif lastcompositeindex < compositeindex:
+                            compositedata['value'][lastcompositeindex + 1 : compositeindex + 1] += inputbits - compositenorm
+                        else:
+                            compositedata['value'][lastcompositeindex + 1 : ] += inputbits - compositenorm
+                            compositedata['value'][ : compositeindex + 1] += inputbits - compositenorm
+
+                        loopdata[loopindex] = (inputbits, inputtimestamp)
+                        loopindex += 1
+
+            for control in controls:
+                if control == audioprocessor.Control.ToggleRecording:
+                    if recording:
+                        loops.append(loopdata[:loopindex].copy())
+                        if emptycomposite:
+                            compositedata = compositedata[:loopindex]
+                            emptycomposite = False
+                        compositenorm = np.mean(compositedata['value'], dtype=int)
+                        loopindex = 0
+                        loopdata = np.zeros(10000, dtype=dtype)
+                    else:
+                        looprecstart = 0
+                    recording = not recording
+
+        return np.array(outputbits), loops
+
+    # block processing has to match the original sample-by-sample processing exactly, at any block size, including
+    # overdubs longer than the composite. inputs are kept small enough that no overdub reaches the limits of the stored
+    # values, which the original loop (with unbounded values) didn't have
+    def testBlockMatchesSample(self):
+        toggle = audioprocessor.Control.ToggleRecording
+        phases = [(np.random.randint(low=1, high=1000, size=size), controls) for size, controls in [(20, [toggle]), (37, [toggle]), (10, [toggle]), (300, [toggle, toggle]), (500, [toggle]), (90, [])]]
+
+        baselineoutput, baselineloops = self.runbaseline(phases)
+        assert len(baselineloops) == 3
+
+        for blocksize in (1, 64, audioprocessor.AUDIO_BLOCK_SIZE):
+            blockoutput, blockloops = self.runphases(phases, blocksize=blocksize)
+
+            assert np.array_equal(baselineoutput, blockoutput)
+            assert len(blockloops) == len(baselineloops)
+            for baselineloop, blockloop in zip(baselineloops, blockloops):
+                assert np.array_equal(baselineloop['value'], blockloop['value'])
+                assert np.array_equal(baselineloop['timestamp'], blockloop['timestamp'])
+
+    # bucket lookups have to agree with a binary search over jittered timestamps, wherever the playhead lands
+    def testCompositeIndex(self):
+        timestamps = np.cumsum(np.random.uniform(low=0.5, high=1.5, size=1000) / 44100)
+        playhead = np.sort(np.random.uniform(low=-0.01, high=timestamps[-1] + 0.01, size=500))
+        compositeindex = pedal.CompositeIndex(timestamps)
+
+        assert np.array_equal(compositeindex.countbefore(playhead), np.searchsorted(timestamps, playhead, side="left"))
+
+        before = np.clip(np.searchsorted(timestamps, playhead, side="left") - 1, 0, timestamps.size - 1)
+        after = np.minimum(before + 1, timestamps.size - 1)
+        nearest = np.where(playhead - timestamps[before] > timestamps[after] - playhead, after, before)
+        assert np.array_equal(compositeindex.lookup(playhead), np.maximum.accumulate(nearest))
+
+    # recording buffers are only reallocated when the sample rate outgrows them, and give back their tail when finalized
+    def testRecordingBuffer(self):
+        recordingbuffer = audioprocessor.RecordingBuffer(pedal.LOOP_ARRAY_DTYPE)
+
+        compositedata = recordingbuffer.plan(0.01)
+        assert compositedata.size >= pedal.MAX_LOOP_DURATION * 100
+        assert recordingbuffer.plan(0.02) is compositedata
+
+        compositedata['value'] = 1
+        compositedata = recordingbuffer.finalize(10)
+        assert compositedata.size == 10 and np.all(compositedata['value'] == 1)
+
+        # released pages read back as zeros
+        assert np.all(recordingbuffer.data['value'][-100:] == 0)
+
+        assert recordingbuffer.plan(0.001).size >= pedal.MAX_LOOP_DURATION * 1000
+
+    # the index laid out while recording finds the same samples as one built over the finished recording
+    def testRecordingIndex(self):
+        recordingbuffer = audioprocessor.RecordingBuffer(pedal.LOOP_ARRAY_DTYPE)
+        compositedata = recordingbuffer.plan(1 / 44100)
+
+        timestamps = np.concatenate(([0], np.cumsum(np.random.uniform(low=0.5, high=1.5, size=9999) / 44100)))
+        for start in range(0, timestamps.size, 128):
+            count = min(128, timestamps.size - start)
+            compositedata['timestamp'][start : start + count] = timestamps[start : start + count]
+            recordingbuffer.record(start, count)
+
+        compositedata = recordingbuffer.finalize(timestamps.size)
+        compositelookup = recordingbuffer.lookup(timestamps.size)
+        playhead = np.sort(np.random.uniform(low=-0.01, high=timestamps[-1] + 0.01, size=500))
+        assert np.array_equal(compositelookup.lookup(playhead), pedal.CompositeIndex(compositedata['timestamp']).lookup(playhead))
+
+    # loop handles read in place until their slot is recorded over
+    def testLoopArena(self):
+        looparena = sharedbuffers.LoopArena(pedal.LOOP_ARRAY_DTYPE, slots=2, slotcapacity=100)
+
+        handles = []
+        for i in range(3):
+            loopdata = looparena.begin()
+            loopdata['value'][:10 + i] = i
+            handles.append(looparena.handle(10 + i))
+
+        assert looparena.view(handles[0]) is None and looparena.retain(handles[0]) is None
+        for i in (1, 2):
+            loopdata = looparena.view(handles[i])
+            assert loopdata.size == 10 + i and np.all(loopdata['value'] == i)
+            assert np.shares_memory(loopdata, looparena.samples)
+            assert not np.shares_memory(looparena.retain(handles[i]), looparena.samples)
+
+        del loopdata
+        looparena.close()
+
+    # only the newest of several published composites is taken up, as a view into shared memory
+    def testCompositeBuffer(self):
+        compositebuffer = sharedbuffers.CompositeBuffer(pedal.LOOP_ARRAY_DTYPE, capacity=100)
+        composites = [np.zeros(size, dtype=pedal.LOOP_ARRAY_DTYPE) for size in (10, 20, 30)]
+        for i, composite in enumerate(composites):
+            composite['value'] = np.random.randint(low=1, high=4000, size=composite.size)
+            composite['timestamp'] = np.arange(composite.size) + i
+
+        assert compositebuffer.swap() == (False, None, None, None)
+
+        for composite in composites:
+            compositebuffer.put(composite)
+
+        swapped, composite, compositesum, compositelookup = compositebuffer.swap()
+        assert swapped and np.array_equal(composite, composites[-1])
+        assert compositesum == scannorm(composites[-1])
+        assert np.shares_memory(composite, compositebuffer.slots)
+        assert np.shares_memory(compositelookup.bucketstarts, compositebuffer.bucketstarts)
+        playhead = np.linspace(-1, 40, 100)
+        assert np.array_equal(compositelookup.lookup(playhead), pedal.CompositeIndex(composites[-1]['timestamp']).lookup(playhead))
+        assert compositebuffer.swap() == (False, None, None, None)
+
+        # the slot being played is never written to
+        compositebuffer.put(composites[0])
+        assert np.array_equal(composite, composites[-1])
+
+        assert compositebuffer.swap()[1].size == composites[0].size
+
+        compositebuffer.put(None)
+        assert compositebuffer.swap() == (True, None, CompositeNorm(), None)
+
+        del composite, compositelookup
+        compositebuffer.close()
+
+    # taking up a full-length composite only swaps references, however long the composite is
+    def testCompositeSwapTime(self):
+        compositebuffer = sharedbuffers.CompositeBuffer(pedal.LOOP_ARRAY_DTYPE)
+        composite = np.zeros(compositebuffer.capacity, dtype=pedal.LOOP_ARRAY_DTYPE)
+        composite['timestamp'] = np.arange(composite.size) / sharedbuffers.MAX_SAMPLE_RATE
+        compositebuffer.put(composite, CompositeNorm(0, composite.size))
+
+        swapstart = time.perf_counter()
+        swapped, composite, compositesum, compositelookup = compositebuffer.swap()
+        compositelookup.lookup(np.arange(audioprocessor.AUDIO_BLOCK_SIZE) / 44100 + 60)
+        assert swapped and time.perf_counter() - swapstart < 0.01
+
+        del composite, compositelookup
+        compositebuffer.close()
+
+    # chained deltas patch an old composite into the current one, in the shared composite buffer
+    def testCompositeDelta(self):
+        versions = [np.zeros(1000, dtype=pedal.LOOP_ARRAY_DTYPE)]
+        versions[0]['value'] = np.random.randint(low=1, high=4000, size=1000)
+        versions[0]['timestamp'] = np.arange(1000) / 8000
+        for _ in range(2):
+            loop = np.zeros(100, dtype=pedal.LOOP_ARRAY_DTYPE)
+            loop['value'] = np.random.randint(low=1, high=4000, size=100)
+            loop['timestamp'] = np.random.uniform(0, versions[0]['timestamp'][-1], 100)
+            loop.sort(order="timestamp")
+            versions.append(mergeloops(versions[-1], loop)[0])
+
+        deltas = [savedelta(old, new) for old, new in zip(versions, versions[1:])]
+        delta = chaindeltas(deltas)
+        assert len(delta) < len(saveloop(versions[-1]))
+
+        starts, lengths, values, compositesum = loaddelta(delta)
+        assert compositesum == scannorm(versions[-1])
+        patched = versions[0].copy()
+        applydelta(patched, starts, lengths, values)
+        assert np.array_equal(patched, versions[-1])
+
+        # only a full composite can change the timestamps
+        assert savedelta(versions[0], versions[0][:-1]) is None
+
+        compositebuffer = sharedbuffers.CompositeBuffer(pedal.LOOP_ARRAY_DTYPE, capacity=1000)
+        compositebuffer.put(versions[0])
+        playing = compositebuffer.swap()[1]
+        assert compositebuffer.patch(*loaddelta(delta))
+        assert np.array_equal(playing, versions[0])
+
+        swapped, composite, compositesum, compositelookup = compositebuffer.swap()
+        assert swapped and np.array_equal(composite, versions[-1]) and compositesum == scannorm(versions[-1])
+        playhead = np.linspace(0, versions[0]['timestamp'][-1], 300)
+        assert np.array_equal(compositelookup.lookup(playhead), pedal.CompositeIndex(versions[0]['timestamp']).lookup(playhead))
+
+        assert not compositebuffer.patch(*loaddelta(savedelta(versions[0][:10], versions[1][:10])))
+
+        del playing, composite, compositelookup
+        compositebuffer.close()
+
+    # commands are taken up in order, so back-to-back toggles are both seen, and the ring never overflows
+    def testControlBlock(self):
+        controlblock = sharedbuffers.ControlBlock(audioprocessor.Control, capacity=4)
+        toggle = audioprocessor.Control.ToggleRecording
+
+        assert not controlblock.pending() and controlblock.get() is None
+
+        writer = threading.Thread(target=lambda: [controlblock.put(command) for command in [toggle] * 9 + [audioprocessor.Control.EndProcess]])
+        writer.start()
+
+        commands = []
+        while len(commands) < 10:
+            command = controlblock.get()
+            if command is not None:
+                commands.append(command)
+        writer.join()
+
+        assert commands == [toggle] * 9 + [audioprocessor.Control.EndProcess]
+        assert not controlblock.pending()
+
+        # a sequence number seen before its entry leaves the stale entry there alone until the new one shows up
+        controlblock.header[sharedbuffers.CONTROL_SEQUENCE] += 1
+        assert controlblock.pending() and controlblock.get() is None
+        controlblock.header[sharedbuffers.CONTROL_SEQUENCE] -= 1
+
+        controlblock.setflag(toggle, True)
+        assert controlblock.flag(toggle) and not controlblock.flag(audioprocessor.Control.ToggleMonitoring)
+
+        # a full ring raises instead of waiting for ever on a reader that's gone or stuck
+        for _ in range(4):
+            controlblock.put(toggle, alive=lambda: False)
+        with self.assertRaises(BrokenPipeError):
+            controlblock.put(audioprocessor.Control.EndProcess, alive=lambda: False)
+        with self.assertRaises(TimeoutError):
+            controlblock.put(audioprocessor.Control.EndProcess, timeout=0.01)
+        assert controlblock.backlog() == 4
+
+        controlblock.close()
+
+    # the sample clock follows a sample rate that differs from the assumed one, and slews its drift back to zero
+    def testSampleClock(self):
+        # monotonic readings at 48 kHz, with a little scheduling jitter
+        source = {'now' : 0}
+        clock = audioprocessor.SampleClock(source=lambda: source['now'] + np.random.randint(-20000, 20000))
+
+        timestamps = []
+        for _ in range(4000):
+            source['now'] += 64 * 1e9 / 48000
+            timestamps.append(clock.tick(64))
+        timestamps = np.concatenate(timestamps)
+
+        assert abs(clock.rate() - 48000) < 10
+        assert abs(clock.drift) < 0.001
+        assert np.all(np.diff(timestamps) > 0)
+
+        # time keeps passing while idle, and the clock picks up from the monotonic clock afterwards
+        clock.idle()
+        source['now'] += 5e9
+        assert clock.tick(1)[0] > timestamps[-1] + 4.9
+
+    # files are processed at full speed until the input runs out, against a composite timed on the file's sample rate
+    def testFileBackend(self):
+        inputbits = np.random.randint(low=1, high=4000, size=5000)
+        composite = np.zeros(100, dtype=LOOP_ARRAY_DTYPE)
+        composite['value'] = np.random.randint(low=1, high=4000, size=composite.size)
+        composite['timestamp'] = np.arange(composite.size) / 8000
+
+        with tempfile.TemporaryDirectory() as directory:
+            # 16-bit WAV input at 8 kHz, which loses nothing of the 12-bit samples
+            inpath = os.path.join(directory, "in.wav")
+            with wave.open(inpath, "wb") as wavfile:
+                wavfile.setnchannels(2)
+                wavfile.setsampwidth(2)
+                wavfile.setframerate(8000)
+                wavfile.writeframes(np.repeat((inputbits - 2048) << 4, 2).astype('<i2').tobytes())
+
+            outpath = os.path.join(directory, "out.npy")
+
+            controlblock = sharedbuffers.ControlBlock(audioprocessor.Control)
+            compositebuffer = sharedbuffers.CompositeBuffer(LOOP_ARRAY_DTYPE, capacity=1000)
+            looparena = sharedbuffers.LoopArena(LOOP_ARRAY_DTYPE, slots=2, slotcapacity=1000)
+            telemetry = sharedbuffers.Telemetry()
+            logring = sharedbuffers.LogRing()
+
+            compositebuffer.put(composite)
+            controlblock.put(audioprocessor.Control.ToggleMonitoring)
+            audioprocessor.run(controlblock, compositebuffer, looparena, telemetry, queue.Queue(), logring, {'files' : {'audioin' : inpath, 'audioout' : outpath}, 'blocksize' : 256})
+
+            outputbits = np.load(outpath)
+            assert telemetry.snapshot()['samples'] == inputbits.size
+
+            for sharedbuffer in (controlblock, compositebuffer, looparena, telemetry, logring):
+                sharedbuffer.close()
+
+        # the composite repeats every 100 samples at 8 kHz
+        assert np.array_equal(outputbits, inputbits + np.tile(composite['value'], 50) - np.mean(composite['value'], dtype=int))
+
+    # bursts of SPI conversions decode into the caller's buffer, growing the transfer buffers only when outgrown
+    def testSPIBurst(self):
+        samples = np.random.randint(low=0, high=4096, size=1000)
+        fakesoc = FakeSoc(samples)
+
+        with unittest.mock.patch.multiple(rpi, soc=fakesoc, soc_init=False, spi_init=False):
+            spi = rpi.SPI()
+
+            buf = np.zeros(100, dtype=int)
+            windows = spi.recv_windows
+            assert spi.read_block(buf) == 100 and np.array_equal(buf, samples[:100])
+            assert spi.recv_windows is windows
+
+            buf = np.zeros(rpi.SPI_BURST_SAMPLES + 100, dtype=int)
+            assert spi.read_block(buf) == buf.size and np.array_equal(buf, samples[100:buf.size + 100])
+
+            assert spi.read() == samples[buf.size + 100]
+            assert fakesoc.transfers == buf.size + 101
+
+            del spi
+
+    # block writes split samples over both PWM channels exactly like single writes, clipping out-of-range sums
+    def testPWMBlock(self):
+        samples = np.concatenate(([-500, 0, 4095, 5000], np.random.randint(low=0, high=4096, size=100)))
+        fakesoc = FakeSoc([])
+
+        with unittest.mock.patch.multiple(rpi, soc=fakesoc, soc_init=False, pwm_init=False):
+            pwm = rpi.PWM((18, 13))
+            pwm.write_block(samples)
+            blockdata = fakesoc.pwmdata
+            fakesoc.pwmdata = {}
+
+            for sample in samples.tolist():
+                pwm.write(sample)
+            assert fakesoc.pwmdata == blockdata
+
+            del pwm
+
+        clipped = np.clip(samples, 0, 4095)
+        assert np.array_equal((np.array(blockdata[0]) << 6) | np.array(blockdata[1]), clipped)
+
+    # virtual audio blocks and single samples read back in order across block boundaries
+    def testVirtualBlocks(self):
+        samplequeue = queue.Queue()
+        writer, reader = vrpi.PWM(samplequeue), vrpi.SPI(samplequeue)
+        samples = np.random.randint(low=0, high=4096, size=100)
+
+        writer.write_block(samples[:40])
+        writer.write(int(samples[40]))
+        writer.write_block(np.array([], dtype=int))
+        writer.write_block(samples[41:])
+
+        buf = np.zeros(30, dtype=int)
+        assert reader.read_block(buf) == 30 and np.array_equal(buf, samples[:30])
+        assert reader.read() == samples[30]
+        assert reader.read_block(buf) == 30 and np.array_equal(buf, samples[31:61])
+
+        rest = np.zeros(39, dtype=int)
+        assert reader.read_full(rest) == 39 and np.array_equal(rest, samples[61:])
+        assert samplequeue.empty()
+
+    # threads on a virtual clock wake in deadline order, and each step is acknowledged before advance returns
+    def testVirtualClock(self):
+        clock = vrpi.VirtualClock()
+        wakes = []
+
+        def sleeper(name, interval):
+            while True:
+                clock.sleep(interval)
+                if clock.closed:
+                    break
+                wakes.append((clock.time(), name))
+            clock.unregister()
+
+        threads = [threading.Thread(target=sleeper, args=args) for args in (("fast", 0.25), ("slow", 1))]
+        for thread in threads:
+            clock.register(thread)
+            thread.start()
+
+        # threads woken by the same step run alongside each other, so only their wake times are ordered
+        clock.advance(1)
+        assert [wake[0] for wake in wakes] == [0.25, 0.5, 0.75, 1, 1]
+        assert sorted(wakes) == [(0.25, "fast"), (0.5, "fast"), (0.75, "fast"), (1, "fast"), (1, "slow")]
+
+        clock.advance(0.1)
+        assert len(wakes) == 5 and clock.time() == 1.1
+
+        clock.close()
+        for thread in threads:
+            thread.join()
+
+    # input changes are reported once, straight away, and changes during the lockout wait until it's over
+    def testDebouncer(self):
+        gpioqueue = queue.Queue()
+        debouncer = pedal.Debouncer(vrpi.GPIO(gpioqueue, vrpi.GPIO.FSEL.INPUT, pedal.PUSHBUTTON_RELEASE), lockout=0.05)
+        assert debouncer.poll(0) is None
+
+        gpioqueue.put(pedal.PUSHBUTTON_PRESS)
+        assert debouncer.poll(0.01) == pedal.PUSHBUTTON_PRESS
+        assert debouncer.poll(0.02) is None
+
+        gpioqueue.put(pedal.PUSHBUTTON_RELEASE)
+        assert debouncer.poll(0.03) is None and debouncer.level == pedal.PUSHBUTTON_PRESS
+        assert debouncer.poll(0.07) == pedal.PUSHBUTTON_RELEASE
+
+        # a repeated level is no change
+        gpioqueue.put(pedal.PUSHBUTTON_RELEASE)
+        assert debouncer.poll(0.2) is None and gpioqueue.empty()
+
+    # a full log ring drops and counts new records instead of blocking, and drains oldest first
+    def testLogRing(self):
+        logring = sharedbuffers.LogRing(capacity=4)
+
+        for i in range(6):
+            assert logring.put(logging.INFO, "record %d", i) == (i < 4)
+        assert logring.backlog() == 4 and logring.dropped() == 2
+
+        assert logring.drain(3) == [(logging.INFO, "record %d" % i) for i in range(3)]
+        assert logring.put(logging.WARNING, "x" * 1000)
+        assert logring.drain() == [(logging.INFO, "record 3"), (logging.WARNING, "x" * sharedbuffers.LOG_RECORD_BYTES)]
+        assert logring.drain() == []
+
+        # messages are encoded once, and only the numbers change from record to record
+        for i in range(3):
+            logring.put(logging.INFO, "clock: %f Hz, drift %f ms", 44100.5 + i, -0.25)
+        assert len(logring.messages) == 3
+        assert logring.drain() == [(logging.INFO, "clock: %f Hz, drift %f ms" % (44100.5 + i, -0.25)) for i in range(3)]
+
+        # arguments that don't fit the message leave it unformatted
+        assert logring.put(logging.INFO, "%d %d %d %d %d", 1, 2, 3, 4, 5)
+        assert logring.drain() == [(logging.INFO, "%d %d %d %d %d")]
+
+        logring.close()
+
+    # every real-time knob is either applied or reported as skipped, in a child process so the test runner is untouched
+    def testRealtimeProfile(self):
+        args = dict(audioprocessor.AP_KW_DEFAULTS)
+        args.update({'realtime' : True, 'rtcpu' : 0})
+        resultqueue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=applyrealtimeprofile, args=(args, resultqueue))
+        process.start()
+        applied, skipped = resultqueue.get(timeout=10)
+        process.join()
+
+        assert len(applied) + len(skipped) == 4
+        assert "gc frozen" in applied
+        assert "pinned to cpu 0" in applied or not hasattr(os, "sched_setaffinity")
+
+    # plain .npy payloads of older format versions are still readable, and come back in the current format
+    def testLoopFormat(self):
+        legacy = np.zeros(50, dtype=LOOP_FORMATS[1])
+        legacy['value'] = np.arange(50) * 80
+        legacy['timestamp'] = np.arange(50) / 44100
+        legacyfile = BytesIO()
+        np.save(legacyfile, legacy)
+
+        loopdata, loopsum = loadloop(legacyfile.getvalue())
+        assert loopdata.dtype == LOOP_ARRAY_DTYPE
+        assert np.array_equal(loopdata['value'], legacy['value'])
+        assert np.allclose(loopdata['timestamp'], legacy['timestamp'])
+        assert loopsum == CompositeNorm(legacy['value'].sum(), legacy.size)
+
+        # the value sum travels with the payload instead of being rescanned
+        payload = saveloop(loopdata, CompositeNorm(12345, loopdata.size))
+        assert len(payload) < len(legacyfile.getvalue()) / 2
+        reloaded, reloadedsum = loadloop(payload)
+        assert np.array_equal(reloaded, loopdata) and reloadedsum == CompositeNorm(12345, loopdata.size)
+
+        with self.assertRaises(ValueError):
+            toloopformat(np.zeros(5))
+
+        # sorting on the timestamps alone gives the same order as sorting the whole structured array
+        shuffled = loopdata[np.random.permutation(loopdata.size)]
+        assert np.array_equal(sortloop(shuffled), np.sort(shuffled, order="timestamp"))
+
+    # queued loops stay queued until they're uploaded or cancelled, and spooled ones are found again by a new queue
+    def testUploadQueue(self):
+        with tempfile.TemporaryDirectory() as spool:
+            uploads = pedal.UploadQueue(spool)
+            assert uploads.put(1) and uploads.put(2, payload=b"loop 2") and not uploads.put(1)
+
+            # a loop that comes serialized is on disk as soon as it's queued, so a restarted pedal uploads it
+            assert pedal.UploadQueue(spool).load() == [(2, b"loop 2")]
+
+            # the rest are serialized and spooled before anything is uploaded, whether or not there's a session yet
+            job = uploads.prepare()
+            assert job.loopindex == 1 and job.attempts == 0
+            job.payload = b"loop 1"
+            uploads.save(job)
+            uploads.finish(job, pedal.UPLOAD_QUEUED)
+            assert uploads.prepare() is None
+            assert sorted(pedal.UploadQueue(spool).load()) == [(1, b"loop 1"), (2, b"loop 2")]
+
+            # a loop the server can't be reached for goes back to the front of the queue
+            assert uploads.take() is job
+            uploads.finish(job, pedal.UPLOAD_QUEUED)
+            assert len(uploads) == 2 and uploads.take() is job and job.attempts == 2
+
+            uploads.finish(job, pedal.UPLOAD_DONE)
+            assert pedal.UploadQueue(spool).load() == [(2, b"loop 2")] and len(uploads) == 1
+
+            assert uploads.cancel(2) and not uploads.cancel(2) and uploads.take() is None
+            status = uploads.status()
+            assert status['queued'] == 0
+            assert [(job['index'], job['state'], job['bytes']) for job in status['jobs']] == [(1, pedal.UPLOAD_DONE, 6), (2, pedal.UPLOAD_CANCELLED, 6)]
+
+    # requests share one kept-alive connection, and only requests that certainly never reached the server are retried
+    def testServerTransport(self):
+        clientports = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                clientports.append(self.client_address[1])
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(SUCCESS_RETURN)))
+                self.end_headers()
+                self.wfile.write(SUCCESS_RETURN.encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        servertransport = transport.ServerTransport("http://127.0.0.1:%d/" % server.server_address[1])
+        for _ in range(3):
+            assert servertransport.post("getsession", data={'mac' : "00:00:00:00:00:00"}).text == SUCCESS_RETURN
+        servertransport.post("addloop", data={'index' : 0}, files={'npdata' : BytesIO(b"x" * 1000)})
+        assert len(clientports) == 4 and len(set(clientports)) == 1
+
+        stats = servertransport.stats()
+        assert stats['getsession']['requests'] == 3 and stats['getsession']['bytesreceived'] == 3 * len(SUCCESS_RETURN)
+        assert stats['addloop']['bytessent'] > 1000 and stats['total']['requests'] == 4 and stats['total']['failures'] == 0
+
+        servertransport.close()
+        server.shutdown()
+        server.server_close()
+
+        # nothing listens on a freshly closed port, so every attempt is refused before it's sent
+        with socket.socket() as closed:
+            closed.bind(("127.0.0.1", 0))
+            port = closed.getsockname()[1]
+        backoffs = []
+        offlinetransport = transport.ServerTransport("http://127.0.0.1:%d/" % port, sleep=backoffs.append)
+        with self.assertRaises(transport.OFFLINE_ERRORS):
+            offlinetransport.post("addloop", data={'index' : 0})
+        stats = offlinetransport.stats()['addloop']
+        assert stats['requests'] == stats['failures'] == transport.TRANSPORT_RETRIES + 1 and stats['retries'] == transport.TRANSPORT_RETRIES
+        assert len(backoffs) == transport.TRANSPORT_RETRIES and all(0 <= backoff <= transport.TRANSPORT_MAX_BACKOFF for backoff in backoffs)
+        offlinetransport.close()
+
+    # encoded payloads come back exactly as saved, several times smaller, in whichever encoding was negotiated
+    def testLoopEncoding(self):
+        loopdata = np.zeros(44100, dtype=LOOP_ARRAY_DTYPE)
+        loopdata['value'] = 2048 + 1500 * np.sin(np.arange(44100) / 20) + np.random.randint(-20, 20, 44100)
+        loopdata['timestamp'] = np.arange(44100) / 44100
+
+        for encoding in LOOP_ENCODINGS:
+            payload = encodeloop(loopdata, encoding=encoding)
+            assert loopencoding(payload) == encoding
+            assert len(payload) < len(saveloop(loopdata)) / 4
+            decoded, decodedsum = loadloop(payload)
+            assert np.array_equal(decoded, loopdata) and decodedsum == scannorm(loopdata)
+
+        # deltas wrap around, so arbitrary values and unsorted timestamps survive too
+        noise = np.zeros(100, dtype=LOOP_ARRAY_DTYPE)
+        noise['value'] = np.random.randint(-32768, 32767, 100)
+        noise['timestamp'] = np.random.uniform(0, MAX_LOOP_DURATION, 100)
+        assert np.array_equal(loadloop(encodeloop(noise))[0], noise)
+
+        assert acceptedencodings("gzip, x-sloop-lzma;q=0, x-sloop-zlib;q=0.5") == ["x-sloop-zlib"]
+        assert acceptedencodings(None) == []
+
+        payload = encodeloop(loopdata)
+        assert negotiateloop(payload, [LOOP_STORE_ENCODING])[0] is payload
+        assert loopencoding(negotiateloop(payload, ["x-sloop-lzma"])[0]) == "x-sloop-lzma"
+        assert negotiateloop(payload, [])[1] is None and loopencoding(negotiateloop(payload, [])[0]) is None
+
+        with self.assertRaises(ValueError):
+            loadloop(payload[:-10])
+
+    # a loop's hash doesn't depend on how it was sent, and bundles come apart into the payloads put in
+    def testLoopBundle(self):
+        loops = {}
+        for loopindex in range(1, 4):
+            loops[loopindex] = np.zeros(100 * loopindex, dtype=LOOP_ARRAY_DTYPE)
+            loops[loopindex]['value'] = np.random.randint(low=1, high=4000, size=100 * loopindex)
+            loops[loopindex]['timestamp'] = np.arange(100 * loopindex) / 44100
+
+        legacy = loops[1].astype(LOOP_FORMATS[1])
+        assert loophash(legacy) == loophash(loops[1]) == loophash(loadloop(encodeloop(loops[1]))[0])
+        changed = loops[1].copy()
+        changed['value'][50] += 1
+        assert loophash(changed) != loophash(loops[1])
+
+        bundle = packloops([(loopindex, encodeloop(loopdata)) for loopindex, loopdata in loops.items()])
+        unpacked = {loopindex : loadloop(payload)[0] for loopindex, payload in unpackloops(bundle)}
+        assert unpacked.keys() == loops.keys() and all(np.array_equal(unpacked[loopindex], loops[loopindex]) for loopindex in loops)
+        assert unpackloops(b"") == []
+
+        with self.assertRaises(ValueError):
+            unpackloops(bundle[:-1])
+
+    # running sums kept by overdubs and merges have to match a rescan of the composite
+    def testCompositeNorm(self):
+        composite = np.zeros(200, dtype=LOOP_ARRAY_DTYPE)
+        composite['value'] = np.random.randint(low=1, high=4000, size=composite.size)
+        composite['timestamp'] = np.arange(composite.size) / 100
+        compositesum = scannorm(composite)
+        assert compositesum.value() == np.mean(composite['value'], dtype=int)
+
+        indices = np.sort(np.random.randint(low=5, high=150, size=80))
+        audioprocessor.overdub(composite['value'], indices, 5, np.random.randint(low=-2000, high=2000, size=indices.size), compositesum)
+        assert compositesum == scannorm(composite)
+
+        loop = np.zeros(300, dtype=LOOP_ARRAY_DTYPE)
+        loop['value'] = np.random.randint(low=1, high=4000, size=loop.size)
+        loop['timestamp'] = np.sort(np.random.uniform(low=0, high=2.5, size=loop.size))
+        merged, mergedsum = mergeloops(composite, loop, compositesum)
+        assert mergedsum == scannorm(merged) and compositesum == scannorm(composite)
+
+    # overdubs and merges near the limits of the stored values saturate instead of wrapping around, and the running
+    # sums follow the saturated values
+    def testOverdubLimits(self):
+        composite = np.zeros(10, dtype=LOOP_ARRAY_DTYPE)
+        composite['value'] = [30000] * 5 + [-30000] * 5
+        composite['timestamp'] = np.arange(composite.size)
+        compositesum = scannorm(composite)
+
+        played = audioprocessor.overdub(composite['value'], np.array([2, 2, 7]), 1, np.array([4000, 4000, -4000]), compositesum)
+        assert np.array_equal(played, [30000, 32767, -30000])
+        assert composite['value'][2] == 32767 and np.all(composite['value'][3:8] == [26000, 26000, -32768, -32768, -32768])
+        assert compositesum == scannorm(composite)
+
+        loop = np.zeros(10, dtype=LOOP_ARRAY_DTYPE)
+        loop['value'] = [8000] * 5 + [-8000] * 5
+        loop['timestamp'] = np.arange(loop.size)
+        merged, mergedsum = mergeloops(composite, loop, compositesum)
+        assert np.all(merged['value'][1:5] == 32767) and np.all(merged['value'][5:] == -32768)
+        assert mergedsum == scannorm(merged)
 
 if __name__ == "__main__":
     unittest.main()
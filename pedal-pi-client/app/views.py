@@ -130,6 +130,16 @@ def getmembers():
 def getloops():
     return flask.make_response(flask.jsonify(sorted(list(pedal.loops.keys()))), SUCCESS_CODE)
 
+# get the progress of loops queued for upload to the server, and of the most recent uploads
+@flaskapp.route("/getuploads")
+def getuploads():
+    return flask.make_response(flask.jsonify(pedal.uploadstatus()), SUCCESS_CODE)
+
+# get live audio processor telemetry: sample rate, block processing times, late & dropped samples, queue depths
+@flaskapp.route("/gettelemetry")
+def gettelemetry():
+    return flask.make_response(flask.jsonify(pedal.telemetry()), SUCCESS_CODE)
+
 # -------------------------------
 #   Static Fileserver Endpoints
 # -------------------------------
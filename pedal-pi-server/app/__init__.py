@@ -41,13 +41,22 @@ idle_td = td(hours=MAX_SESSION_IDLE)
 # delete orphaned and idle sessions (where no new loop has been submitted in the past MAX_SESSION_IDLE hours)
 def maintaindatabase():
     sessions = models.Session.query.all()
+    deleted = []
     for session in sessions:
         if not len(session.pedals) or (session.lastmodified == None and session.timestamp < dt.utcnow() - idle_td) or (session.lastmodified and session.lastmodified < dt.utcnow() - idle_td):
             flaskapp.logger.info("Deleted %s session %s at %s" % ("idle" if len(session.pedals) else "orphaned", session.id, dt.now()))
+            deleted.append(session.id)
+
+            # the session's loops release their payloads, which are deleted once no other loop shares them
+            views.discardloops(session, list(session.loops), regenerate=False)
             db.session.delete(session)
 
         db.session.commit()
 
+    # wake the pedals watching the deleted sessions, and forget the sessions' composite versions
+    for sessionid in deleted:
+        views.publishversion(sessionid, None)
+
 # schedule maintaindatabase to run at DB_MAINTENANCE_INTERVAL
 dbsched = BackgroundScheduler()
 dbsched.add_job(func=maintaindatabase, trigger="interval", **DB_MAINTENANCE_INTERVAL)
@@ -1,5 +1,6 @@
 from app import db
 import sqlalchemy
+from sqlalchemy.exc import IntegrityError
 import numpy as np
 from io import BytesIO
 
@@ -11,8 +12,8 @@ from common import *
 
 SAMPLE_MAC = "12:34:56:ab:cd:ef"
 
-# numpy dtype to define loop & composite array entries
-LOOP_ARRAY_DTYPE = [('value', int), ('timestamp', float)]
+# number of composite versions each session keeps a delta for, so pedals that far behind download only the changes
+COMPOSITE_DELTA_HISTORY = 8
 
 # -------------------
 #   Database Models
@@ -25,12 +26,20 @@ class Session(db.Model):
     lastmodified = db.Column(db.DateTime, nullable=True)
     composite = db.Column(db.LargeBinary, nullable=True)
 
+    # incremented every time the composite changes, so pedals can tell whether theirs is current
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
     pedals = db.relationship("Pedal", backref="session", lazy=False)
     loops = db.relationship("Loop", backref="session", lazy=False)
 
+    # only loaded when a pedal asks for changes, unlike the loops
+    deltas = db.relationship("CompositeDelta", backref="session", lazy=True, cascade="all, delete-orphan", order_by="CompositeDelta.version")
+
     # combines loops into composite loop numpy array
     # args:     fromscratch: indicates whether to recombine all loops or just add loops added since last modified (generally, the former is used when deleting loops and the latter when adding)
     def generatecomposite(self, fromscratch):
+        previous = self.composite
+        self.version = (self.version or 0) + 1
         if len(self.loops):
             if self.composite and not fromscratch:
                 self.composite = combineloops([loop for loop in self.loops if loop.timestamp > self.lastmodified], composite=self.composite)
@@ -41,6 +50,34 @@ class Session(db.Model):
             self.composite = None
             self.lastmodified = None
 
+        self.recorddelta(previous)
+
+    # keep the changes from the previous composite version, dropping deltas too old to be worth keeping
+    # deltas only help while they form an unbroken chain up to the current version, so a composite that changed
+    # shape (e.g. a new first loop) drops them all
+    # args:     previous: composite payload before the current version
+    def recorddelta(self, previous):
+        delta = None
+        if previous and self.composite:
+            delta = savedelta(loadloop(previous)[0], *loadloop(self.composite))
+
+        if delta is None:
+            self.deltas = []
+        else:
+            self.deltas = [old for old in self.deltas if old.version > self.version - COMPOSITE_DELTA_HISTORY] + [CompositeDelta(version=self.version, npdata=delta)]
+
+    # payload that brings a pedal's composite up to date, as small as possible
+    # args:     version: composite version the pedal has, or None
+    # return:   chained delta since version if there's an unbroken chain of them and it's smaller, otherwise the full composite
+    def compositesince(self, version):
+        if version is not None and version < self.version:
+            deltas = [delta.npdata for delta in self.deltas if delta.version > version]
+            if len(deltas) == self.version - version:
+                delta = chaindeltas(deltas)
+                if len(delta) < len(self.composite):
+                    return delta
+        return self.composite
+
     def __repr__(self):
         return "<Session %s>" % self.id
 
@@ -62,9 +99,79 @@ class Loop(db.Model):
     pedalmac = db.Column(db.String(18), db.ForeignKey("pedal.mac"), primary_key=True)
     index = db.Column(db.String(4), primary_key=True)
     timestamp = db.Column(db.DateTime)
-    npdata = db.Column(db.LargeBinary, nullable=False)
+
+    # loophash of the loop, under which its payload is stored once however many loops share it
+    hash = db.Column(db.String(64), db.ForeignKey("loop_blob.hash"), nullable=False)
+    blob = db.relationship("LoopBlob", lazy=False)
 
     sessionid = db.Column(db.String(4), db.ForeignKey("session.id"))
 
+    # stored payload of the loop
+    @property
+    def npdata(self):
+        return self.blob.npdata
+
+    # number of samples in the loop, so pedals can check their copies without downloading them
+    @property
+    def length(self):
+        return self.blob.length
+
+    # delete the loop, and its payload along with it if no other loop shares it
+    def discard(self):
+        self.blob.release()
+        db.session.delete(self)
+
     def __repr__(self):
         return "<Loop %s:%s>" % (self.pedalmac, self.index)
+
+# loop payload stored once by content hash, and the number of loops referring to it
+class LoopBlob(db.Model):
+    hash = db.Column(db.String(64), primary_key=True)
+    npdata = db.Column(db.LargeBinary, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+
+    # take a reference to the stored payload with the given hash, storing it first if it isn't already
+    # a payload stored by another request in the meantime rolls back the database session, so this has to be called
+    # before anything else is changed in it
+    # args:     hash: loophash of the loop
+    #           npdata: payload in the stored encoding, or None to only take a reference to one already stored
+    #           length: number of samples in the loop
+    # return:   LoopBlob, or None if npdata is None and no payload with that hash is stored
+    @staticmethod
+    def acquire(hash, npdata=None, length=None):
+        blob = LoopBlob.query.get(hash)
+        if blob is None:
+            if npdata is None:
+                return None
+            try:
+                blob = LoopBlob(hash=hash, npdata=npdata, length=length, refcount=1)
+                db.session.add(blob)
+                db.session.flush()
+                return blob
+            except IntegrityError:
+                db.session.rollback()
+                return LoopBlob.acquire(hash, npdata, length)
+
+        # counted in the database, so that references taken at the same time are all counted
+        blob.refcount = LoopBlob.refcount + 1
+        return blob
+
+    # drop a reference to the payload, deleting it once no loop refers to it
+    def release(self):
+        self.refcount = LoopBlob.refcount - 1
+        db.session.flush()
+        if self.refcount <= 0:
+            db.session.delete(self)
+
+    def __repr__(self):
+        return "<LoopBlob %s>" % self.hash
+
+# changes that took a session composite to the given version from the one before
+class CompositeDelta(db.Model):
+    sessionid = db.Column(db.String(4), db.ForeignKey("session.id"), primary_key=True)
+    version = db.Column(db.Integer, primary_key=True)
+    npdata = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return "<CompositeDelta %s:%d>" % (self.sessionid, self.version)
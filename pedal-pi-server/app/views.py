@@ -8,6 +8,7 @@ from io import BytesIO
 import numpy as np
 import re
 import random
+import threading
 
 import sys
 sys.path.append("../../common")
@@ -26,6 +27,24 @@ MAX_NICKNAME_LENGTH = 20
 MAC_REGEX = re.compile("(..:){5}..")
 NICKNAME_SUB_REGEX = re.compile("[,\n]")
 
+# ----------------------------------
+#   Composite Version Notification
+# ----------------------------------
+
+# latest composite version of each session, kept in memory so that pedals waiting on /watch never touch the database
+# this assumes a single server process (threaded, as run.py runs it), since the conditions can't wake requests in other
+# processes. /watch checks its record against the database each time it's called, and warns if another process has
+# changed a composite without this one hearing of it
+compositeversions = {}
+versionlock = threading.Lock()
+versionconditions = {}
+
+# seconds a change committed by this process is given to be published before its version is taken as unheard of
+VERSION_PUBLISH_GRACE = 1
+
+# whether the warning that another process changed a composite has been logged
+versionwarned = False
+
 # ------------------
 #   Helper Methods
 # ------------------
@@ -39,6 +58,105 @@ def generatesessionid(seed=0):
         seed //= 26
     return sessionid
 
+# condition /watch requests for a session wait on
+# (call with versionlock held)
+
+def versioncondition(sessionid):
+    return versionconditions.setdefault(sessionid, threading.Condition(versionlock))
+
+# record a session's new composite version and wake every pedal watching it
+# args:     sessionid: session whose composite changed
+#           version: new composite version, or None once the session is gone
+
+def publishversion(sessionid, version):
+    with versionlock:
+        if version is None:
+            compositeversions.pop(sessionid, None)
+            condition = versionconditions.pop(sessionid, None)
+        else:
+            compositeversions[sessionid] = version
+            condition = versioncondition(sessionid)
+        if condition:
+            condition.notify_all()
+
+# bring the in-memory record of a session's composite version up to the one in the database, which is ahead of it
+# more than a moment after a change only if another server process made the change, as publishversion can't be heard
+# across processes. pedals watching through this process still get the new version when they next call /watch
+# (call with versionlock held)
+# args:     sessionid: session whose composite changed
+#           version: composite version in the database
+
+def checkversion(sessionid, version):
+    global versionwarned
+    condition = versioncondition(sessionid)
+    behind = lambda: sessionid in compositeversions and compositeversions[sessionid] < version
+
+    # a change made by this process is published straight after it's committed
+    if not condition.wait_for(lambda: not behind(), timeout=VERSION_PUBLISH_GRACE):
+        if not versionwarned:
+            versionwarned = True
+            flaskapp.logger.warning("Composite version %d of session %s was never published to this server process. /watch needs a single server process" % (version, sessionid))
+        compositeversions[sessionid] = version
+        condition.notify_all()
+
+# response carrying a stored loop or composite payload, in the encoding the pedal prefers out of those it accepts
+# pedals that accept none of the loop encodings (e.g. older ones) get a plain saveloop payload
+# args:     payload: payload as stored
+
+def loopresponse(payload):
+    payload, encoding = negotiateloop(payload, acceptedencodings(flask.request.headers.get("Accept-Encoding")))
+    response = flask.Response(payload)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+# response carrying a composite payload, tagged with the composite version it brings the pedal up to
+# args:     session: session the composite belongs to
+#           payload: composite or delta payload, or EMPTY_RETURN
+
+def compositeresponse(session, payload):
+    if payload == EMPTY_RETURN or payload.startswith(COMPOSITE_DELTA_MAGIC):
+        response = flask.Response(payload)
+    else:
+        response = loopresponse(payload)
+    response.headers[COMPOSITE_VERSION_HEADER] = str(session.version)
+    return response
+
+# add a loop referring to a stored payload to the pedal's session, and bring the session composite up to date
+# args:     pedal: sessioned pedal adding the loop
+#           index: index of new loop
+#           blob: LoopBlob holding the loop's payload, already acquired for it
+
+def storeloop(pedal, index, blob):
+    models.Loop(pedalmac=pedal.mac, index=index, timestamp=dt.utcnow(), blob=blob, session=pedal.session)
+
+    pedal.session.generatecomposite(fromscratch=False)
+    pedal.session.lastmodified = dt.utcnow()
+
+    db.session.commit()
+
+    publishversion(pedal.sessionid, pedal.session.version)
+
+# delete loops and bring their session composite up to date, unless the session is about to be closed
+# args:     session: session the loops belong to
+#           loops: loops to delete
+#           regenerate: whether to rebuild the composite from the loops left
+
+def discardloops(session, loops, regenerate=True):
+    for loop in loops:
+        loop.discard()
+
+    db.session.commit()
+
+    if regenerate and len(loops):
+        session.generatecomposite(fromscratch=True)
+        session.lastmodified = dt.utcnow()
+
+        db.session.commit()
+
+        publishversion(session.id, session.version)
+
 # --------------------
 #   Server Endpoints
 # --------------------
@@ -103,9 +221,13 @@ def endsession():
         if pedal and pedal.session:
             if pedal.session.ownermac == mac:
                 flaskapp.logger.info("Pedal %s at IP %s has ended session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
+                sessionid = pedal.sessionid
+                discardloops(pedal.session, list(pedal.session.loops), regenerate=False)
                 db.session.delete(pedal.session)
 
                 db.session.commit()
+
+                publishversion(sessionid, None)
             
                 return SUCCESS_RETURN
             else:
@@ -176,7 +298,10 @@ def leavesession():
         pedal = models.Pedal.query.get(mac)
         if pedal and pedal.session:
             session = pedal.session
+            remaining = [other for other in session.pedals if other.mac != mac]
 
+            # the pedal's loops leave with it, and the payloads no other loop shares along with them
+            discardloops(session, list(pedal.loops), regenerate=bool(remaining))
             db.session.delete(pedal)
             
             db.session.commit()
@@ -185,10 +310,13 @@ def leavesession():
             if not len(session.pedals):
                 flaskapp.logger.info("Empty session %s has been closed" % session.id)
 
+                sessionid = session.id
                 db.session.delete(session)
 
                 db.session.commit()
 
+                publishversion(sessionid, None)
+
             return SUCCESS_RETURN
         else:
             flaskapp.logger.info("Received leave session request from unsessioned pedal %s at IP %s" % (mac, flask.request.remote_addr))
@@ -261,6 +389,27 @@ def getloopids():
         flaskapp.logger.info("Received loop list request without MAC address from IP %s" % flask.request.remote_addr)
         return FAILURE_RETURN
 
+# get the index, content hash and length of every loop this pedal has added to its session, so that it can tell which
+# of its loops the session is missing or holds a different version of without downloading any
+# args:     POST: MAC address of requesting pedal
+# return:   comma-separated index:hash:length entries, NONE_RETURN if pedal unsessioned
+
+@flaskapp.route("/getloophashes", methods=["POST"])
+def getloophashes():
+    mac = flask.request.values.get('mac')
+    if mac and MAC_REGEX.fullmatch(str(mac)):
+        mac = str(mac)
+        pedal = models.Pedal.query.get(mac)
+        if pedal and pedal.session:
+            flaskapp.logger.info("Pedal %s at IP %s has requested loop hashes for session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
+            loops = [loop for loop in pedal.session.loops if loop.pedalmac == mac]
+            return ",".join(["%s:%s:%d" % (loop.index, loop.hash, loop.length) for loop in loops])
+        else:
+            flaskapp.logger.info("Received loop hash request from unsessioned pedal %s at IP %s" % (mac, flask.request.remote_addr))
+            return NONE_RETURN
+    else:
+        flaskapp.logger.info("Received loop hash request without MAC address from IP %s" % flask.request.remote_addr)
+        return FAILURE_RETURN
 
 # add loop to session
 # args:     POST: MAC address of pedal sending loop 
@@ -280,14 +429,20 @@ def addloop():
                     flaskapp.logger.info("Pedal %s at IP %s attempted to add loop to session %s at already-present index %s" % (mac, flask.request.remote_addr, pedal.sessionid, index))
                     return FAILURE_RETURN
                 else:
+                    # store every loop in the current format and the stored encoding, which uploads already come in
+                    # uploads from older pedals are converted once here, so nothing is re-encoded when it's served
+                    try:
+                        loopdata, loopsum = loadloop(npdata)
+                        if loopencoding(npdata) != LOOP_STORE_ENCODING:
+                            npdata = encodeloop(loopdata, loopsum)
+                    except ValueError:
+                        flaskapp.logger.info("Pedal %s at IP %s attempted to add invalid loop data to session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
+                        return FAILURE_RETURN
+
                     flaskapp.logger.info("Pedal %s at IP %s added a new loop to session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
-                
-                    loop = models.Loop(pedalmac=mac, index=index, timestamp=dt.utcnow(), npdata=npdata, session=pedal.session)
 
-                    pedal.session.generatecomposite(fromscratch=False)
-                    pedal.session.lastmodified = dt.utcnow()
-                    
-                    db.session.commit()
+                    # a payload already stored under the same hash is shared instead of stored again
+                    storeloop(pedal, index, models.LoopBlob.acquire(loophash(loopdata), npdata, len(loopdata)))
                     return SUCCESS_RETURN
             else:
                 flaskapp.logger.info("Pedal %s at IP %s attempted to add loop to full session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
@@ -299,10 +454,47 @@ def addloop():
         flaskapp.logger.info("Received incomplete add loop request from IP %s: MAC? %r, index? %r, raw data? %r" % (flask.request.remote_addr, bool(mac), bool(index), bool(npdata)))
         return FAILURE_RETURN
 
+# add loop to session by content hash, without sending it, if the server already stores a loop with that hash
+# pedals call this before /addloop, and only send the loop itself if the server doesn't have it
+# args:     POST: MAC address of pedal sending loop
+#           POST: index of new loop
+#           POST: loophash of the loop
+# return:   SUCCESS_RETURN if loop added, NONE_RETURN if no loop with that hash is stored, FULL_RETURN if session full,
+#           FAILURE_RETURN if index already present from given mac, or if pedal unsessioned
+
+@flaskapp.route("/haveloop", methods=["POST"])
+def haveloop():
+    mac, index, hash = [flask.request.values.get(key) for key in ('mac', 'index', 'hash')]
+    if mac and MAC_REGEX.fullmatch(str(mac)) and index and hash:
+        mac, index, hash = [str(val) for val in (mac, index, hash)]
+        pedal = models.Pedal.query.get(mac)
+        if pedal and pedal.session:
+            if len(pedal.session.loops) < MAX_LOOPS:
+                if models.Loop.query.get((mac, index)):
+                    flaskapp.logger.info("Pedal %s at IP %s attempted to add loop to session %s at already-present index %s" % (mac, flask.request.remote_addr, pedal.sessionid, index))
+                    return FAILURE_RETURN
+                else:
+                    blob = models.LoopBlob.acquire(hash)
+                    if blob:
+                        flaskapp.logger.info("Pedal %s at IP %s added an already-stored loop to session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
+                        storeloop(pedal, index, blob)
+                        return SUCCESS_RETURN
+                    else:
+                        return NONE_RETURN
+            else:
+                flaskapp.logger.info("Pedal %s at IP %s attempted to add loop to full session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
+                return FULL_RETURN
+        else:
+            flaskapp.logger.info("Received add loop by hash request from unsessioned pedal %s at IP %s" % (mac, flask.request.remote_addr))
+            return FAILURE_RETURN
+    else:
+        flaskapp.logger.info("Received incomplete add loop by hash request from IP %s: MAC? %r, index? %r, hash? %r" % (flask.request.remote_addr, bool(mac), bool(index), bool(hash)))
+        return FAILURE_RETURN
+
 # return specified loop
 # args:     POST: MAC address of pedal removing loop 
 #           POST: index of loop to remove
-# return:   loop data on success, FAILURE_RETURN if no loop at index + mac of pedal or if pedal unsessioned
+# return:   loop payload on success, in the encoding negotiated through Accept-Encoding, FAILURE_RETURN if no loop at index + mac of pedal or if pedal unsessioned
 
 @flaskapp.route("/getloop", methods=["POST"])
 def getloop():
@@ -315,7 +507,7 @@ def getloop():
             if loop:
                 flaskapp.logger.info("Pedal %s at IP %s downloaded loop %s from session %s" % (mac, flask.request.remote_addr, index, pedal.sessionid))
 
-                return flask.Response(loop.npdata)
+                return loopresponse(loop.npdata)
             else:
                 flaskapp.logger.info("Pedal %s at IP %s attempted to download nonexistent loop %s from session %s" % (mac, flask.request.remote_addr, index, pedal.sessionid))
                 return FAILURE_RETURN
@@ -326,6 +518,39 @@ def getloop():
         flaskapp.logger.info("Received incomplete download loop request from IP %s: MAC? %r, index? %r" % (flask.request.remote_addr, bool(mac), bool(index)))
         return FAILURE_RETURN
 
+# return several of this pedal's loops at once
+# args:     POST: MAC address of pedal downloading loops
+#           POST: comma-separated indices of loops to download
+# return:   bundle of the loops found, each in the encoding negotiated through Accept-Encoding, as written by packloops
+#           FAILURE_RETURN if pedal unsessioned or indices invalid
+
+@flaskapp.route("/getloops", methods=["POST"])
+def getloops():
+    mac, indices = [flask.request.values.get(key) for key in ('mac', 'indices')]
+    if mac and MAC_REGEX.fullmatch(str(mac)) and indices:
+        mac = str(mac)
+        pedal = models.Pedal.query.get(mac)
+        if pedal and pedal.session:
+            try:
+                indices = [int(index) for index in str(indices).split(",")]
+            except ValueError:
+                flaskapp.logger.info("Received invalid loop indices from pedal %s at IP %s" % (mac, flask.request.remote_addr))
+                return FAILURE_RETURN
+
+            accepted = acceptedencodings(flask.request.headers.get("Accept-Encoding"))
+            loops = [models.Loop.query.get((mac, str(index))) for index in indices]
+            flaskapp.logger.info("Pedal %s at IP %s downloaded %d loops from session %s" % (mac, flask.request.remote_addr, len([loop for loop in loops if loop]), pedal.sessionid))
+
+            response = flask.Response(packloops([(int(loop.index), negotiateloop(loop.npdata, accepted)[0]) for loop in loops if loop]))
+            response.headers["Vary"] = "Accept-Encoding"
+            return response
+        else:
+            flaskapp.logger.info("Received bulk download request from unsessioned pedal %s at IP %s" % (mac, flask.request.remote_addr))
+            return FAILURE_RETURN
+    else:
+        flaskapp.logger.info("Received incomplete bulk download request from IP %s: MAC? %r, indices? %r" % (flask.request.remote_addr, bool(mac), bool(indices)))
+        return FAILURE_RETURN
+
 # remove loop from session
 # args:     POST: MAC address of pedal removing loop 
 #           POST: index of loop to remove
@@ -340,16 +565,9 @@ def removeloop():
         if pedal and pedal.session:
             loop = models.Loop.query.get((mac, index))
             if loop:
-                db.session.delete(loop)
-
                 flaskapp.logger.info("Pedal %s at IP %s removed loop %s from session %s" % (mac, flask.request.remote_addr, index, pedal.sessionid))
 
-                db.session.commit()
-
-                pedal.session.generatecomposite(fromscratch=True)
-                pedal.session.lastmodified = dt.utcnow()
-
-                db.session.commit()
+                discardloops(pedal.session, [loop])
                 
                 return SUCCESS_RETURN
             else:
@@ -363,20 +581,34 @@ def removeloop():
         return FAILURE_RETURN
 
 # get current composite
-# this is the method clients use for polling
+# pedals call this once /watch reports a new version, passing the version they have so that only the changes are sent
 # args:     POST: MAC address of pedal requesting composite 
 #           POST: timestamp of last update (can be null)
-# return:   raw data if update necessary, NONE_RETURN if no updates since provided timestamp or unsessioned
+#           POST: composite version the pedal has (can be null, takes precedence over timestamp)
+# return:   composite payload if update necessary, in the encoding negotiated through Accept-Encoding, a delta payload instead when the pedal's version is recent enough and the delta
+#           is smaller, NONE_RETURN if no updates since provided timestamp or version, FAILURE_RETURN if unsessioned
+#           the version the response brings the pedal up to is sent in the COMPOSITE_VERSION_HEADER response header
 
 @flaskapp.route("/getcomposite", methods=["POST"])
 def getcomposite():
-    mac, timestamp = [flask.request.values.get(key) for key in ('mac', 'timestamp')]
+    mac, timestamp, version = [flask.request.values.get(key) for key in ('mac', 'timestamp', 'version')]
     if mac and MAC_REGEX.fullmatch(str(mac)):
         mac = str(mac)
         pedal = models.Pedal.query.get(mac)
         if pedal and pedal.session:
-            if pedal.session.composite:
-                if timestamp and timestamp != "None":
+            try:
+                version = int(version) if version and version != "None" else None
+            except ValueError:
+                flaskapp.logger.info("Received invalid composite version from pedal %s at IP %s" % (mac, flask.request.remote_addr))
+                return FAILURE_RETURN
+
+            if version == pedal.session.version:
+                return NONE_RETURN
+            elif pedal.session.composite:
+                if version is not None:
+                    flaskapp.logger.info("Pedal %s at IP %s has requested composite changes since version %d for session %s" % (mac, flask.request.remote_addr, version, pedal.sessionid))
+                    return compositeresponse(pedal.session, pedal.session.compositesince(version))
+                elif timestamp and timestamp != "None":
                     flaskapp.logger.info("Pedal %s at IP %s has requested composite from %s for session %s" % (mac, flask.request.remote_addr, timestamp, pedal.sessionid))
                     try:
                         timestamp = float(timestamp)
@@ -384,19 +616,66 @@ def getcomposite():
                         flaskapp.logger.info("Received invalid timestamp from pedal %s at IP %s" % (mac, flask.request.remote_addr))
                         return FALSE_RETURN
                     if timestamp < pedal.session.lastmodified.timestamp():
-                        return flask.Response(pedal.session.composite)
+                        return compositeresponse(pedal.session, pedal.session.composite)
                     else:
                         return NONE_RETURN
                 else:
                     flaskapp.logger.info("Pedal %s at IP %s has requested composite without timestamp for session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
                     flaskapp.logger.info("Sending composite...")
-                    return flask.Response(pedal.session.composite)
+                    return compositeresponse(pedal.session, pedal.session.composite)
             else:
                 flaskapp.logger.info("Pedal %s at IP %s has received empty composite for session %s" % (mac, flask.request.remote_addr, pedal.sessionid))
-                return EMPTY_RETURN
+                return compositeresponse(pedal.session, EMPTY_RETURN)
         else:
             flaskapp.logger.info("Received composite request from unsessioned pedal %s at IP %s" % (mac, flask.request.remote_addr))
             return FAILURE_RETURN
     else:
         flaskapp.logger.info("Received composite request without MAC address from IP %s" % flask.request.remote_addr)
         return FAILURE_RETURN
+
+# wait for the session composite to change
+# this is the method clients use to be notified of composite updates, instead of polling /getcomposite
+# the request is held open until the composite version differs from the one given, or for up to WATCH_TIMEOUT
+# only the pedal's session id and the session version are read from the database, never the loop data
+# args:     POST: MAC address of watching pedal
+#           POST: composite version the pedal last downloaded (can be null, which returns the current version straight away)
+# return:   new composite version, NONE_RETURN if unchanged within WATCH_TIMEOUT, FAILURE_RETURN if unsessioned or session ended
+
+@flaskapp.route("/watch", methods=["POST"])
+def watch():
+    mac, version = [flask.request.values.get(key) for key in ('mac', 'version')]
+    if mac and MAC_REGEX.fullmatch(str(mac)):
+        mac = str(mac)
+        sessionid = db.session.query(models.Pedal.sessionid).filter_by(mac=mac).scalar()
+        if sessionid:
+            try:
+                version = int(version) if version and version != "None" else None
+            except ValueError:
+                flaskapp.logger.info("Received invalid composite version from pedal %s at IP %s" % (mac, flask.request.remote_addr))
+                return FAILURE_RETURN
+
+            currentversion = db.session.query(models.Session.version).filter_by(id=sessionid).scalar() or 0
+
+            # hand the database connection back before waiting
+            db.session.close()
+
+            with versionlock:
+                if compositeversions.setdefault(sessionid, currentversion) < currentversion:
+                    checkversion(sessionid, currentversion)
+                versioncondition(sessionid).wait_for(lambda: compositeversions.get(sessionid) != version, timeout=WATCH_TIMEOUT)
+                newversion = compositeversions.get(sessionid)
+
+            if newversion is None:
+                flaskapp.logger.info("Session %s watched by pedal %s at IP %s has ended" % (sessionid, mac, flask.request.remote_addr))
+                return FAILURE_RETURN
+            elif newversion == version:
+                return NONE_RETURN
+            else:
+                flaskapp.logger.info("Notified pedal %s at IP %s of composite version %d for session %s" % (mac, flask.request.remote_addr, newversion, sessionid))
+                return str(newversion)
+        else:
+            flaskapp.logger.info("Received watch request from unsessioned pedal %s at IP %s" % (mac, flask.request.remote_addr))
+            return FAILURE_RETURN
+    else:
+        flaskapp.logger.info("Received watch request without MAC address from IP %s" % flask.request.remote_addr)
+        return FAILURE_RETURN
@@ -0,0 +1,66 @@
+from sqlalchemy import *
+from migrate import *
+
+from common import *
+
+# moves every loop payload out of the loop table into loop_blob, stored once per loophash with the number of loops
+# referring to it. loops that were stored before their hash was (or without one at all) have it computed here
+
+def blobtable(meta):
+    return Table("loop_blob", meta,
+        Column("hash", String(64), primary_key=True),
+        Column("npdata", LargeBinary, nullable=False),
+        Column("length", Integer, nullable=False),
+        Column("refcount", Integer, nullable=False, default=0))
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    loop = Table("loop", meta, autoload=True)
+    loopblob = blobtable(meta)
+    loopblob.create()
+
+    if "hash" not in loop.c:
+        Column("hash", String(64), nullable=True).create(loop)
+
+    blobs = {}
+    for pedalmac, index, npdata in migrate_engine.execute(select([loop.c.pedalmac, loop.c.index, loop.c.npdata])).fetchall():
+        try:
+            loopdata, loopsum = loadloop(npdata)
+        except ValueError:
+            # a loop that can't be read can't be hashed, and could never have been played either
+            migrate_engine.execute(loop.delete().where(and_(loop.c.pedalmac == pedalmac, loop.c.index == index)))
+            continue
+
+        hash = loophash(loopdata)
+        if hash in blobs:
+            blobs[hash]['refcount'] += 1
+        else:
+            if loopencoding(npdata) != LOOP_STORE_ENCODING:
+                npdata = encodeloop(loopdata, loopsum)
+            blobs[hash] = {'hash' : hash, 'npdata' : npdata, 'length' : len(loopdata), 'refcount' : 1}
+
+        migrate_engine.execute(loop.update().where(and_(loop.c.pedalmac == pedalmac, loop.c.index == index)).values(hash=hash))
+
+    if blobs:
+        migrate_engine.execute(loopblob.insert(), list(blobs.values()))
+
+    # only dropped once every payload has been copied
+    loop.c.npdata.drop()
+    if "length" in loop.c:
+        loop.c.length.drop()
+    loop.c.hash.alter(nullable=False)
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    loop = Table("loop", meta, autoload=True)
+    loopblob = Table("loop_blob", meta, autoload=True)
+
+    Column("npdata", LargeBinary, nullable=True).create(loop)
+    Column("length", Integer, nullable=True).create(loop)
+
+    for hash, npdata, length in migrate_engine.execute(select([loopblob.c.hash, loopblob.c.npdata, loopblob.c.length])).fetchall():
+        migrate_engine.execute(loop.update().where(loop.c.hash == hash).values(npdata=npdata, length=length))
+
+    loop.c.hash.alter(nullable=True)
+    loop.c.npdata.alter(nullable=False)
+    loopblob.drop()
@@ -0,0 +1,19 @@
+from sqlalchemy import *
+from migrate import *
+
+# adds the composite version of each session, which pedals compare against theirs to tell whether it's current
+# existing sessions start from version 0, like new ones. databases created since the column was added already
+# have it, having been stamped at the latest version when they were created
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    session = Table("session", meta, autoload=True)
+
+    if "version" not in session.c:
+        Column("version", Integer, nullable=False, server_default="0").create(session)
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    session = Table("session", meta, autoload=True)
+
+    session.c.version.drop()
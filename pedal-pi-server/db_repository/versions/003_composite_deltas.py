@@ -0,0 +1,27 @@
+from sqlalchemy import *
+from migrate import *
+
+# adds the table of composite deltas, kept per session so pedals holding an older version of the composite are
+# sent the ranges that changed instead of the whole composite. databases created since the table was added
+# already have it, having been stamped at the latest version when they were created
+
+def deltatable(meta):
+    return Table("composite_delta", meta,
+        Column("sessionid", String(4), ForeignKey("session.id"), primary_key=True),
+        Column("version", Integer, primary_key=True),
+        Column("npdata", LargeBinary, nullable=False))
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+
+    # the foreign key is resolved against the session table
+    Table("session", meta, autoload=True)
+
+    if not migrate_engine.has_table("composite_delta"):
+        deltatable(meta).create()
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    compositedelta = Table("composite_delta", meta, autoload=True)
+
+    compositedelta.drop()
@@ -5,6 +5,8 @@ import unittest
 from app import flaskapp, db, models, views
 import requests as req
 import re
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from pydub import AudioSegment, playback
 from io import BytesIO
@@ -201,6 +203,145 @@ class TestCase(unittest.TestCase):
         print(len(refloop.raw_data))
         '''
         assert resploop == refloop.raw_data
-                
+
+    def testwatch(self):
+        pedal = genpedal()
+        req.post(BASEURL + "newsession", data=pedal)
+
+        # no version returns the current one straight away
+        version = int(req.post(BASEURL + "watch", data=pedal).text)
+
+        # a waiting watch returns as soon as a loop is added
+        pedal['version'] = version
+        watcher = ThreadPoolExecutor(max_workers=1).submit(req.post, BASEURL + "watch", data=dict(pedal))
+        pedal['index'] = 0
+        req.post(BASEURL + "addloop", data=pedal, files={'npdata' : BytesIO(views.saveloop(np.ones(100, dtype=views.LOOP_ARRAY_DTYPE)))})
+        assert int(watcher.result(timeout=5).text) == version + 1
+
+        pedal['version'] = version + 1
+        watcher = ThreadPoolExecutor(max_workers=1).submit(req.post, BASEURL + "watch", data=dict(pedal))
+        req.post(BASEURL + "endsession", data=pedal)
+        assert watcher.result(timeout=5).text == views.FAILURE_RETURN
+
+    def testcompositedelta(self):
+        pedal = genpedal()
+        req.post(BASEURL + "newsession", data=pedal)
+
+        loop = np.zeros(1000, dtype=views.LOOP_ARRAY_DTYPE)
+        loop['value'] = np.arange(1000)
+        loop['timestamp'] = np.arange(1000) / 8000
+        pedal['index'] = 0
+        req.post(BASEURL + "addloop", data=pedal, files={'npdata' : BytesIO(views.saveloop(loop))})
+        resp = req.post(BASEURL + "getcomposite", data=pedal)
+        version = int(resp.headers[views.COMPOSITE_VERSION_HEADER])
+        composite = views.loadloop(resp.content)[0]
+
+        # an up-to-date pedal gets nothing, and one a version behind gets just the changed samples
+        pedal['version'] = version
+        assert req.post(BASEURL + "getcomposite", data=pedal).text == views.NONE_RETURN
+
+        loop['value'][:10] = 1
+        pedal['index'] = 1
+        req.post(BASEURL + "addloop", data=pedal, files={'npdata' : BytesIO(views.saveloop(loop[:10]))})
+        resp = req.post(BASEURL + "getcomposite", data=pedal)
+        assert resp.content.startswith(views.COMPOSITE_DELTA_MAGIC)
+        assert int(resp.headers[views.COMPOSITE_VERSION_HEADER]) == version + 1
+
+        views.applydelta(composite, *views.loaddelta(resp.content)[:3])
+        pedal.pop('version')
+        assert np.array_equal(composite, views.loadloop(req.post(BASEURL + "getcomposite", data=pedal).content)[0])
+
+    def testloopencoding(self):
+        pedal = genpedal()
+        req.post(BASEURL + "newsession", data=pedal)
+
+        loop = np.zeros(44100, dtype=views.LOOP_ARRAY_DTYPE)
+        loop['value'] = 2048 + 1500 * np.sin(np.arange(44100) / 20)
+        loop['timestamp'] = np.arange(44100) / 44100
+        pedal['index'] = 0
+        req.post(BASEURL + "addloop", data=pedal, files={'npdata' : BytesIO(views.encodeloop(loop))})
+
+        # loops are sent as stored to pedals that accept the stored encoding, and converted for those that don't
+        for accept in [views.LOOP_ACCEPT_ENCODING, "x-sloop-lzma", "gzip, deflate"]:
+            for endpoint in ["getloop", "getcomposite"]:
+                resp = req.post(BASEURL + endpoint, data=pedal, headers={'Accept-Encoding' : accept})
+                encoding = views.acceptedencodings(accept)[0] if views.acceptedencodings(accept) else None
+                assert resp.headers.get("Content-Encoding") == encoding
+                assert views.loopencoding(resp.content) == encoding
+                assert np.array_equal(views.loadloop(resp.content)[0], loop)
+
+    def testloophashes(self):
+        pedal = genpedal()
+        req.post(BASEURL + "newsession", data=pedal)
+
+        loops = {}
+        for index in range(1, 4):
+            loops[index] = np.zeros(100 * index, dtype=views.LOOP_ARRAY_DTYPE)
+            loops[index]['value'] = np.arange(100 * index)
+            loops[index]['timestamp'] = np.arange(100 * index) / 44100
+            pedal['index'] = index
+            req.post(BASEURL + "addloop", data=pedal, files={'npdata' : BytesIO(views.saveloop(loops[index]))})
+
+        hashes = req.post(BASEURL + "getloophashes", data=pedal).text
+        assert hashes == ",".join(["%d:%s:%d" % (index, views.loophash(loop), len(loop)) for index, loop in loops.items()])
+
+        # only the loops asked for come back, and loops that aren't there are left out
+        pedal['indices'] = "1,3,9"
+        bundle = req.post(BASEURL + "getloops", data=pedal, headers={'Accept-Encoding' : views.LOOP_ACCEPT_ENCODING}).content
+        unpacked = dict(views.unpackloops(bundle))
+        assert sorted(unpacked) == [1, 3]
+        assert all(np.array_equal(views.loadloop(unpacked[index])[0], loops[index]) for index in unpacked)
+
+    def testsharedloops(self):
+        pedal1 = genpedal()
+        pedal2 = genpedal(1)
+        sess = req.post(BASEURL + "newsession", data=pedal1).text
+        pedal2['sessionid'] = sess
+        req.post(BASEURL + "joinsession", data=pedal2)
+
+        loop = np.zeros(1000, dtype=views.LOOP_ARRAY_DTYPE)
+        loop['value'] = np.arange(1000)
+        loop['timestamp'] = np.arange(1000) / 44100
+        loophash = views.loophash(loop)
+
+        # a hash the server hasn't seen is turned down, so the loop itself has to be sent
+        pedal1['index'], pedal1['hash'] = 0, loophash
+        assert req.post(BASEURL + "haveloop", data=pedal1).text == views.NONE_RETURN
+        assert req.post(BASEURL + "addloop", data=pedal1, files={'npdata' : BytesIO(views.encodeloop(loop))}).text == views.SUCCESS_RETURN
+
+        # after which the same loop is added by hash alone, by either pedal, and stored only once
+        pedal2['index'], pedal2['hash'] = 0, loophash
+        assert req.post(BASEURL + "haveloop", data=pedal2).text == views.SUCCESS_RETURN
+        pedal1['index'] = 1
+        assert req.post(BASEURL + "haveloop", data=pedal1).text == views.SUCCESS_RETURN
+        assert req.post(BASEURL + "haveloop", data=pedal1).text == views.FAILURE_RETURN
+        assert models.LoopBlob.query.count() == 1 and models.LoopBlob.query.get(loophash).refcount == 3
+
+        # the payload outlives every loop but the last one referring to it
+        assert req.post(BASEURL + "removeloop", data=pedal1).text == views.SUCCESS_RETURN
+        assert np.array_equal(views.loadloop(req.post(BASEURL + "getloop", data=pedal2).content)[0], loop)
+        assert req.post(BASEURL + "leavesession", data=pedal2).text == views.SUCCESS_RETURN
+        pedal1['index'] = 0
+        assert np.array_equal(views.loadloop(req.post(BASEURL + "getloop", data=pedal1).content)[0], loop)
+        assert req.post(BASEURL + "endsession", data=pedal1).text == views.SUCCESS_RETURN
+        assert models.LoopBlob.query.count() == 0
+
+    def testsharedloopsrace(self):
+        pedals = [genpedal(index) for index in range(4)]
+        for pedal in pedals:
+            req.post(BASEURL + "newsession", data=pedal)
+            pedal['index'] = 0
+
+        loop = np.zeros(1000, dtype=views.LOOP_ARRAY_DTYPE)
+        loop['value'] = np.arange(1000)
+        loop['timestamp'] = np.arange(1000) / 44100
+        npdata = views.encodeloop(loop)
+
+        # pedals uploading the same new loop at once all get it stored, once, and counted for each of them
+        with ThreadPoolExecutor(max_workers=len(pedals)) as executor:
+            responses = list(executor.map(lambda pedal: req.post(BASEURL + "addloop", data=pedal, files={'npdata' : BytesIO(npdata)}).text, pedals))
+        assert responses == [views.SUCCESS_RETURN] * len(pedals)
+        assert models.LoopBlob.query.count() == 1 and models.LoopBlob.query.get(views.loophash(loop)).refcount == len(pedals)
+
 if __name__ == "__main__":
     unittest.main()